@@ -0,0 +1,1096 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from functools import partial
+from types import SimpleNamespace
+from typing import Any, Callable, Optional
+
+import numpy as np
+import yaml
+from scipy.ndimage import gaussian_filter
+from sklearn.cluster import AgglomerativeClustering
+
+from environment import Environment, EnvironmentController
+from episode_catalog import EpisodeCatalog
+from episode_sampler import BalancedSampler
+from network import NodeRegistry, MessageServer, RemoteThread, write_file_chunk, resolve_file_path
+from parallelism import LocalThread, Process, QueueStats, EventLoopTask
+from preprocessed_cache import PreprocessedCache
+from weight_store import SharedWeightStore
+
+# the modules that import tensorflow are imported in the checks that use them, so the rest run without it
+
+channels = ['control', 'data']
+
+
+def record_message(received: list, node: str, index: int) -> None:
+    received.append((node, index))
+
+
+def get_message_tester(item: Any) -> Optional[str]:
+    return item[1][0] if item[1][0].startswith('tester') else None
+
+
+def reply(received: list, node: str) -> None:
+    received.append(node)
+
+
+# a worker node sends messages and a file to the learner node, then waits for the reply of the learner
+def run_network_worker_node(registry: NodeRegistry, node: str, message_count: int, file_path: str) -> None:
+    thread = LocalThread(None, None, cfg={'queue_size': 0, 'channels': channels}, main_thread=True)
+    server = MessageServer(registry.get_bind_address(node), lambda frame: thread.put(frame[2], frame[3]),
+                           registry.authkey)
+    server.start()
+    learner = RemoteThread(registry.get_address(registry.learner_node), 'learner', channels, registry.authkey)
+    learner.send_file(file_path, node, os.path.basename(file_path), chunk_size=1 << 16)
+    for i in range(message_count):
+        learner.add_to_run_queue(record_message, node, i)
+    learner.add_to_run_queue(reply, node, channel='control')
+    received = []
+    thread.pop_and_run_next(received, wait=True)
+    assert received == ['learner'], received
+    learner.close()
+    server.close()
+
+
+def check_network(node_count: int = 3, message_count: int = 1000, port: int = 7150) -> None:
+    nodes = {'learner': f'localhost:{port}', **{f'node_{i}': f'localhost:{port + 1 + i}' for i in range(node_count)}}
+    registry = NodeRegistry({'nodes': nodes, 'learner_node': 'learner', 'worker_nodes': list(nodes)[1:],
+                             'bind_host': 'localhost', 'authkey': os.urandom(16).hex()})
+    directory = tempfile.mkdtemp()
+    learner = LocalThread(None, None, cfg={'queue_size': 0, 'channels': channels}, main_thread=True)
+
+    def on_frame(frame):
+        if frame[0] == 'message':
+            learner.put(frame[2], frame[3])
+        else:
+            _, node, relative_path, offset, data = frame
+            write_file_chunk(resolve_file_path(f'{directory}/received/{node}', relative_path), offset, data)
+
+    server = MessageServer(registry.get_bind_address('learner'), on_frame, registry.authkey)
+    server.start()
+    file_data = np.random.randint(0, 256, 1 << 20, dtype=np.uint8)
+    file_path = f'{directory}/episodes.npy'
+    file_data.tofile(file_path)
+
+    # a node without the authkey is disconnected before its frames are read, and files may not leave their directory
+    intruder = RemoteThread(registry.get_address('learner'), 'learner', channels, b'wrong key')
+    intruder.add_to_run_queue(record_message, 'intruder', 0)
+    intruder.close()
+    try:
+        resolve_file_path(directory, '../episodes.npy')
+        assert False
+    except ValueError:
+        pass
+
+    mp = multiprocessing.get_context('spawn')
+    start_time = time.time()
+    processes = [mp.Process(target=run_network_worker_node, args=(registry, node, message_count, file_path))
+                 for node in registry.worker_nodes]
+    [process.start() for process in processes]
+    received = []
+    replied = []
+    while len(replied) < node_count:
+        for func, args, _ in learner.pop_ready(10):
+            func(replied if func is reply else received, *args)
+    for node in replied:
+        RemoteThread(registry.get_address(node), 'node', channels, registry.authkey).add_to_run_queue(reply, 'learner')
+    [process.join() for process in processes]
+    elapsed = time.time() - start_time
+    server.close()
+
+    assert all(node != 'intruder' for node, _ in received)
+    for node in registry.worker_nodes:
+        assert [i for n, i in received if n == node] == list(range(message_count))
+        assert np.array_equal(np.fromfile(f'{directory}/received/{node}/episodes.npy', dtype=np.uint8), file_data)
+    print(f'{datetime.now()}: network: {node_count} nodes sent {node_count * message_count} messages and '
+          f'{node_count} files of {len(file_data) >> 20}MB in {elapsed:.2f}s.')
+
+
+# the coordinate transforms of main.py with the shapes of the default configs
+screen_shape = np.array([234, 224])
+crop_top_left = np.array([10, 0])
+crop_size = np.array([224, 224])
+prediction_shape = np.array([56, 56])
+mask_shape = (56, 56, 1)
+
+
+def screen_pos_to_action_pos(p: np.ndarray) -> np.ndarray:
+    return (p - crop_top_left) * (prediction_shape / crop_size)
+
+
+def action_pos_to_screen_pos(p: np.ndarray) -> np.ndarray:
+    return p * (crop_size / prediction_shape) + crop_top_left
+
+
+def create_batch(batch_size: int):
+    states = np.random.randint(0, 256, (batch_size, *screen_shape, 3), dtype=np.uint8)
+    actions = np.zeros((batch_size, 3), dtype=np.int32)
+    actions[:, :2] = np.random.randint(0, prediction_shape, (batch_size, 2))
+    actions[:, 2] = np.random.randint(0, 3, batch_size)
+    return states, actions
+
+
+def time_call(func, repeats: int) -> float:
+    start_time = time.time()
+    for _ in range(repeats):
+        func()
+    return (time.time() - start_time) / repeats
+
+
+def check_distortions(batch_size: int = 64, repeats: int = 20) -> None:
+    from distortions import distort_episode_shift, distort_episode_color, draw_batch_shifts, \
+        shift_batch, distort_batch_color, BatchDistorter, distort_batch_shift
+    from single_state_categorical_reward import Episode
+
+    states, actions = create_batch(batch_size)
+    shift_max_value = np.array([10, 10])
+    rows = np.arange(batch_size)
+
+    # equivalence: the per sample shift is given the shifts drawn for the batch
+    shifts = draw_batch_shifts(actions, screen_shape, mask_shape, shift_max_value, action_pos_to_screen_pos,
+                               screen_pos_to_action_pos)
+    states2, actions2 = states.copy(), actions.copy()
+    masks, masks2 = np.ones((batch_size, *mask_shape)), np.ones((batch_size, *mask_shape))
+    shift_batch(states2, actions2, rows, shifts, masks, masks2, action_pos_to_screen_pos, screen_pos_to_action_pos)
+    randint = np.random.randint
+    try:
+        for i in range(batch_size):
+            given_shifts = iter(shifts[i])
+            np.random.randint = lambda low, high: next(given_shifts)
+            episode2, mask, mask2 = distort_episode_shift(
+                Episode(states[i], actions[i], np.zeros((), np.bool), states[i]), mask_shape, shift_max_value,
+                action_pos_to_screen_pos, screen_pos_to_action_pos)
+            assert np.array_equal(episode2.state, states2[i]) and np.array_equal(episode2.action, actions2[i])
+            assert np.array_equal(mask, masks[i]) and np.array_equal(mask2, masks2[i])
+    finally:
+        np.random.randint = randint
+
+    # like the learner did, the distorted samples are stored in the batch
+    def per_sample(func):
+        batch_states2 = np.zeros_like(states)
+        batch_masks = np.zeros((batch_size, *mask_shape), np.float32)
+        for i in range(batch_size):
+            episode2, mask, mask2 = func(Episode(states[i], actions[i], np.zeros((), np.bool), states[i]), mask_shape)
+            batch_states2[i] = episode2.state
+            batch_masks[i] = mask
+
+    def batch(func):
+        distorter = BatchDistorter([(func, 1)], mask_shape)
+        distorter(states, actions, np.zeros_like(states), np.zeros_like(actions),
+                  np.zeros((batch_size, *mask_shape), np.float32), np.zeros((batch_size, *mask_shape), np.float32))
+
+    for name, sample_func, batch_func in [
+        ('shift', partial(distort_episode_shift, shift_max_value=shift_max_value,
+                          action_pos_to_screen_pos=action_pos_to_screen_pos,
+                          screen_pos_to_action_pos=screen_pos_to_action_pos),
+         partial(distort_batch_shift, shift_max_value=shift_max_value,
+                 action_pos_to_screen_pos=action_pos_to_screen_pos, screen_pos_to_action_pos=screen_pos_to_action_pos)),
+            ('color', distort_episode_color, distort_batch_color)]:
+        sample_time = time_call(partial(per_sample, sample_func), repeats)
+        batch_time = time_call(partial(batch, batch_func), repeats)
+        print(f'{datetime.now()}: distortions: {name} took {sample_time / batch_size * 1000:.3f}ms per sample one '
+              f'sample at a time and {batch_time / batch_size * 1000:.3f}ms per sample in batches of {batch_size} '
+              f'({sample_time / batch_time:.1f}x).')
+
+
+# stands for a reward predictor that has a fixed cost per batch besides its cost per frame, like mobilenet on cpu. the
+#   prediction of a frame is its mean, so the agents can check that they got their own predictions
+class FixedCostModel:
+    def __init__(self, weights_file: str = None, batch_cost: float = .02, frame_cost: float = .002):
+        self.batch_cost = batch_cost
+        self.frame_cost = frame_cost
+        self.weight_updates = []
+
+    def set_weights(self, weights: list) -> None:
+        self.weight_updates.append(weights)
+
+    def predict_on_batch(self, frames: np.ndarray) -> np.ndarray:
+        time.sleep(self.batch_cost + self.frame_cost * len(frames))
+        means = np.mean(frames, axis=(1, 2, 3), dtype=np.float32)
+        return np.broadcast_to(means.reshape(-1, 1, 1, 1), (len(frames), *prediction_shape, 3))
+
+
+# the agents start together and report when they are done, so process start up is not measured
+def run_inference_agent(client: Any, steps: int, barrier: Any, end_times: Any) -> None:
+    barrier.wait()
+    for _ in range(steps):
+        state = np.full((*screen_shape, 3), np.random.randint(256), np.uint8)
+        prediction = client.predict(state)
+        assert prediction.shape == (*prediction_shape, 3) and np.all(prediction == state[0, 0, 0])
+    end_times.put(time.time())
+
+
+def check_inference(agent_count: int = 8, steps: int = 50) -> None:
+    from inference import InferenceServer
+
+    directory = tempfile.mkdtemp()
+    server = InferenceServer(FixedCostModel, agent_count, np.zeros((*screen_shape, 3), np.uint8),
+                             {'path': f'{directory}/inference', 'max_batch_size': 16, 'max_latency': .01,
+                              'stats_frequency': 1, 'prediction_shape': (*prediction_shape, 3)})
+
+    # the weights of the collectors are set once on each of their groups, also on the ones that register afterwards
+    server.on_message(('register', 'collectors_a', None))
+    server.on_message(('register', 'tester_0', None))
+    server.on_message(('prefix_weights', 'collectors_', [np.zeros(1)]))
+    server.on_message(('register', 'collectors_b', None))
+    for group, update_count in [('collectors_a', 1), ('collectors_b', 1), ('tester_0', 0)]:
+        assert len(server.get_model(group).weight_updates) == update_count, group
+    server.models, server.new_weights, server.prefix_weights = {}, {}, {}
+
+    server.start()
+    clients = [server.create_client(i, 'collectors', None) for i in range(agent_count)]
+    mp = multiprocessing.get_context('spawn')
+    barrier = mp.Barrier(agent_count + 1)
+    end_times = mp.Queue()
+    processes = [mp.Process(target=run_inference_agent, args=(client, steps, barrier, end_times))
+                 for client in clients]
+    [process.start() for process in processes]
+    barrier.wait()
+    start_time = time.time()
+    elapsed = max(end_times.get() for _ in processes) - start_time
+    [process.join() for process in processes]
+    server.stop()
+    assert all(process.exitcode == 0 for process in processes)
+    model = FixedCostModel()
+    sequential = agent_count * steps * (model.batch_cost + model.frame_cost)
+    print(f'{datetime.now()}: inference: {agent_count} agents predicted {agent_count * steps} frames in '
+          f'{elapsed:.2f}s, {sequential:.2f}s one frame at a time ({sequential / elapsed:.1f}x).')
+
+
+# the default clusterer configs
+clusterer_configs = {'start_clickable_threshold': .9, 'clickable_threshold_speed': 0,
+                     'clickable_threshold_speed_step': 1, 'speed_steps_per_clickable_threshold_reset': 1,
+                     'distance_threshold': 2.99,
+                     'cluster_count_threshold': 4, 'engine': 'components'}
+
+
+# the readouts used to run in tf.py_function, which is still how the clusterer runs
+def check_readouts(repeats: int = 200) -> None:
+    import tensorflow as tf
+
+    import readouts
+    from readouts import better_reward_to_action, worse_reward_to_action, most_certain_reward_to_action, \
+        least_certain_reward_to_action, random_reward_to_action, PredictionClusterer, combine_prediction_to_actions
+
+    tf.disable_v2_behavior()
+    readouts.action_prob_coeffs = [1., .3, .1]
+    clusterer = PredictionClusterer(clusterer_configs)
+    prediction_to_actions = [clusterer, better_reward_to_action, worse_reward_to_action,
+                             most_certain_reward_to_action, least_certain_reward_to_action, random_reward_to_action]
+    preds = np.random.uniform(size=(1, *prediction_shape, 3)).astype(np.float32)
+    preds_input = tf.placeholder(tf.float32, preds.shape)
+    mixed_probs = [.5, .1, .1, .1, .1, .1]
+    with tf.Session() as session:
+        def run_time(action: tf.Tensor) -> float:
+            return time_call(lambda: session.run(action, {preds_input: preds}), repeats)
+
+        for prediction_to_action in prediction_to_actions:
+            name = getattr(prediction_to_action, '__name__', type(prediction_to_action).__name__)
+            graph_action = combine_prediction_to_actions([prediction_to_action], [1])(preds_input)
+            python_action = tf.py_function(prediction_to_action, [preds_input], tf.int32)
+            assert session.run(graph_action, {preds_input: preds}).shape == (1, 3)
+            print(f'{datetime.now()}: readouts: {name} took {run_time(graph_action) * 1000:.2f}ms per step '
+                  f'({run_time(python_action) * 1000:.2f}ms in tf.py_function).')
+        mixed_action = combine_prediction_to_actions(prediction_to_actions, mixed_probs)(preds_input)
+        python_action = tf.py_function(
+            lambda x: np.random.choice(prediction_to_actions, 1, False, mixed_probs)[0](x), [preds_input], tf.int32)
+        print(f'{datetime.now()}: readouts: {mixed_probs} mix took {run_time(mixed_action) * 1000:.2f}ms per step '
+              f'({run_time(python_action) * 1000:.2f}ms in tf.py_function).')
+
+
+# the labels of the clusters in the order their first points appear, so clusterings can be compared
+def canonical_clusters(clusters: np.ndarray) -> np.ndarray:
+    _, first_indices, inverse = np.unique(clusters, return_index=True, return_inverse=True)
+    ranks = np.zeros(len(first_indices), np.int64)
+    ranks[np.argsort(first_indices)] = np.arange(len(first_indices))
+    return ranks[inverse.ravel()]
+
+
+# smoothed noise, so the points above a threshold form blobs of various sizes and gaps
+def create_preds(type_count: int = 1) -> np.ndarray:
+    sigma = np.random.uniform(.5, 2)
+    preds = gaussian_filter(np.random.uniform(size=(*prediction_shape, type_count)), (sigma, sigma, 0))
+    return (preds - preds.min()) / (preds.max() - preds.min())
+
+
+def create_clickables(threshold: float) -> np.ndarray:
+    return np.argwhere(create_preds()[:, :, 0] > threshold).astype(np.int32)
+
+
+def check_clusterer(maps: int = 200, repeats: int = 5) -> None:
+    import readouts
+    from readouts import PredictionClusterer, cluster_connected_components
+
+    clickables = [create_clickables(np.random.uniform(.3, .8)) for _ in range(maps)]
+    for distance_threshold in [1.5, 1.99, 2.99, 4.5]:
+        agglomerative = AgglomerativeClustering(n_clusters=None, distance_threshold=distance_threshold,
+                                                compute_full_tree=True, linkage='single')
+        for points in clickables:
+            if len(points) > 1:
+                expected = canonical_clusters(agglomerative.fit_predict(points))
+                clusters = cluster_connected_components(points, distance_threshold, tuple(prediction_shape))
+                assert np.array_equal(canonical_clusters(clusters), expected)
+    sizes = [len(points) for points in clickables]
+    agglomerative = AgglomerativeClustering(n_clusters=None, distance_threshold=2.99, compute_full_tree=True,
+                                            linkage='single')
+    for name, cluster in [('agglomerative', agglomerative.fit_predict),
+                          ('components', partial(cluster_connected_components, distance_threshold=2.99,
+                                                 grid_shape=tuple(prediction_shape)))]:
+        elapsed = time_call(lambda: [cluster(points) for points in clickables if len(points) > 1], repeats)
+        print(f'{datetime.now()}: clusterer: {name} took {elapsed / maps * 1000:.2f}ms per map of '
+              f'{np.mean(sizes):.0f} points on average (max {np.max(sizes)}).')
+
+    # a whole step of the clusterer, from the predictions of all the types to the action
+    readouts.action_prob_coeffs = [1., .3, .1]
+    all_preds = [np.expand_dims(create_preds(3), axis=0).astype(np.float32) for _ in range(maps)]
+    for engine in ['agglomerative', 'components']:
+        clusterer = PredictionClusterer({**clusterer_configs, 'start_clickable_threshold': .6, 'engine': engine})
+        elapsed = time_call(lambda: [clusterer(preds) for preds in all_preds], repeats)
+        print(f'{datetime.now()}: clusterer: a step with the {engine} engine took {elapsed / maps * 1000:.2f}ms.')
+
+    # without clickable points the clusterer falls back to the numpy twin of better_reward_to_action, with a linear
+    #   normalizer like the configs use
+    readouts.numpy_prediction_normalizer = lambda logits, axis=None: logits / np.sum(logits, axis=axis)
+    clusterer = PredictionClusterer({**clusterer_configs, 'start_clickable_threshold': 1.1})
+    actions = np.concatenate([clusterer(preds) for preds in all_preds])
+    assert actions.dtype == np.int32 and np.all((actions >= 0) & (actions < all_preds[0].shape[1:])), actions
+    assert np.all([preds[0][tuple(action)] > 0 for preds, action in zip(all_preds, actions)])
+
+
+# the frequencies of the sampled indices are compared to the probabilities of tf.distributions.Multinomial
+def check_sampler(batch_size: int = 8, repeats: int = 200, samples: int = 20000) -> None:
+    import tensorflow as tf
+
+    import sampler
+
+    logits = np.array([[.1, .5, 2, 1, 0, .3]], np.float32)
+    probs = np.exp(logits[0]) / np.sum(np.exp(logits[0]))
+    numpy_counts = np.bincount([sampler.sample_numpy(sampler.get_numpy_weights(logits[0])) for _ in range(samples)],
+                               minlength=logits.shape[1])
+    assert np.allclose(numpy_counts / samples, probs, atol=.02), numpy_counts / samples
+    top_counts = np.bincount([sampler.sample_numpy(sampler.get_numpy_weights(logits[0], top_k=2))
+                              for _ in range(samples)], minlength=logits.shape[1])
+    assert set(np.flatnonzero(top_counts)) == {2, 3}
+
+    tf.disable_v2_behavior()
+    logits_input = tf.placeholder(tf.float32, (None, logits.shape[1]))
+    maps = np.random.uniform(size=(batch_size, np.prod(prediction_shape) * 3)).astype(np.float32)
+    maps_input = tf.placeholder(tf.float32, maps.shape)
+    with tf.Session() as session:
+        counts = np.bincount(session.run(sampler.sample(logits_input), {logits_input: np.repeat(logits, samples, 0)}),
+                             minlength=logits.shape[1])
+        assert np.allclose(counts / samples, probs, atol=.02), counts / samples
+        for name, index in [('multinomial', tf.argmax(tf.distributions.Multinomial(1.0, logits=maps_input).sample(),
+                                                      axis=-1)),
+                            ('inverse cdf', sampler.sample(maps_input)),
+                            ('inverse cdf top 100', sampler.sample(maps_input, top_k=100))]:
+            elapsed = time_call(lambda: session.run(index, {maps_input: maps}), repeats)
+            print(f'{datetime.now()}: sampler: {name} took {elapsed * 1000:.2f}ms for {batch_size} maps of '
+                  f'{maps.shape[1]} actions.')
+
+
+# the unet reward predictor (or the distillation student) of the train configs, like main.create_prediction_model
+#   builds it
+def create_prediction_model(configs_path: str = '../configs/train-configs.yaml', student: bool = False,
+                            model_cache_dir: Optional[str] = None) -> Any:
+    import tensorflow.keras as keras
+
+    from predictors import ScreenPreprocessor, SimpleRewardPredictor, UNetRewardPredictor, InitialWeightsCache
+
+    with open(configs_path) as f:
+        cfg = yaml.load(f, Loader=yaml.FullLoader)
+    reward_predictor_type, reward_predictor_configs = (SimpleRewardPredictor,
+                                                       cfg['distillation_configs']['student_configs']) if student \
+        else (UNetRewardPredictor, cfg['unet_reward_predictor_configs'])
+    reward_predictor_configs['prediction_shape'] = cfg['prediction_shape']
+    action_type_count = cfg['environment_configs']['action_type_count']
+    initial_weights_cache = InitialWeightsCache(model_cache_dir, reward_predictor_type.__name__, action_type_count,
+                                                reward_predictor_configs)
+    screen_input = keras.layers.Input((*screen_shape, 3), name='state', dtype=np.uint8)
+    screen_preprocessor = ScreenPreprocessor(cfg['screen_preprocessor_configs'], name='screen_preprocessor')
+    reward_predictor = reward_predictor_type(action_type_count, 2,
+                                             initial_weights_cache.get_configs(reward_predictor_configs),
+                                             name='reward_predictor')
+    model = keras.Model(inputs=screen_input, outputs=reward_predictor(screen_preprocessor(screen_input)))
+    initial_weights_cache.apply(reward_predictor)
+    return model
+
+
+# the predictor reports the accuracy and latency of every export against the float model. the states are smoothed noise,
+#   so the int8 calibration is only indicative
+def check_tflite(state_count: int = 50) -> None:
+    import tensorflow as tf
+
+    from inference import TFLitePredictor
+
+    tf.disable_v2_behavior()
+    model = create_prediction_model()
+    states = [np.uint8(gaussian_filter(np.random.uniform(0, 255, (*screen_shape, 3)), (4, 4, 0)))
+              for _ in range(state_count)]
+    for quantization in ['none', 'dynamic', 'int8']:
+        predictor = TFLitePredictor(model, {'tflite_quantization': quantization, 'tflite_calibration_size': state_count,
+                                            'tflite_report_frequency': 1, 'tflite_report_size': state_count})
+        predictor.states.extend(states)
+        predictor.export()
+
+
+# the student of the train configs is distilled from an untrained unet on smoothed noise, which only shows that the
+#   student can follow the teacher and how much faster it is
+def check_distillation(batch_size: int = 8, steps: int = 50) -> None:
+    import tensorflow as tf
+    import tensorflow.keras as keras
+
+    from distillation import Distiller
+
+    predictions = np.random.uniform(size=(4, *prediction_shape, 3))
+    assert Distiller.get_agreement(predictions, predictions, 10) == 1
+    assert Distiller.get_agreement(predictions, -predictions, 10) == 0
+
+    tf.disable_v2_behavior()
+    teacher = create_prediction_model()
+    student = create_prediction_model(student=True)
+    student.compile('adam', keras.losses.BinaryCrossentropy())
+
+    def generator():
+        while True:
+            yield {'state': np.uint8(gaussian_filter(np.random.uniform(0, 255, (batch_size, *screen_shape, 3)),
+                                                     (0, 4, 4, 0)))}, None
+
+    distiller = Distiller(teacher, student, (teacher, student), {'steps': steps, 'top_k': 10, 'evaluation_steps': 5,
+                                                                 'latency_repeats': 20, 'save_dir': None})
+    distiller.distill(generator(), 0)
+
+
+# each worker runs the student of the train configs on single frames, like a collector, for a fixed duration after all
+#   the workers are ready
+def run_resource_worker(resource_plan: Optional[Any], duration: float, barrier: Any, steps: Any) -> None:
+    import tensorflow as tf
+
+    tf.disable_v2_behavior()
+    if resource_plan is not None:
+        resource_plan.apply()
+    model = create_prediction_model(student=True)
+    state = np.zeros((1, *screen_shape, 3), np.uint8)
+    model.predict_on_batch(state)
+    barrier.wait()
+    step_count = 0
+    start_time = time.time()
+    while time.time() - start_time < duration:
+        model.predict_on_batch(state)
+        step_count += 1
+    steps.put(step_count)
+
+
+# the aggregate steps per second of the workers with the default thread pools (every process sized to all of the
+#   cores) and with the resource plans of each setting. the learner cores are left idle
+def check_resources(worker_count: int = 8, duration: float = 10) -> None:
+    from resources import ResourcePlanner
+
+    mp = multiprocessing.get_context('spawn')
+    settings = [('default', None)] + \
+               [(f'planned with learner share {learner_share} and {inter_op_threads} inter op threads',
+                 ResourcePlanner(worker_count, {'learner_share': learner_share, 'inter_op_threads': inter_op_threads,
+                                                'cores': None}).plan()[1])
+                for learner_share in [0, .25] for inter_op_threads in [1, 2]]
+    for name, resource_plans in settings:
+        barrier = mp.Barrier(worker_count)
+        steps = mp.Queue()
+        processes = [mp.Process(target=run_resource_worker,
+                                args=(None if resource_plans is None else resource_plans[i], duration, barrier, steps))
+                     for i in range(worker_count)]
+        [process.start() for process in processes]
+        total_steps = sum(steps.get() for _ in processes)
+        [process.join() for process in processes]
+        print(f'{datetime.now()}: resources: {worker_count} workers made {total_steps / duration:.1f} steps/s '
+              f'with the {name} resources.')
+
+
+def run_startup_worker(model_cache_dir: Optional[str], elapsed_times: Any) -> None:
+    import tensorflow as tf
+
+    tf.disable_v2_behavior()
+    start_time = time.time()
+    model = create_prediction_model(model_cache_dir=model_cache_dir)
+    model.predict_on_batch(np.zeros((1, *screen_shape, 3), np.uint8))
+    elapsed_times.put(time.time() - start_time)
+
+
+# the import time of the modules that every process imports through main, each in a fresh interpreter, and the time a
+#   fresh process takes to build the unet and predict once without the initial weights cache, when it fills the cache,
+#   and when it loads from it
+def check_startup(repeats: int = 3) -> None:
+    for module in ['readouts', 'phone', 'relevant_action_monkey_client', 'predictors', 'main']:
+        if module == 'main' and not os.path.exists('configs.yaml'):
+            continue
+        elapsed = min(float(subprocess.check_output(
+            [sys.executable, '-c', f'import time; start_time = time.time(); import {module}; '
+                                   f'print(time.time() - start_time)']).decode().split()[-1]) for _ in range(repeats))
+        print(f'{datetime.now()}: startup: importing {module} took {elapsed:.2f}s.')
+
+    mp = multiprocessing.get_context('spawn')
+    model_cache_dir = tempfile.mkdtemp()
+    for name, cache_dir in [('without the cache', None), ('filling the cache', model_cache_dir),
+                            ('from the cache', model_cache_dir)]:
+        elapsed_times = mp.Queue()
+        process = mp.Process(target=run_startup_worker, args=(cache_dir, elapsed_times))
+        process.start()
+        elapsed = elapsed_times.get()
+        process.join()
+        print(f'{datetime.now()}: startup: building the unet {name} took {elapsed:.2f}s.')
+
+
+# the frames are revisited with a different status bar, which is outside of the crop, so they are still hits. after the
+#   weights change the same frames are misses again
+def check_prediction_cache(frame_count: int = 20, steps: int = 1000) -> None:
+    from inference import PredictionCache
+
+    cache = PredictionCache({'prediction_cache_size': frame_count, 'prediction_cache_stats_frequency': steps,
+                             'crop_top_left': crop_top_left, 'crop_size': crop_size})
+    frames = [np.random.randint(0, 256, (*screen_shape, 3), dtype=np.uint8) for _ in range(frame_count)]
+    predict_calls = []
+
+    def predict(state: np.ndarray) -> np.ndarray:
+        predict_calls.append(state)
+        return np.full(prediction_shape, len(predict_calls), np.float32)
+
+    for step in range(steps):
+        frame = frames[np.random.randint(frame_count)].copy()
+        frame[:crop_top_left[0]] = step % 256
+        cache.predict(frame, predict, 'app')
+    assert len(predict_calls) <= frame_count, len(predict_calls)
+    cache.invalidate()
+    assert cache.predict(frames[0], predict, 'app')[0, 0] == len(predict_calls)
+    elapsed = time_call(lambda: cache.get_key(frames[0]), 200)
+    print(f'{datetime.now()}: prediction cache: a lookup took {elapsed * 1000:.2f}ms.')
+
+
+# most actions do not change the screen, so the slow predictor only runs on the changes, and the actions tried on an
+#   unchanged screen are down-weighted
+def check_prediction_cascade(steps: int = 200, change_probability: float = .2, latency: float = .005) -> None:
+    from inference import PredictionCascade
+
+    cascade = PredictionCascade(lambda s1, s2: np.array_equal(s1, s2),
+                                {'cascade_decay': .5, 'cascade_stats_frequency': steps})
+    state = np.zeros((*screen_shape, 3), np.uint8)
+    predict_calls = []
+
+    def predict(state: np.ndarray) -> np.ndarray:
+        time.sleep(latency)
+        predict_calls.append(state)
+        return np.ones((*prediction_shape, 3), np.float32)
+
+    start_time = time.time()
+    for step in range(steps):
+        if np.random.uniform() < change_probability:
+            state = np.full_like(state, step % 256)
+        cascade.predict(state, predict)
+        cascade.on_action(np.array([step % prediction_shape[0], 0, 0]))
+    elapsed = time.time() - start_time
+    assert len(predict_calls) + cascade.skipped == steps
+
+    cascade.reset()
+    cascade.predict(state, predict)
+    cascade.on_action(np.array([1, 2, 0]))
+    cascade.on_action(np.array([1, 2, 0]))
+    prediction = cascade.predict(state, predict)
+    assert prediction[1, 2, 0] == .25 and np.sum(prediction != 1) == 1, prediction[1, 2]
+    print(f'{datetime.now()}: prediction cascade: {steps} steps took {elapsed:.2f}s instead of '
+          f'{elapsed + cascade.get_saved_time():.2f}s.')
+
+
+# the numpy twin of the screen preprocessor is compared to the layer for each of the preprocessing options
+def check_preprocessor(batch_size: int = 32, repeats: int = 20) -> None:
+    import tensorflow as tf
+
+    from predictors import ScreenPreprocessor
+
+    tf.disable_v2_behavior()
+    screens = np.uint8(gaussian_filter(np.random.uniform(0, 255, (batch_size, *screen_shape, 3)), (0, 4, 4, 0)))
+    screens[:batch_size // 2] = 255 - screens[:batch_size // 2]
+    screens_input = tf.placeholder(tf.uint8, screens.shape)
+    base_configs = {'crop_top_left': crop_top_left, 'crop_size': crop_size, 'resize_size': [224, 224],
+                    'grayscale': False, 'scale_color': False, 'equalize_background': False, 'contrast_alpha': -1}
+    options = [{}, {'resize_size': [112, 112]}, {'grayscale': True, 'resize_size': [150, 100]},
+               {'grayscale': True, 'scale_color': True},
+               {'grayscale': True, 'scale_color': True, 'equalize_background': True, 'contrast_alpha': 10}]
+    with tf.Session() as session:
+        for option in options:
+            preprocessor = ScreenPreprocessor({**base_configs, **option})
+            output = preprocessor(screens_input)
+            expected = session.run(output, {screens_input: screens})
+            actual = preprocessor.preprocess_numpy(screens)
+            assert actual.shape == expected.shape, (actual.shape, expected.shape)
+            error = np.max(np.abs(actual - expected))
+            assert error < 1e-3, (option, error)
+            elapsed = time_call(lambda: session.run(output, {screens_input: screens}), repeats)
+            numpy_elapsed = time_call(lambda: preprocessor.preprocess_numpy(screens), repeats)
+            print(f'{datetime.now()}: preprocessor: {option} took {elapsed * 1000:.2f}ms in the graph and '
+                  f'{numpy_elapsed * 1000:.2f}ms in numpy for {batch_size} screens (max error {error:.1e}).')
+
+
+# every reward class is sampled to the same size from its own positions (augmented classes contain each of their
+#   positions equally often), and weighted positions are sampled in proportion to their weights. a class without weight
+#   is left out
+def check_balanced_sampler(samples: int = 30000, position_count: int = 1000000) -> None:
+    rewards = np.repeat([0, 1, 2], [50, 20, 5])
+    file_ids, rows = np.divmod(np.arange(len(rewards)), 10)
+    for augmenting_correction, class_size in [(True, 50), (False, 5)]:
+        balanced_sampler = BalancedSampler(file_ids, rows, rewards, True, augmenting_correction, True)
+        sampled_file_ids, sampled_rows = balanced_sampler.sample()
+        positions = sampled_file_ids * 10 + sampled_rows
+        assert balanced_sampler.get_size() == len(positions) == class_size * 3
+        assert np.array_equal(np.bincount(rewards[positions]), [class_size] * 3)
+        counts = np.bincount(positions, minlength=len(rewards))
+        if augmenting_correction:
+            assert np.all(counts[rewards == 2] == 10) and np.all(counts[rewards == 0] == 1)
+        else:
+            assert np.max(counts) == 1
+    sampled_file_ids, sampled_rows = BalancedSampler(file_ids, rows, rewards, False, False, True).sample()
+    assert np.array_equal(np.sort(sampled_file_ids * 10 + sampled_rows), np.arange(len(rewards)))
+
+    weights = np.where(np.arange(len(rewards)) % 2 == 0, 1., 3.)
+    weights[rewards == 1] = np.arange(20) % 2
+    sampled_file_ids, sampled_rows = BalancedSampler(file_ids, rows, rewards, True, True, False, weights,
+                                                     samples).sample()
+    positions = sampled_file_ids * 10 + sampled_rows
+    assert np.allclose(np.bincount(rewards[positions]) / len(positions), 1 / 3, atol=.01)
+    assert np.all(weights[positions] > 0)
+    class_0 = positions[rewards[positions] == 0]
+    assert np.isclose(np.mean(class_0 % 2 == 1), .75, atol=.02), np.mean(class_0 % 2 == 1)
+    weights[rewards == 2] = 0
+    balanced_sampler = BalancedSampler(file_ids, rows, rewards, True, True, False, weights, samples)
+    sampled_file_ids, sampled_rows = balanced_sampler.sample()
+    assert set(rewards[sampled_file_ids * 10 + sampled_rows]) == {0, 1} and balanced_sampler.get_size() >= samples
+
+    rewards = np.random.randint(0, 2, position_count)
+    file_ids, rows = np.divmod(np.arange(position_count), 1000)
+    elapsed = time_call(BalancedSampler(file_ids, rows, rewards, True, True, True).sample, 5)
+    print(f'{datetime.now()}: balanced sampler: sampling {position_count} positions took {elapsed * 1000:.1f}ms.')
+
+
+# a reader sees every record as soon as it is written, starting from an empty shard, and compaction rewrites closed
+#   shards without their partially written records and leaves the shards that are still being written
+def check_shards(record_count: int = 200) -> None:
+    from single_state_categorical_reward import Episode, EpisodeFile, EpisodeShard, compact_shards
+    from utils import load_obj
+
+    directory = tempfile.mkdtemp()
+    os.makedirs(f'{directory}/0')
+    file_name = f'{directory}/0/0'
+    state = np.zeros((*screen_shape, 3), np.uint8)
+    example = Episode(state, np.zeros(3, np.int32), np.zeros((), np.uint8), state)
+    writer = EpisodeShard(file_name, example, 'w')
+    reader = EpisodeShard(file_name, example, 'r')
+    assert reader.size == 0 and len(reader.read_states(0, 1)) == 0
+    episodes = [Episode(np.full_like(state, i), np.array([i, i, i % 3], np.int32), np.array(i % 2, np.uint8),
+                        np.full_like(state, i + 1)) for i in range(record_count)]
+    start_time = time.time()
+    for i, episode in enumerate(episodes):
+        writer.set(episode, i)
+        assert reader.get(i).action[0] == i
+    elapsed = time.time() - start_time
+    try:
+        reader.get(record_count)
+        assert False
+    except IndexError:
+        pass
+
+    compact_shards(directory, 0)
+    assert os.path.exists(file_name + '.shard') and not os.path.exists(file_name + '.meta')
+    writer.close()
+    with open(file_name + '.shard', 'ab') as f:
+        f.write(b'partial')
+    compact_shards(directory, 0)
+    assert not os.path.exists(file_name + '.shard')
+    meta = load_obj(file_name + '.meta')
+    assert meta['size'] == record_count
+    assert np.array_equal(meta['reward_indices'][1], np.arange(1, record_count, 2))
+    episode_file = EpisodeFile(file_name, meta['max_size'], meta['example'], 'r')
+    for i, episode in enumerate(episodes):
+        compacted = episode_file.get(i)
+        assert np.array_equal(compacted.state, episode.state) and np.array_equal(compacted.result, episode.result)
+        assert np.array_equal(compacted.action, episode.action) and compacted.reward == episode.reward
+    episode_file.close()
+    print(f'{datetime.now()}: shards: writing and reading back a record took {elapsed / record_count * 1000:.2f}ms.')
+
+
+# the files of the catalog are numpy arrays of rewards with the action types as their negatives. only the files that
+#   changed since they were cataloged are read again
+def check_catalog(version_count: int = 10, file_count: int = 20, file_size: int = 1000) -> None:
+    directory = tempfile.mkdtemp()
+    read_files = []
+
+    def read_record(file_name: str) -> Any:
+        read_files.append(file_name)
+        rewards = np.load(file_name + '.rewards.npy')
+        return len(rewards), len(rewards), None, rewards, -rewards
+
+    def write_file(version: int, i: int, size: int) -> np.ndarray:
+        rewards = np.random.randint(0, 2, size)
+        np.save(f'{directory}/{version}/{i:02d}.rewards.npy', rewards)
+        return rewards
+
+    all_rewards = {}
+    for version in range(version_count):
+        os.makedirs(f'{directory}/{version}')
+        for i in range(file_count):
+            all_rewards[version, i] = write_file(version, i, file_size)
+    catalog = EpisodeCatalog(directory, {'rewards': ('.rewards.npy', read_record)})
+
+    def check_query(versions: list) -> float:
+        start_time = time.time()
+        entries, positions = catalog.query(versions)
+        elapsed = time.time() - start_time
+        keys = [(version, i) for version in versions for i in range(file_count)]
+        assert [path for path, _, _, _, _ in entries] == [f'{directory}/{version}/{i:02d}' for version, i in keys]
+        assert np.array_equal(positions['reward'], np.concatenate([all_rewards[key] for key in keys]))
+        assert np.array_equal(positions['action_type'], -positions['reward'])
+        assert np.array_equal(positions['row'], np.concatenate([np.arange(len(all_rewards[key])) for key in keys]))
+        return elapsed
+
+    versions = list(range(version_count))
+    first_elapsed = check_query(versions)
+    assert len(read_files) == version_count * file_count
+    read_files.clear()
+    cached_elapsed = check_query(versions)
+    assert len(read_files) == 0
+    all_rewards[0, 0] = write_file(0, 0, file_size // 2)
+    check_query(versions)
+    assert read_files == [f'{directory}/0/00']
+    os.remove(f'{directory}/0/{file_count - 1:02d}.rewards.npy')
+    entries, positions = catalog.query([0])
+    assert len(entries) == file_count - 1 and len(positions) == file_size // 2 + (file_count - 2) * file_size
+    catalog.close()
+    print(f'{datetime.now()}: catalog: querying {version_count * file_count} files took {first_elapsed * 1000:.1f}ms '
+          f'when cataloging them and {cached_elapsed * 1000:.1f}ms from the catalog.')
+
+
+# the values of every weight of a version are its version number, so a torn read mixes numbers
+def run_weight_store_reader(path: str, specs: list, version_count: int, barrier: Any, read_counts: Any) -> None:
+    weight_store = SharedWeightStore(path)
+    barrier.wait()
+    version = 0
+    read_count = 0
+    while version < version_count:
+        result = weight_store.read(specs, version)
+        if result is None:
+            continue
+        version, weights = result
+        assert all(np.all(weight == weights[0].flat[0]) for weight in weights), version
+        assert weights[0].flat[0] <= version
+        read_count += 1
+    read_counts.put(read_count)
+
+
+# a reader process reads while the weights are published. the sequence counter makes it retry instead of returning a
+#   version that was being overwritten. weights of another size resize the file without resetting the version
+def check_weight_store(version_count: int = 200, weight_size: int = 1 << 20) -> None:
+    path = f'{tempfile.mkdtemp()}/weights'
+    example_weights = [np.zeros(weight_size, np.float32), np.zeros((10, 10), np.int64), np.zeros(3, np.uint8)]
+    specs = SharedWeightStore.get_specs(example_weights)
+    weight_store = SharedWeightStore(path)
+    assert weight_store.get_version() == -1
+    assert weight_store.publish([np.full_like(weight, 1) for weight in example_weights]) == 1
+    assert weight_store.read(specs, 1) is None
+    try:
+        weight_store.read(specs[:1], 0)
+        assert False
+    except ValueError:
+        pass
+
+    mp = multiprocessing.get_context('spawn')
+    barrier = mp.Barrier(2)
+    read_counts = mp.Queue()
+    process = mp.Process(target=run_weight_store_reader,
+                         args=(path, specs, version_count, barrier, read_counts))
+    process.start()
+    barrier.wait()
+    start_time = time.time()
+    for version in range(2, version_count + 1):
+        assert weight_store.publish([np.full_like(weight, version) for weight in example_weights]) == version
+    elapsed = time.time() - start_time
+    read_count = read_counts.get()
+    process.join()
+    assert process.exitcode == 0
+
+    reader = SharedWeightStore(path)
+    assert reader.read(specs)[0] == version_count
+    resized_weights = [np.full(10, 7, np.float32)]
+    assert weight_store.publish(resized_weights) == version_count + 1
+    version, weights = reader.read(SharedWeightStore.get_specs(resized_weights), version_count)
+    assert version == version_count + 1 and np.array_equal(weights[0], resized_weights[0])
+    print(f'{datetime.now()}: weight store: published {version_count - 1} versions of {weight_size * 4 >> 20}MB in '
+          f'{elapsed:.2f}s while a reader read {read_count} of them.')
+
+
+def record_dispatch(coordinator: Any, name: str) -> None:
+    coordinator.ran.append((name, time.time()))
+
+
+# the dispatcher of the coordinator sleeps on the learner queue. a message sent while it waits is run right away,
+#   everything that is ready is run in one wake-up with the control messages first, and it returns after the timeout
+#   when nothing arrives
+def check_dispatcher(dispatch_timeout: float = 2, delay: float = .2) -> None:
+    from single_state_categorical_reward import Coordinator
+
+    learner_thread = LocalThread(None, None, cfg={'queue_size': 0, 'channels': channels}, main_thread=True)
+    coordinator = SimpleNamespace(learner_thread=learner_thread, dispatch_timeout=dispatch_timeout,
+                                  dispatch_stats_frequency=3600, dispatch_stats=QueueStats(), ran=[],
+                                  can_learn_from_replay_buffer=lambda: False)
+    coordinator.run_items = partial(Coordinator.run_items, coordinator)
+
+    sent_times = []
+
+    def send():
+        time.sleep(delay)
+        sent_times.append(time.time())
+        learner_thread.add_to_run_queue(record_dispatch, 'delayed')
+
+    sender = threading.Thread(target=send)
+    sender.start()
+    Coordinator.dispatch(coordinator)
+    sender.join()
+    assert [name for name, _ in coordinator.ran] == ['delayed']
+    wake_latency = coordinator.ran[0][1] - sent_times[0]
+    assert wake_latency < dispatch_timeout / 2, wake_latency
+
+    coordinator.ran.clear()
+    for i in range(3):
+        learner_thread.add_to_run_queue(record_dispatch, f'data {i}')
+    learner_thread.add_to_run_queue(record_dispatch, 'control', channel='control')
+    Coordinator.dispatch(coordinator)
+    assert [name for name, _ in coordinator.ran] == ['control', 'data 0', 'data 1', 'data 2']
+    assert coordinator.dispatch_stats.wakeups == 2 and coordinator.dispatch_stats.dispatched == 5
+
+    coordinator.ran.clear()
+    start_time = time.time()
+    Coordinator.dispatch(coordinator)
+    idle_elapsed = time.time() - start_time
+    assert len(coordinator.ran) == 0 and idle_elapsed >= dispatch_timeout * .9, idle_elapsed
+    print(f'{datetime.now()}: dispatcher: woke up {wake_latency * 1000:.2f}ms after a message was sent.')
+
+
+# on every kind of queue thread a control message is received past the data messages ahead of it, which stay buffered
+#   in order until the data channel is received from. the control messages that are not taken stay buffered too
+def check_channels(message_count: int = 10000) -> None:
+    cfg = {'type': 'spawn', 'queue_size': 0, 'channels': channels}
+    threads = [('thread', LocalThread(None, None, cfg=cfg, main_thread=True)),
+               ('process', Process(None, None, cfg=cfg, main_process=True))]
+    for name, thread in threads:
+        try:
+            thread.add_to_run_queue(record_message, 'learner', 0, channel='unknown')
+            assert False
+        except ValueError:
+            pass
+        for i in range(message_count):
+            thread.add_to_run_queue(record_message, 'data', i)
+        thread.add_to_run_queue(record_message, 'control', 0, channel='control')
+        start_time = time.time()
+        items = []
+        while len(items) == 0:
+            items = thread.pop_ready(1, channels=['control'])
+        elapsed = time.time() - start_time
+        assert [args for _, args, _ in items] == [('control', 0)]
+        assert thread.pop_ready(0, channels=['control']) == []
+
+        items = []
+        while len(items) < message_count:
+            items += thread.pop_ready(1)
+        assert [args for _, args, _ in items] == [('data', i) for i in range(message_count)]
+
+        thread.add_to_run_queue(record_message, 'data', 0)
+        thread.add_to_run_queue(record_message, 'control', 0, channel='control')
+        time.sleep(.1)
+        assert [thread.pop_next(wait=True)[1] for _ in range(2)] == [('control', 0), ('data', 0)]
+
+        for i in range(4):
+            thread.add_to_run_queue(record_message, 'control', i, channel='control')
+        time.sleep(.1)
+        assert [args for _, args, _ in thread.pop_matching('control', lambda item: item[1][1] % 2 == 1)] == \
+               [('control', 1), ('control', 3)]
+        assert [args for _, args, _ in thread.pop_ready(0)] == [('control', 0), ('control', 2)]
+
+        # a tester's reset on the control channel does not overtake its learning request on the data channel
+        thread.set_order_key(get_message_tester)
+        thread.add_to_run_queue(record_message, 'tester 1', 0)
+        thread.add_to_run_queue(record_message, 'data', 0)
+        thread.add_to_run_queue(record_message, 'tester 1', 1, channel='control')
+        thread.add_to_run_queue(record_message, 'tester 2', 0, channel='control')
+        time.sleep(.1)
+        assert [args for _, args, _ in thread.pop_matching('control', lambda item: True)] == [('tester 2', 0)]
+        assert [args for _, args, _ in thread.pop_ready(0)] == [('tester 1', 0), ('tester 1', 1), ('data', 0)]
+        for i in range(3):
+            thread.add_to_run_queue(record_message, 'tester 1', i, channel='data' if i < 2 else 'control')
+        time.sleep(.1)
+        assert [thread.pop_next()[1] for _ in range(3)] == [('tester 1', 0), ('tester 1', 1), ('tester 1', 2)]
+        thread.set_order_key(None)
+
+        for i in range(100):
+            thread.add_to_run_queue(record_message, 'data', i)
+        time.sleep(.1)
+        assert thread.pop_matching('control', lambda item: True, 10) == [] and len(thread.buffers) == 10
+        assert len(thread.pop_ready(0)) == 100
+        print(f'{datetime.now()}: channels: the {name} received a control message behind {message_count} data messages '
+              f'in {elapsed * 1000:.1f}ms.')
+
+
+# the cache is loaded while the meta file of its episode file keeps its signature, even if the states were changed in
+#   place, and rebuilt once the episode file is rewritten or has grown
+def check_preprocessed_cache(size: int = 100) -> None:
+    from single_state_categorical_reward import Episode, EpisodeFile
+    from utils import dump_obj
+
+    file_name = f'{tempfile.mkdtemp()}/0'
+    state = np.zeros((*screen_shape, 3), np.uint8)
+    example = Episode(state, np.zeros(3, np.int32), np.zeros((), np.uint8), state)
+    EpisodeFile(file_name, size, example, 'w+').close()
+    meta_times = [time.time()]
+
+    def write_states(value: int, file_size: int) -> None:
+        episode_file = EpisodeFile(file_name, size, example, 'r+')
+        for i in range(file_size):
+            episode_file.set(Episode(np.full_like(state, value), example.action, example.reward, state), i)
+        episode_file.flush()
+        episode_file.close()
+
+    # the meta file is moved a second forward on every write, so its signature changes even on coarse file systems
+    def write_meta(file_size: int) -> None:
+        dump_obj({'size': file_size, 'max_size': size, 'example': example}, file_name + '.meta')
+        meta_times.append(meta_times[-1] + 1)
+        os.utime(file_name + '.meta', (meta_times[-1], meta_times[-1]))
+
+    cfg = {'grayscale': True, 'crop_top_left': [0, 0], 'crop_size': [56, 56], 'resize_size': [56, 56],
+           'scale_color': False, 'equalize_background': False, 'contrast_alpha': 0}
+    cache = PreprocessedCache(lambda states: states[:, :56, :56, :1].astype(np.float32), 'uint8', 16, cfg)
+
+    def get_cache(file_size: int) -> np.ndarray:
+        episode_file = EpisodeFile(file_name, size, example, 'r')
+        values = np.array(cache.get(episode_file, file_size))
+        episode_file.close()
+        return values
+
+    write_states(1, size // 2)
+    write_meta(size // 2)
+    start_time = time.time()
+    values = get_cache(size // 2)
+    build_elapsed = time.time() - start_time
+    assert values.shape == (size // 2, 56, 56, 1) and np.all(values == 1)
+    write_states(2, size // 2)
+    start_time = time.time()
+    assert np.all(get_cache(size // 2) == 1)
+    load_elapsed = time.time() - start_time
+    write_meta(size // 2)
+    assert np.all(get_cache(size // 2) == 2)
+    write_states(3, size)
+    write_meta(size)
+    values = get_cache(size)
+    assert len(values) == size and np.all(values == 3)
+    print(f'{datetime.now()}: preprocessed cache: building the cache of {size // 2} states took '
+          f'{build_elapsed * 1000:.1f}ms and loading it {load_elapsed * 1000:.1f}ms.')
+
+class EpisodeCountController(EnvironmentController):
+    def __init__(self, episodes: int):
+        self.episodes = episodes
+
+    def should_start_episode(self) -> bool:
+        self.episodes -= 1
+        return self.episodes >= 0
+
+    def get_next_action(self, state: np.ndarray) -> Any:
+        return 0
+
+
+# each action sleeps, like a phone waiting for its screen, and the coordinator counts the environments that act at once
+class SleepingEnvironment(Environment):
+    def __init__(self, steps: int, step_time: float, coordinator: Any):
+        super().__init__(EpisodeCountController(1))
+        self.steps = steps
+        self.step_time = step_time
+        self.coordinator = coordinator
+        self.step = 0
+
+    def restart(self) -> None:
+        self.step = 0
+
+    def read_state(self) -> np.ndarray:
+        return np.zeros(1)
+
+    def is_finished(self) -> bool:
+        return self.step >= self.steps
+
+    def act(self, action: Any, wait_action: Callable) -> float:
+        wait_action()
+        assert self.coordinator.thread_locals.locals.collector is self
+        with self.coordinator.lock:
+            self.coordinator.active += 1
+            self.coordinator.max_active = max(self.coordinator.max_active, self.coordinator.active)
+        time.sleep(self.step_time)
+        with self.coordinator.lock:
+            self.coordinator.active -= 1
+        self.step += 1
+        return 0
+
+
+# the workers of the asyncio backend step their environments from one event loop, at most blocking_threads at once, and
+#   every step sees the locals of its own worker, whichever executor thread runs it
+def check_asyncio_workers(worker_count: int = 8, blocking_threads: int = 2, steps: int = 10,
+                          step_time: float = .02) -> None:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    import tensorflow as tf
+    import tensorflow.keras as keras
+
+    from single_state_categorical_reward import AsyncioCoordinator
+
+    coordinator = SimpleNamespace(loop=asyncio.new_event_loop(), executor=ThreadPoolExecutor(blocking_threads),
+                                  thread_locals=threading.local(), graph=tf.get_default_graph(),
+                                  session=keras.backend.get_session(), lock=threading.Lock(), active=0, max_active=0,
+                                  run_step=AsyncioCoordinator.run_step)
+    for name in ['run_with_locals', 'run_blocking', 'run_worker']:
+        setattr(coordinator, name, partial(getattr(AsyncioCoordinator, name), coordinator))
+
+    # the environment stands in for the collector creator
+    def setup_collector(environment: SleepingEnvironment, thread: Any) -> Any:
+        coordinator.thread_locals.locals.collector = environment
+        return SimpleNamespace(run_steps=environment.run_steps)
+
+    coordinator.setup_collector = setup_collector
+    loop_thread = threading.Thread(target=coordinator.loop.run_forever, daemon=True)
+    loop_thread.start()
+    environments = [SleepingEnvironment(steps, step_time, coordinator) for _ in range(worker_count)]
+    tasks = [EventLoopTask(coordinator.loop, coordinator.run_worker, environment,
+                           cfg={'queue_size': 0, 'channels': channels}) for environment in environments]
+    start_time = time.time()
+    [task.run() for task in tasks]
+    [task.future.result() for task in tasks]
+    elapsed = time.time() - start_time
+    coordinator.loop.call_soon_threadsafe(coordinator.loop.stop)
+    loop_thread.join()
+    coordinator.loop.close()
+    coordinator.executor.shutdown()
+    assert all(environment.step == steps for environment in environments)
+    assert coordinator.max_active == blocking_threads, coordinator.max_active
+    assert elapsed >= worker_count * steps * step_time / blocking_threads
+    print(f'{datetime.now()}: asyncio workers: {worker_count} workers took {elapsed:.2f}s for {steps} steps of '
+          f'{step_time * 1000:.0f}ms each with {blocking_threads} blocking threads.')
+
+
+checks = {'network': check_network, 'distortions': check_distortions, 'inference': check_inference,
+          'readouts': check_readouts, 'clusterer': check_clusterer, 'sampler': check_sampler,
+          'tflite': check_tflite, 'distillation': check_distillation, 'prediction_cache': check_prediction_cache,
+          'prediction_cascade': check_prediction_cascade, 'preprocessor': check_preprocessor,
+          'resources': check_resources, 'startup': check_startup, 'balanced_sampler': check_balanced_sampler,
+          'shards': check_shards, 'catalog': check_catalog, 'weight_store': check_weight_store,
+          'dispatcher': check_dispatcher, 'channels': check_channels, 'preprocessed_cache': check_preprocessed_cache,
+          'asyncio_workers': check_asyncio_workers}
+
+if __name__ == '__main__':
+    for check_name in sys.argv[1:] or list(checks):
+        checks[check_name]()
@@ -0,0 +1,16 @@
+import glob
+import os
+import sys
+
+from single_state_categorical_reward import compact_shards
+
+# shards that are still being written are skipped, so they can be compacted by a later run
+data_files_dir = sys.argv[1]
+versions = sys.argv[2:]
+
+if len(versions) == 0:
+    versions = sorted({os.path.basename(os.path.dirname(shard_file))
+                       for shard_file in glob.glob(f'{data_files_dir}/*/*.shard')}, key=int)
+for version in versions:
+    print(f'compacting version {version}')
+    compact_shards(data_files_dir, version)
@@ -0,0 +1,63 @@
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Tuple, Union
+
+import numpy as np
+import tensorflow.keras as keras
+
+from utils import Config
+
+
+# trains a small student to match the prediction maps of the teacher (the reward predictor of the learner) on the stored
+#   states, so that the collectors can run the student instead. after each distillation, the agreement of the two (the
+#   mean overlap of their top_k actions on the next batches) and the per frame latency of each on the cpu are reported
+class Distiller:
+    def __init__(self, teacher: keras.Model, student: keras.Model, latency_models: Tuple[keras.Model, keras.Model],
+                 cfg: Config):
+        self.steps = cfg['steps']
+        self.top_k = cfg['top_k']
+        self.evaluation_steps = cfg['evaluation_steps']
+        self.latency_repeats = cfg['latency_repeats']
+        self.save_dir = cfg['save_dir']
+
+        self.teacher = teacher
+        self.student = student
+        self.latency_models = latency_models
+
+    def get_weights(self) -> List[np.ndarray]:
+        return self.student.get_weights()
+
+    @staticmethod
+    def get_agreement(teacher_predictions: np.ndarray, student_predictions: np.ndarray, top_k: int) -> float:
+        teacher_predictions = teacher_predictions.reshape((len(teacher_predictions), -1))
+        student_predictions = student_predictions.reshape((len(student_predictions), -1))
+        teacher_top = np.argpartition(teacher_predictions, -top_k, axis=1)[:, -top_k:]
+        student_top = np.argpartition(student_predictions, -top_k, axis=1)[:, -top_k:]
+        return float(np.mean([len(np.intersect1d(teacher_actions, student_actions)) / top_k
+                              for teacher_actions, student_actions in zip(teacher_top, student_top)]))
+
+    def get_latency(self, model: keras.Model, state: np.ndarray) -> float:
+        model.predict_on_batch(state)
+        start_time = time.time()
+        for _ in range(self.latency_repeats):
+            model.predict_on_batch(state)
+        return (time.time() - start_time) / self.latency_repeats
+
+    def distill(self, data: Iterator[Tuple[Dict[str, np.ndarray], Any]], version: Union[int, List[int]]) -> None:
+        losses = []
+        for _ in range(self.steps):
+            x, _ = next(data)
+            losses.append(self.student.train_on_batch(x['state'], self.teacher.predict_on_batch(x['state'])))
+        agreements = []
+        for _ in range(self.evaluation_steps):
+            x, _ = next(data)
+            agreements.append(self.get_agreement(self.teacher.predict_on_batch(x['state']),
+                                                 self.student.predict_on_batch(x['state']), self.top_k))
+        latency_state = next(data)[0]['state'][:1]
+        teacher_latency, student_latency = [self.get_latency(model, latency_state) for model in self.latency_models]
+        print(f'{datetime.now()}: distilled version {version} in {self.steps} steps with loss {np.mean(losses):.4f}, '
+              f'top {self.top_k} agreement {np.mean(agreements) * 100:.1f}%, cpu latency per frame '
+              f'{teacher_latency * 1000:.1f}ms for the teacher and {student_latency * 1000:.1f}ms for the student.')
+        if self.save_dir is not None:
+            self.student.save_weights(f'{self.save_dir}/student-{version[-1] if isinstance(version, list) else version}'
+                                      f'.hdf5')
@@ -0,0 +1,191 @@
+import random
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+from single_state_categorical_reward import Episode
+
+
+def get_mask(transformed_shape: np.ndarray, mask_top_left: np.ndarray, mask_bottom_right: np.ndarray,
+             transform_coord: Callable) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    top_left = transform_coord(mask_top_left)
+    bottom_right = transform_coord(mask_bottom_right)
+    tl_diff = np.maximum(0, top_left) - top_left
+    br_diff = bottom_right - np.minimum(transformed_shape - 1, bottom_right)
+    return top_left, bottom_right, tl_diff, br_diff
+
+
+def distort_episode_shift(episode: Episode, mask_shape: tuple, shift_max_value: np.ndarray,
+                          action_pos_to_screen_pos: Callable, screen_pos_to_action_pos: Callable) \
+        -> Tuple[Episode, np.ndarray, np.ndarray]:
+    mask_shape = np.array(mask_shape)
+    state_img_shape = np.array(episode.state.shape[:2])
+    state2 = np.zeros(episode.state.shape, episode.state.dtype)
+    shift_neg_max = np.maximum(-episode.action[:2], -shift_max_value)
+    shift_pos_max = np.minimum(state_img_shape - 1 - episode.action[:2], shift_max_value)
+
+    screen_pos = action_pos_to_screen_pos(episode.action[:2])
+
+    while True:
+        action2 = episode.action.copy()
+        shift_val = np.array([np.random.randint(shift_neg_max[0], shift_pos_max[0]),
+                              np.random.randint(shift_neg_max[1], shift_pos_max[1])])
+        screen_pos2 = screen_pos + shift_val
+        action2[:2] = screen_pos_to_action_pos(screen_pos2)
+        if np.any(action2[:2] < 0) or np.any(action2[:2] >= mask_shape[:2]):
+            continue
+        mask_top_left = np.maximum(0, -shift_val)
+        mask2_top_left = np.maximum(0, shift_val)
+        mask_bottom_right = np.minimum(state_img_shape, state_img_shape - shift_val)
+        mask2_bottom_right = np.minimum(state_img_shape, state_img_shape + shift_val)
+        state2[mask2_top_left[0]:mask2_bottom_right[0], mask2_top_left[1]:mask2_bottom_right[1]] = \
+            episode.state[mask_top_left[0]:mask_bottom_right[0], mask_top_left[1]:mask_bottom_right[1]]
+
+        top_left, bottom_right, tl_diff, br_diff = \
+            get_mask(mask_shape[:2], mask_top_left, mask_bottom_right, screen_pos_to_action_pos)
+        top_left2, bottom_right2, tl_diff2, br_diff2 = \
+            get_mask(mask_shape[:2], mask2_top_left, mask2_bottom_right, screen_pos_to_action_pos)
+        top_left = np.ceil(top_left + np.maximum(tl_diff, tl_diff2)).astype(np.int32)
+        top_left2 = np.ceil(top_left2 + np.maximum(tl_diff, tl_diff2)).astype(np.int32)
+        bottom_right = np.ceil(bottom_right - np.maximum(br_diff, br_diff2)).astype(np.int32)
+        bottom_right2 = np.ceil(bottom_right2 - np.maximum(br_diff, br_diff2)).astype(np.int32)
+
+        diff = bottom_right - top_left
+        diff2 = bottom_right2 - top_left2
+        bottom_right = top_left + np.minimum(diff, diff2)
+        bottom_right2 = top_left2 + np.minimum(diff, diff2)
+
+        mask = np.zeros(mask_shape)
+        mask[max(0, top_left[0]): bottom_right[0], max(0, top_left[1]): bottom_right[1]] = 1
+        mask2 = np.zeros(mask_shape)
+        mask2[max(0, top_left2[0]): bottom_right2[0], max(0, top_left2[1]): bottom_right2[1]] = 1
+
+        assert np.sum(mask) == np.sum(mask2)
+        # note that I am not distorting the result here. If I use it I have to distort it too.
+        return Episode(state2, action2, episode.reward.copy(), episode.result), mask, mask2
+
+
+# maybe log some of these
+def distort_episode_color(episode: Episode, mask_shape: tuple) -> Tuple[Episode, np.ndarray, np.ndarray]:
+    color_order = np.arange(3)
+    while np.all(color_order == np.arange(3)):
+        color_order = np.random.permutation(3)
+    state = episode.state.copy()[:, :, color_order]
+    mask = np.ones(mask_shape)
+    # note that I am not distorting the result here. If I use it I have to distort it too.
+    return Episode(state, episode.action.copy(), episode.reward.copy(), episode.result), mask, mask
+
+
+def combine_distort_episode(func_probs: List[Tuple[Callable, float]], mask_shape: tuple) -> Callable:
+    def distort(episode: Episode) -> Episode:
+        for func, p in func_probs:
+            if random.uniform(0, 1) < p:
+                episode = func(episode, mask_shape)
+        return episode
+
+    return distort
+
+
+# the batch versions distort the rows of a batch in place. states and actions hold the batch to distort (a copy of
+#   the original batch) and masks and masks2 are multiplied with the masks of the distortion. get_mask works on the
+#   corners of a whole batch too
+
+
+# same as distort_episode_shift, the shifts are redrawn only for the rows whose shifted action is out of the mask
+def draw_batch_shifts(actions: np.ndarray, state_img_shape: np.ndarray, mask_shape: tuple,
+                      shift_max_value: np.ndarray, action_pos_to_screen_pos: Callable,
+                      screen_pos_to_action_pos: Callable) -> np.ndarray:
+    shift_neg_max = np.maximum(-actions[:, :2], -shift_max_value)
+    shift_pos_max = np.minimum(state_img_shape - 1 - actions[:, :2], shift_max_value)
+    screen_pos = action_pos_to_screen_pos(actions[:, :2])
+    shifts = np.zeros((len(actions), 2), dtype=np.int64)
+    pending = np.arange(len(actions))
+    while len(pending) > 0:
+        shifts[pending] = np.random.randint(shift_neg_max[pending], shift_pos_max[pending])
+        action_pos2 = screen_pos_to_action_pos(screen_pos[pending] + shifts[pending]).astype(actions.dtype)
+        pending = pending[np.any(action_pos2 < 0, axis=1) | np.any(action_pos2 >= mask_shape[:2], axis=1)]
+    return shifts
+
+
+def shift_batch(states: np.ndarray, actions: np.ndarray, rows: np.ndarray, shifts: np.ndarray, masks: np.ndarray,
+                masks2: np.ndarray, action_pos_to_screen_pos: Callable, screen_pos_to_action_pos: Callable) -> None:
+    mask_shape = np.array(masks.shape[1:3])
+    state_img_shape = np.array(states.shape[1:3])
+    actions[rows, :2] = screen_pos_to_action_pos(action_pos_to_screen_pos(actions[rows, :2]) + shifts)
+
+    mask_top_left = np.maximum(0, -shifts)
+    mask2_top_left = np.maximum(0, shifts)
+    mask_bottom_right = np.minimum(state_img_shape, state_img_shape - shifts)
+    mask2_bottom_right = np.minimum(state_img_shape, state_img_shape + shifts)
+    # the rows are shifted with slice copies, which are several times faster than gathering the shifted pixels of all
+    #   the rows with one fancy index (see check_distortions). numpy buffers the overlapping copy, then only the
+    #   uncovered borders are cleared
+    for row, tl, br, tl2, br2 in zip(rows, mask_top_left, mask_bottom_right, mask2_top_left, mask2_bottom_right):
+        state = states[row]
+        state[tl2[0]:br2[0], tl2[1]:br2[1]] = state[tl[0]:br[0], tl[1]:br[1]]
+        state[:tl2[0]] = 0
+        state[br2[0]:] = 0
+        state[:, :tl2[1]] = 0
+        state[:, br2[1]:] = 0
+
+    top_left, bottom_right, tl_diff, br_diff = \
+        get_mask(mask_shape, mask_top_left, mask_bottom_right, screen_pos_to_action_pos)
+    top_left2, bottom_right2, tl_diff2, br_diff2 = \
+        get_mask(mask_shape, mask2_top_left, mask2_bottom_right, screen_pos_to_action_pos)
+    top_left = np.ceil(top_left + np.maximum(tl_diff, tl_diff2)).astype(np.int32)
+    top_left2 = np.ceil(top_left2 + np.maximum(tl_diff, tl_diff2)).astype(np.int32)
+    bottom_right = np.ceil(bottom_right - np.maximum(br_diff, br_diff2)).astype(np.int32)
+    bottom_right2 = np.ceil(bottom_right2 - np.maximum(br_diff, br_diff2)).astype(np.int32)
+    size = np.minimum(bottom_right - top_left, bottom_right2 - top_left2)
+
+    grid_y = np.arange(mask_shape[0])[None, :, None]
+    grid_x = np.arange(mask_shape[1])[None, None, :]
+    for mask_rows, tl in [(masks, top_left), (masks2, top_left2)]:
+        br = tl + size
+        inside = (grid_y >= tl[:, 0, None, None]) & (grid_y < br[:, 0, None, None]) & \
+                 (grid_x >= tl[:, 1, None, None]) & (grid_x < br[:, 1, None, None])
+        mask_rows[rows] *= inside.reshape((len(rows), *mask_shape, *[1] * (mask_rows.ndim - 3)))
+
+
+def distort_batch_shift(states: np.ndarray, actions: np.ndarray, rows: np.ndarray, masks: np.ndarray,
+                        masks2: np.ndarray, shift_max_value: np.ndarray, action_pos_to_screen_pos: Callable,
+                        screen_pos_to_action_pos: Callable) -> None:
+    shifts = draw_batch_shifts(actions[rows], np.array(states.shape[1:3]), masks.shape[1:], shift_max_value,
+                               action_pos_to_screen_pos, screen_pos_to_action_pos)
+    shift_batch(states, actions, rows, shifts, masks, masks2, action_pos_to_screen_pos, screen_pos_to_action_pos)
+
+
+color_permutations = np.array([order for order in np.ndindex(3, 3, 3)
+                               if len(set(order)) == 3 and order != (0, 1, 2)])
+
+
+def distort_batch_color(states: np.ndarray, actions: np.ndarray, rows: np.ndarray, masks: np.ndarray,
+                        masks2: np.ndarray) -> None:
+    # the rows are grouped by their permutation, so each group is gathered once and its channels are assigned from the
+    #   gathered copy. gathering the last axis (e.g. with np.take_along_axis) is much slower than assigning channels
+    color_orders = np.random.randint(len(color_permutations), size=len(rows))
+    for order_index, color_order in enumerate(color_permutations):
+        order_rows = rows[color_orders == order_index]
+        if len(order_rows) == 0:
+            continue
+        source = states[order_rows]
+        for channel in range(3):
+            states[order_rows, :, :, channel] = source[..., color_order[channel]]
+
+
+# applies each distortion to a row with its probability. the rewards and the results are not distorted
+class BatchDistorter:
+    def __init__(self, func_probs: List[Tuple[Callable, float]], mask_shape: tuple):
+        self.func_probs = func_probs
+        self.mask_shape = mask_shape
+
+    def __call__(self, states: np.ndarray, actions: np.ndarray, states2: np.ndarray, actions2: np.ndarray,
+                 masks: np.ndarray, masks2: np.ndarray) -> None:
+        states2[:] = states
+        actions2[:] = actions
+        masks[:] = 1
+        masks2[:] = 1
+        for func, p in self.func_probs:
+            rows = np.flatnonzero(np.random.uniform(0, 1, len(states)) < p)
+            if len(rows) > 0:
+                func(states2, actions2, rows, masks, masks2)
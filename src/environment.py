@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Any, Callable
+from typing import Any, Callable, Iterator, Optional
 
 import numpy as np
 
@@ -53,11 +53,18 @@ class Environment(ABC):
         self.stopped = True
 
     def start(self):
+        for _ in self.run_steps():
+            pass
+
+    # the environment loop, which yields after the start of every episode and after every action, so an event loop can
+    #   interleave several environments
+    def run_steps(self) -> Iterator[None]:
         self.stopped = False
         while self.should_start_episode() and not self.stopped:
             self.restart()
             cur_state = self.read_state()
             self.on_episode_start(cur_state)
+            yield
             premature = False
             while not self.is_finished():
                 if self.stopped:
@@ -72,6 +79,7 @@ class Environment(ABC):
                 reward = self.act(action, self.on_wait)
                 cur_state = self.read_state()
                 self.on_state_change(last_state, action, cur_state, reward)
+                yield
             self.on_episode_end(premature)
         self.on_environment_finished()
 
@@ -91,6 +99,14 @@ class Environment(ABC):
     def act(self, action: Any, wait_action: Callable) -> float:
         pass
 
+    # the environments with noisy screens compare them with a threshold
+    def are_states_equal(self, s1: np.ndarray, s2: np.ndarray) -> bool:
+        return np.array_equal(s1, s2)
+
+    # the app the environment is exploring, for the environments that explore several
+    def get_current_app(self) -> Optional[str]:
+        return None
+
     def should_continue_episode(self) -> bool:
         return self.controller.should_continue_episode()
 
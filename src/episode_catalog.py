@@ -0,0 +1,76 @@
+import glob
+import os
+import pickle
+import sqlite3
+from typing import List, Tuple, Any, Callable, Dict
+
+import numpy as np
+
+CatalogEntry = Tuple[str, str, int, int, Any]
+# (size, max_size, example, rewards, action_types)
+CatalogRecord = Tuple[int, int, Any, np.ndarray, np.ndarray]
+
+
+# keeps one row per episode file with its per-episode rewards and action types stored as columnar blobs, so the
+#   metas are only unpickled once and the positions of a set of versions are read with a single query
+class EpisodeCatalog:
+    positions_dtype = np.dtype([('file', np.int64), ('row', np.int64), ('reward', np.int64), ('action_type', np.int64)])
+
+    # file_formats maps each format to the suffix of its files and a function that reads its catalog record
+    def __init__(self, directory: str, file_formats: Dict[str, Tuple[str, Callable[[str], CatalogRecord]]]):
+        self.directory = directory
+        self.file_formats = file_formats
+        self.connection = sqlite3.connect(f'{directory}/catalog.sqlite')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, version INTEGER, '
+                                'format TEXT, size INTEGER, max_size INTEGER, signature TEXT, example BLOB, '
+                                'rewards BLOB, action_types BLOB)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS files_version ON files (version)')
+        self.connection.commit()
+
+    @staticmethod
+    def get_signature(file_path: str) -> str:
+        stat = os.stat(file_path)
+        return f'{stat.st_mtime_ns}-{stat.st_size}'
+
+    def update(self, versions: List[int]) -> None:
+        versions = [int(v) for v in versions]
+        placeholders = ','.join('?' * len(versions))
+        signatures = dict(self.connection.execute(
+            f'SELECT path, signature FROM files WHERE version IN ({placeholders})', versions).fetchall())
+
+        for v in versions:
+            for file_format, (suffix, read_record) in self.file_formats.items():
+                for signature_file in glob.glob(f'{self.directory}/{v}/*{suffix}'):
+                    file_name = signature_file[:-len(suffix)]
+                    signature = self.get_signature(signature_file)
+                    if signatures.pop(file_name, None) == signature:
+                        continue
+                    size, max_size, example, rewards, action_types = read_record(file_name)
+                    self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                            (file_name, v, file_format, size, max_size, signature,
+                                             pickle.dumps(example), rewards.astype(np.int64).tobytes(),
+                                             action_types.astype(np.int64).tobytes()))
+        # the remaining files were removed or compacted since they were cataloged
+        self.connection.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in signatures])
+        self.connection.commit()
+
+    def query(self, versions: List[int]) -> Tuple[List[CatalogEntry], np.ndarray]:
+        versions = [int(v) for v in versions]
+        self.update(versions)
+        placeholders = ','.join('?' * len(versions))
+        rows = self.connection.execute(f'SELECT path, format, size, max_size, example, rewards, action_types '
+                                       f'FROM files WHERE version IN ({placeholders}) ORDER BY version, path',
+                                       versions).fetchall()
+        entries = [(path, file_format, size, max_size, pickle.loads(example))
+                   for path, file_format, size, max_size, example, _, _ in rows]
+        sizes = np.array([row[2] for row in rows], dtype=np.int64)
+        positions = np.zeros(int(np.sum(sizes)), dtype=self.positions_dtype)
+        if len(positions) > 0:
+            positions['file'] = np.repeat(np.arange(len(rows)), sizes)
+            positions['row'] = np.arange(len(positions)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+            positions['reward'] = np.concatenate([np.frombuffer(row[5], dtype=np.int64) for row in rows])
+            positions['action_type'] = np.concatenate([np.frombuffer(row[6], dtype=np.int64) for row in rows])
+        return entries, positions
+
+    def close(self) -> None:
+        self.connection.close()
@@ -0,0 +1,91 @@
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+
+# a growable replacement for defaultdict(list) of reward -> rows
+class RewardIndex:
+    def __init__(self, capacity: int = 1024):
+        self.rewards = np.zeros(max(capacity, 1), dtype=np.int64)
+        self.size = 0
+
+    def append(self, reward: int, index: int) -> None:
+        assert index == self.size
+        if self.size == len(self.rewards):
+            self.rewards = np.concatenate([self.rewards, np.zeros_like(self.rewards)])
+        self.rewards[self.size] = reward
+        self.size += 1
+
+    def get_rewards(self) -> np.ndarray:
+        return self.rewards[:self.size]
+
+    def to_dict(self) -> Dict[int, np.ndarray]:
+        rewards = self.get_rewards()
+        return {int(reward): np.flatnonzero(rewards == reward) for reward in np.unique(rewards)}
+
+
+# samples (file id, row) positions so that every reward class is equally represented in each epoch. each class is
+#   either augmented up to the most represented class or reduced to the least represented one, unless the epoch size
+#   is given
+class BalancedSampler:
+    def __init__(self, file_ids: np.ndarray, rows: np.ndarray, rewards: np.ndarray, correct_distributions: bool,
+                 augmenting_correction: bool, shuffle: bool, weights: Optional[np.ndarray] = None,
+                 size: Optional[int] = None):
+        self.file_ids = np.asarray(file_ids, dtype=np.int64)
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.rewards = np.asarray(rewards, dtype=np.int64)
+        self.correct_distributions = correct_distributions
+        self.augmenting_correction = augmenting_correction
+        self.shuffle = shuffle
+        self.weights = None if weights is None else np.asarray(weights, dtype=np.float64)
+        self.size = len(self.rewards) if size is None else size
+
+        order = np.argsort(self.rewards, kind='stable')
+        # with weights, the positions without weight are never sampled and a class without any is left out
+        if self.weights is not None:
+            order = order[self.weights[order] > 0]
+            if len(order) == 0:
+                raise ValueError('none of the positions has a weight.')
+        self.classes, class_starts, self.class_counts = np.unique(self.rewards[order], return_index=True,
+                                                                  return_counts=True)
+        self.class_positions = np.split(order, class_starts[1:])
+
+        if not self.is_balanceable():
+            self.class_size = None
+        elif size is not None:
+            self.class_size = int(np.ceil(size / len(self.classes)))
+        elif self.augmenting_correction:
+            self.class_size = int(np.max(self.class_counts))
+        else:
+            self.class_size = int(np.min(self.class_counts))
+
+    def is_balanceable(self) -> bool:
+        return self.correct_distributions and len(self.classes) > 1
+
+    def get_size(self) -> int:
+        if self.class_size is None:
+            return self.size
+        return self.class_size * len(self.classes)
+
+    def sample_class(self, positions: np.ndarray) -> np.ndarray:
+        if self.weights is not None:
+            weights = self.weights[positions]
+            return np.random.choice(positions, self.class_size, replace=True, p=weights / np.sum(weights))
+        repeats, remainder = divmod(self.class_size, len(positions))
+        return np.concatenate([np.tile(positions, repeats), np.random.choice(positions, remainder, replace=False)])
+
+    def sample(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self.class_size is None:
+            if self.weights is None and self.size == len(self.rewards):
+                positions = np.arange(len(self.rewards))
+            elif self.weights is None:
+                positions = np.random.choice(len(self.rewards), self.size, replace=self.size > len(self.rewards))
+            else:
+                positions = np.random.choice(len(self.rewards), self.size, replace=True,
+                                             p=self.weights / np.sum(self.weights))
+        else:
+            positions = np.concatenate([self.sample_class(class_positions)
+                                        for class_positions in self.class_positions])
+        if self.shuffle:
+            positions = positions[np.random.permutation(len(positions))]
+        return self.file_ids[positions], self.rows[positions]
@@ -0,0 +1,402 @@
+import hashlib
+import multiprocessing
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict, deque
+from datetime import datetime
+from queue import Empty
+from typing import Any, Callable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras as keras
+
+from utils import Config
+
+# (slot, group, enqueue time)
+Request = Tuple[int, str, float]
+
+
+class InferenceStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.batch_sizes = Counter()
+        self.latencies = []
+        self.prediction_times = []
+        self.start_time = time.time()
+
+    def record_batch(self, requests: List[Request], prediction_time: float) -> None:
+        self.batch_sizes[len(requests)] += 1
+        start_time = time.time() - prediction_time
+        self.latencies += [start_time - enqueue_time for _, _, enqueue_time in requests]
+        self.prediction_times.append(prediction_time)
+
+    def summary(self) -> str:
+        latencies = np.array(self.latencies) if len(self.latencies) > 0 else np.zeros(1)
+        prediction_times = np.array(self.prediction_times) if len(self.prediction_times) > 0 else np.zeros(1)
+        return f'{len(self.latencies)} frames in {len(self.prediction_times)} batches over ' \
+               f'{time.time() - self.start_time:.0f}s, batch sizes {dict(sorted(self.batch_sizes.items()))}, ' \
+               f'queue latency mean {np.mean(latencies) * 1000:.1f}ms, ' \
+               f'p95 {np.percentile(latencies, 95) * 1000:.1f}ms, max {np.max(latencies) * 1000:.1f}ms, ' \
+               f'prediction time mean {np.mean(prediction_times) * 1000:.1f}ms'
+
+
+# predicts the frames of the collectors and testers in batches in one process. each agent has a slot in a memory mapped
+#   file (preferably under /dev/shm) that it writes its frame to and reads its prediction from, so only the slot index
+#   goes through the request queue. the requests that arrive until the first one is max_latency old are predicted
+#   together. there is one model per group of agents that share their weights
+class InferenceServer:
+    def __init__(self, model_creator: Callable[[Optional[str]], Any], slot_count: int, frame_example: np.ndarray,
+                 cfg: Config):
+        self.path = cfg['path']
+        self.max_batch_size = cfg['max_batch_size']
+        self.max_latency = cfg['max_latency']
+        self.stats_frequency = cfg['stats_frequency']
+        prediction_shape = tuple(cfg['prediction_shape'])
+
+        self.model_creator = model_creator
+        self.slot_count = slot_count
+        self.slot_dtype = np.dtype([('frame', frame_example.dtype, frame_example.shape),
+                                    ('prediction', np.float32, prediction_shape)])
+        mp = multiprocessing.get_context('spawn')
+        self.requests = mp.Queue()
+        self.responses = [mp.Event() for _ in range(slot_count)]
+        self.process = None
+        self.slots = None
+        self.models = {}
+        self.new_weights = {}
+        self.prefix_weights = {}
+
+    # the memory map is opened again in each process
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['process'] = None
+        state['slots'] = None
+        return state
+
+    def open(self) -> None:
+        if self.slots is None:
+            self.slots = np.memmap(self.path, dtype=self.slot_dtype, mode='r+', shape=(self.slot_count,))
+
+    def start(self) -> None:
+        with open(self.path, 'wb') as f:
+            f.truncate(self.slot_count * self.slot_dtype.itemsize)
+        self.process = multiprocessing.get_context('spawn').Process(name='inference_server', target=self.serve)
+        self.process.start()
+
+    def stop(self) -> None:
+        self.requests.put(('stop',))
+        self.process.join()
+
+    def create_client(self, slot: int, group: str, weights_file: Optional[str]) -> 'InferenceClient':
+        self.requests.put(('register', group, weights_file))
+        return InferenceClient(self, slot, group)
+
+    # sets the weights of every group whose name starts with prefix, also of the groups that register later. the weights
+    #   that the clients of several groups get are sent once this way, instead of once per client
+    def update_weights(self, prefix: str, weights: Union[List[np.ndarray], str]) -> None:
+        self.requests.put(('prefix_weights', prefix, weights))
+
+    # weights are set right before the next prediction of their group, so only the latest of several updates is set
+    def on_message(self, message: Tuple) -> None:
+        if message[0] == 'register':
+            _, group, weights_file = message
+            if group not in self.models:
+                print(f'{datetime.now()}: inference server created the model of {group}.')
+                self.models[group] = self.model_creator(weights_file)
+                for prefix, weights in self.prefix_weights.items():
+                    if group.startswith(prefix):
+                        self.new_weights[group] = weights
+        elif message[0] == 'weights':
+            _, group, weights = message
+            self.new_weights[group] = weights
+        elif message[0] == 'prefix_weights':
+            _, prefix, weights = message
+            self.prefix_weights[prefix] = weights
+            for group in self.models:
+                if group.startswith(prefix):
+                    self.new_weights[group] = weights
+        else:
+            raise ValueError(f'unknown inference message {message[0]}.')
+
+    # blocks for the first request, then collects requests until its deadline or max_batch_size. every agent has at most
+    #   one request, so it does not wait once all of them have one. returns None when the server is stopped
+    def receive_batch(self) -> Optional[List[Request]]:
+        requests = []
+        deadline = None
+        while len(requests) < min(self.max_batch_size, self.slot_count):
+            try:
+                message = self.requests.get(timeout=None if deadline is None else max(0, deadline - time.time()))
+            except Empty:
+                break
+            if message[0] == 'stop':
+                return None
+            if message[0] == 'predict':
+                requests.append(message[1:])
+                if deadline is None:
+                    deadline = message[3] + self.max_latency
+            else:
+                self.on_message(message)
+        return requests
+
+    def get_model(self, group: str) -> Any:
+        model = self.models[group]
+        if group in self.new_weights:
+            weights = self.new_weights.pop(group)
+            if isinstance(weights, str):
+                model.load_weights(weights, by_name=True)
+            else:
+                model.set_weights(weights)
+        return model
+
+    def predict(self, requests: List[Request]) -> None:
+        groups = defaultdict(list)
+        for slot, group, _ in requests:
+            groups[group].append(slot)
+        for group, group_slots in groups.items():
+            self.slots['prediction'][group_slots] = self.get_model(group).predict_on_batch(
+                self.slots['frame'][group_slots])
+            for slot in group_slots:
+                self.responses[slot].set()
+
+    def serve(self) -> None:
+        self.open()
+        stats = InferenceStats()
+        while True:
+            requests = self.receive_batch()
+            if requests is None:
+                return
+            start_time = time.time()
+            self.predict(requests)
+            stats.record_batch(requests, time.time() - start_time)
+            if time.time() - stats.start_time >= self.stats_frequency:
+                print(f'{datetime.now()}: inference server predicted {stats.summary()}.')
+                stats.reset()
+
+
+# the side of the inference server that an agent uses. an agent waits for its prediction, so it never has more than one
+#   request in its slot
+class InferenceClient:
+    def __init__(self, server: InferenceServer, slot: int, group: str):
+        self.server = server
+        self.slot = slot
+        self.group = group
+
+    def predict(self, state: np.ndarray) -> np.ndarray:
+        self.server.open()
+        slot = self.server.slots[self.slot]
+        response = self.server.responses[self.slot]
+        slot['frame'] = state
+        response.clear()
+        self.server.requests.put(('predict', self.slot, self.group, time.time()))
+        response.wait()
+        return np.array(slot['prediction'])
+
+    # a weights file is loaded by the server
+    def update_weights(self, weights: Union[List[np.ndarray], str]) -> None:
+        self.server.requests.put(('weights', self.group, weights))
+
+
+# runs the reward predictor of an agent as a tflite model. the weights it gets are set on the float model, which is only
+#   used to export them again, with weights quantized to int8 (dynamic) or also the activations (int8), calibrated on
+#   the latest predicted states once calibration_size of them are recorded (dynamic until then). every
+#   report_frequency exports, the export is compared to the float model on the latest report_size states, which
+#   keeps the float model off the weight syncs in between
+class TFLitePredictor:
+    def __init__(self, model: keras.Model, cfg: Config):
+        self.quantization = cfg['tflite_quantization']
+        calibration_size = cfg['tflite_calibration_size']
+        self.report_frequency = cfg['tflite_report_frequency']
+        self.report_size = cfg['tflite_report_size']
+
+        if self.quantization not in ['none', 'dynamic', 'int8']:
+            raise ValueError(f'unknown tflite quantization {self.quantization}.')
+
+        self.model = model
+        self.session = keras.backend.get_session()
+        self.states = deque(maxlen=calibration_size)
+        self.interpreter = None
+        self.input_index = None
+        self.output_index = None
+        self.exports = 0
+        self.export()
+
+    def update_weights(self, weights: Union[List[np.ndarray], str]) -> None:
+        if isinstance(weights, str):
+            self.model.load_weights(weights, by_name=True)
+        else:
+            self.model.set_weights(weights)
+        self.export()
+
+    def get_representative_dataset(self) -> Iterator[List[np.ndarray]]:
+        for state in self.states:
+            yield [np.expand_dims(state, axis=0)]
+
+    def convert(self) -> Tuple[bytes, str]:
+        converter = tf.lite.TFLiteConverter.from_session(self.session, [self.model.input], [self.model.output])
+        quantization = self.quantization
+        if quantization == 'int8' and len(self.states) < self.states.maxlen:
+            quantization = 'dynamic'
+        if quantization != 'none':
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantization == 'int8':
+            converter.representative_dataset = self.get_representative_dataset
+        return converter.convert(), quantization
+
+    def invoke(self, state: np.ndarray) -> np.ndarray:
+        self.interpreter.set_tensor(self.input_index, np.expand_dims(state, axis=0))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index)[0]
+
+    def export(self) -> None:
+        start_time = time.time()
+        content, quantization = self.convert()
+        self.interpreter = tf.lite.Interpreter(model_content=content)
+        self.interpreter.allocate_tensors()
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        print(f'{datetime.now()}: exported the reward predictor to tflite with {quantization} quantization '
+              f'({len(content) >> 10}KB) in {time.time() - start_time:.1f}s.')
+        self.exports += 1
+        if self.report_frequency > 0 and self.exports % self.report_frequency == 0 and len(self.states) > 0:
+            self.report(list(self.states)[-self.report_size:])
+
+    def report(self, states: List[np.ndarray]) -> None:
+        start_time = time.time()
+        float_preds = [self.model.predict_on_batch(np.expand_dims(state, axis=0))[0] for state in states]
+        float_time = (time.time() - start_time) / len(states)
+        start_time = time.time()
+        preds = [self.invoke(state) for state in states]
+        tflite_time = (time.time() - start_time) / len(states)
+        errors = [np.mean(np.abs(pred - float_pred)) for pred, float_pred in zip(preds, float_preds)]
+        agreement = np.mean([np.argmax(pred) == np.argmax(float_pred) for pred, float_pred in zip(preds, float_preds)])
+        print(f'{datetime.now()}: on {len(states)} recorded states, tflite predictions differ from the float model by '
+              f'{np.mean(errors):.4f} on average (max {np.max(errors):.4f}), their best actions agree in '
+              f'{agreement * 100:.0f}% of the states, and they take {tflite_time * 1000:.1f}ms per state against '
+              f'{float_time * 1000:.1f}ms.')
+
+    def predict(self, state: np.ndarray) -> np.ndarray:
+        self.states.append(np.array(state))
+        return self.invoke(state)
+
+
+# runs the reward predictor of an agent as a separate keras model, so its predictions can be cached
+class KerasPredictor:
+    def __init__(self, model: keras.Model):
+        self.model = model
+
+    def get_weights(self) -> List[np.ndarray]:
+        return self.model.get_weights()
+
+    def update_weights(self, weights: Union[List[np.ndarray], str]) -> None:
+        if isinstance(weights, str):
+            self.model.load_weights(weights, by_name=True)
+        else:
+            self.model.set_weights(weights)
+
+    def predict(self, state: np.ndarray) -> np.ndarray:
+        return self.model.predict_on_batch(np.expand_dims(state, axis=0))[0]
+
+
+# a keras predictor that the workers of a thread based coordinator share. every worker forwards the weights it gets,
+#   which in one process are the same object (or weights file), so they are only set by the first worker
+class SharedKerasPredictor(KerasPredictor):
+    def __init__(self, model: keras.Model):
+        super().__init__(model)
+        self.weights = None
+        self.lock = threading.Lock()
+
+    def update_weights(self, weights: Union[List[np.ndarray], str]) -> None:
+        with self.lock:
+            if weights is self.weights or (isinstance(weights, str) and weights == self.weights):
+                return
+            self.weights = weights
+            super().update_weights(weights)
+
+
+# the latest predictions of an agent, keyed by a hash of the part of the frame that the screen preprocessor sees and by
+#   the version of the weights, which is increased (and the cache cleared) whenever the agent gets new weights. the hit
+#   rate of each app is reported every stats_frequency lookups
+class PredictionCache:
+    def __init__(self, cfg: Config):
+        self.size = cfg['prediction_cache_size']
+        self.stats_frequency = cfg['prediction_cache_stats_frequency']
+        self.crop_top_left = cfg['crop_top_left']
+        self.crop_size = cfg['crop_size']
+
+        self.predictions = OrderedDict()
+        self.weight_version = 0
+        self.hits = Counter()
+        self.lookups = Counter()
+
+    def get_key(self, state: np.ndarray) -> Tuple[bytes, int]:
+        crop = state[self.crop_top_left[0]:self.crop_top_left[0] + self.crop_size[0],
+                     self.crop_top_left[1]:self.crop_top_left[1] + self.crop_size[1]]
+        return hashlib.blake2b(np.ascontiguousarray(crop).tobytes(), digest_size=16).digest(), self.weight_version
+
+    def invalidate(self) -> None:
+        self.weight_version += 1
+        self.predictions.clear()
+
+    def predict(self, state: np.ndarray, predict: Callable[[np.ndarray], np.ndarray], app: Optional[str]) -> np.ndarray:
+        key = self.get_key(state)
+        prediction = self.predictions.get(key)
+        if prediction is None:
+            prediction = predict(state)
+            self.predictions[key] = prediction
+            if len(self.predictions) > self.size:
+                self.predictions.popitem(last=False)
+        else:
+            self.predictions.move_to_end(key)
+            self.hits[app] += 1
+        self.lookups[app] += 1
+        if sum(self.lookups.values()) % self.stats_frequency == 0:
+            print(f'{datetime.now()}: prediction cache hit rates: ' +
+                  ', '.join(f'{app} {self.hits[app] / lookups * 100:.0f}% of {lookups}'
+                            for app, lookups in self.lookups.items()) + '.')
+        return prediction
+
+
+# the cheap first stage of the predictions of an agent: when the screen did not change after the last action (under the
+#   equality of the environment), the last predictions are reused with the tried action down-weighted by decay, and the
+#   prediction source only runs on real changes. the skipped predictions and the time they would have taken (at the
+#   mean latency of the real ones) are reported every stats_frequency steps
+class PredictionCascade:
+    def __init__(self, are_states_equal: Callable[[np.ndarray, np.ndarray], bool], cfg: Config):
+        self.decay = cfg['cascade_decay']
+        self.stats_frequency = cfg['cascade_stats_frequency']
+
+        self.are_states_equal = are_states_equal
+        self.last_state = None
+        self.last_prediction = None
+        self.steps = 0
+        self.skipped = 0
+        self.prediction_time = 0.
+
+    def reset(self) -> None:
+        self.last_state = None
+        self.last_prediction = None
+
+    def get_saved_time(self) -> float:
+        return self.skipped * self.prediction_time / max(self.steps - self.skipped, 1)
+
+    def predict(self, state: np.ndarray, predict: Callable[[np.ndarray], np.ndarray]) -> np.ndarray:
+        self.steps += 1
+        if self.last_state is not None and self.are_states_equal(self.last_state, state):
+            self.skipped += 1
+        else:
+            start_time = time.time()
+            self.last_prediction = predict(state)
+            self.prediction_time += time.time() - start_time
+        self.last_state = state
+        if self.steps % self.stats_frequency == 0:
+            print(f'{datetime.now()}: prediction cascade skipped {self.skipped} of {self.steps} predictions, '
+                  f'saving {self.get_saved_time():.1f}s.')
+        return self.last_prediction
+
+    # the predictions may be shared (e.g. with the prediction cache), so they are copied before the change
+    def on_action(self, action: np.ndarray) -> None:
+        self.last_prediction = np.array(self.last_prediction)
+        self.last_prediction[int(action[0]), int(action[1]), int(action[2])] *= self.decay
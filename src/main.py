@@ -1,13 +1,13 @@
 import os
 import copy
-import random
+import time
 from datetime import datetime
 from functools import partial
 from io import BytesIO
 from typing import Callable, List, Any, Tuple, Union, Dict
 
-import matplotlib.cm as cm
 import numpy as np
+import psutil
 import tensorflow as tf
 import tensorflow.keras as keras
 import yaml
@@ -15,17 +15,22 @@ from PIL import Image
 
 import readouts
 from environment import EnvironmentCallbacks, Environment
+from inference import TFLitePredictor, KerasPredictor, PredictionCache, PredictionCascade
 # noinspection PyUnresolvedReferences
 from phone import DummyPhone, Phone
-from browser import Browser
+from distillation import Distiller
+from distortions import BatchDistorter, distort_batch_color, distort_batch_shift
 # noinspection PyUnresolvedReferences
-from predictors import ScreenPreprocessor, SimpleRewardPredictor, UNetRewardPredictor, RandomRewardPredictor
+from predictors import ScreenPreprocessor, SimpleRewardPredictor, UNetRewardPredictor, RandomRewardPredictor, \
+    InitialWeightsCache
+from preprocessed_cache import PreprocessedCache
 from readouts import PredictionClusterer, better_reward_to_action, worse_reward_to_action, \
-    most_certain_reward_to_action, least_certain_reward_to_action, random_reward_to_action
+    most_certain_reward_to_action, least_certain_reward_to_action, random_reward_to_action, \
+    combine_prediction_to_actions
 from relevant_action import RelevantActionEnvironment
 from relevant_action_monkey_client import RelevantActionMonkeyClient
 from single_state_categorical_reward import DataCollectionAgent, LearningAgent, Episode, TestingAgent, \
-    ProcessBasedCoordinator
+    ProcessBasedCoordinator, ThreadBasedCoordinator, AsyncioCoordinator, NetworkCoordinator
 from tf_utils import BufferLogger
 from utils import Config
 
@@ -90,9 +95,9 @@ class CollectorLogger(EnvironmentCallbacks):
     def get_dependencies(self) -> List[tf.Tensor]:
         return self.dependencies
 
-    def on_new_clustering(self, clickables: List[tf.Tensor], clusters: List[np.ndarray],
+    def on_new_clustering(self, clickables: List[np.ndarray], clusters: List[np.ndarray],
                           valid_clusters_nums: List[np.ndarray]) -> None:
-        self.clustering = ([x.numpy() for x in clickables], clusters, valid_clusters_nums)
+        self.clustering = (clickables, clusters, valid_clusters_nums)
 
     def on_new_prediction(self, prediction: np.ndarray) -> None:
         self.prediction = prediction
@@ -212,6 +217,8 @@ class CollectorLogger(EnvironmentCallbacks):
         new_size = self.preprocessed_screen.shape[:2]
         final_pred_size = (new_size[0] * int(type_count ** .5), new_size[1] * (type_count // int(type_count ** .5)))
         final_pred = np.zeros((*final_pred_size, 3), dtype=np.uint8)
+        # matplotlib is only imported by the agents that log predictions
+        import matplotlib.cm as cm
         original_pred = np.uint8(cm.viridis(pred)[:, :, :, :3] * 255)
         for type in range(type_count):
             pred = original_pred[:, :, type, :]
@@ -255,13 +262,9 @@ def linear_normalizer(logits: tf.Tensor, axis=None) -> tf.Tensor:
     return logits / (tf.reduce_sum(logits, axis=axis) + keras.backend.epsilon())
 
 
-def combine_prediction_to_actions(prediction_to_actions: List[Callable], probs: List[float]) -> Callable:
-    assert abs(sum(probs) - 1) < 1e-6
-
-    def to_actions(preds: tf.Tensor) -> tf.Tensor:
-        return np.random.choice(prediction_to_actions, 1, False, probs)[0](preds)
-
-    return lambda inp: tf.py_function(to_actions, [inp], tf.int32)
+# the numpy twin of each normalizer is named after it, for the readouts that run in python
+def linear_normalizer_numpy(logits: np.ndarray, axis=None) -> np.ndarray:
+    return logits / (np.sum(logits, axis=axis) + keras.backend.epsilon())
 
 
 def prediction_sampler(predictions: tf.Tensor, actions: tf.Tensor) -> tf.Tensor:
@@ -286,86 +289,6 @@ def transform_linearly(coord: np.ndarray, ratio: np.ndarray, offset: np.ndarray,
     return res
 
 
-def get_mask(transformed_shape: np.ndarray, mask_top_left: np.ndarray, mask_bottom_right: np.ndarray,
-             transform_coord: Callable) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
-    top_left = transform_coord(mask_top_left)
-    bottom_right = transform_coord(mask_bottom_right)
-    tl_diff = np.maximum(0, top_left) - top_left
-    br_diff = bottom_right - np.minimum(transformed_shape - 1, bottom_right)
-    return top_left, bottom_right, tl_diff, br_diff
-
-
-def distort_episode_shift(episode: Episode, mask_shape: tuple, shift_max_value: np.ndarray,
-                          action_pos_to_screen_pos: Callable, screen_pos_to_action_pos: Callable) \
-        -> Tuple[Episode, np.ndarray, np.ndarray]:
-    mask_shape = np.array(mask_shape)
-    state_img_shape = np.array(episode.state.shape[:2])
-    state2 = np.zeros(episode.state.shape, episode.state.dtype)
-    shift_neg_max = np.maximum(-episode.action[:2], -shift_max_value)
-    shift_pos_max = np.minimum(state_img_shape - 1 - episode.action[:2], shift_max_value)
-
-    screen_pos = action_pos_to_screen_pos(episode.action[:2])
-
-    while True:
-        action2 = episode.action.copy()
-        shift_val = np.array([np.random.randint(shift_neg_max[0], shift_pos_max[0]),
-                              np.random.randint(shift_neg_max[1], shift_pos_max[1])])
-        screen_pos2 = screen_pos + shift_val
-        action2[:2] = screen_pos_to_action_pos(screen_pos2)
-        if np.any(action2[:2] < 0) or np.any(action2[:2] >= mask_shape[:2]):
-            continue
-        mask_top_left = np.maximum(0, -shift_val)
-        mask2_top_left = np.maximum(0, shift_val)
-        mask_bottom_right = np.minimum(state_img_shape, state_img_shape - shift_val)
-        mask2_bottom_right = np.minimum(state_img_shape, state_img_shape + shift_val)
-        state2[mask2_top_left[0]:mask2_bottom_right[0], mask2_top_left[1]:mask2_bottom_right[1]] = \
-            episode.state[mask_top_left[0]:mask_bottom_right[0], mask_top_left[1]:mask_bottom_right[1]]
-
-        top_left, bottom_right, tl_diff, br_diff = \
-            get_mask(mask_shape[:2], mask_top_left, mask_bottom_right, screen_pos_to_action_pos)
-        top_left2, bottom_right2, tl_diff2, br_diff2 = \
-            get_mask(mask_shape[:2], mask2_top_left, mask2_bottom_right, screen_pos_to_action_pos)
-        top_left = np.ceil(top_left + np.maximum(tl_diff, tl_diff2)).astype(np.int32)
-        top_left2 = np.ceil(top_left2 + np.maximum(tl_diff, tl_diff2)).astype(np.int32)
-        bottom_right = np.ceil(bottom_right - np.maximum(br_diff, br_diff2)).astype(np.int32)
-        bottom_right2 = np.ceil(bottom_right2 - np.maximum(br_diff, br_diff2)).astype(np.int32)
-
-        diff = bottom_right - top_left
-        diff2 = bottom_right2 - top_left2
-        bottom_right = top_left + np.minimum(diff, diff2)
-        bottom_right2 = top_left2 + np.minimum(diff, diff2)
-
-        mask = np.zeros(mask_shape)
-        mask[max(0, top_left[0]): bottom_right[0], max(0, top_left[1]): bottom_right[1]] = 1
-        mask2 = np.zeros(mask_shape)
-        mask2[max(0, top_left2[0]): bottom_right2[0], max(0, top_left2[1]): bottom_right2[1]] = 1
-
-        assert np.sum(mask) == np.sum(mask2)
-        # note that I am not distorting the result here. If I use it I have to distort it too.
-        return Episode(state2, action2, episode.reward.copy(), episode.result), mask, mask2
-
-
-# maybe log some of these
-def distort_episode_color(episode: Episode, mask_shape: tuple) -> Tuple[Episode, np.ndarray, np.ndarray]:
-    color_order = np.arange(3)
-    while np.all(color_order == np.arange(3)):
-        color_order = np.random.permutation(3)
-    state = episode.state.copy()[:, :, color_order]
-    mask = np.ones(mask_shape)
-    # note that I am not distorting the result here. If I use it I have to distort it too.
-    return Episode(state, episode.action.copy(), episode.reward.copy(), episode.result), mask, mask
-
-
-def combine_distort_episode(func_probs: List[Tuple[Callable, float]], mask_shape: tuple) -> Callable:
-    def distort(episode: Episode) -> Episode:
-        for func, p in func_probs:
-            if random.uniform(0, 1) < p:
-                episode = func(episode, mask_shape)
-        return episode
-
-    return distort
-
-
 def control_dependencies(inputs) -> tf.Tensor:
     x, dependencies = inputs
     with tf.control_dependencies(dependencies):
@@ -386,6 +309,7 @@ def preds_variance_regularizer(preds: tf.Tensor) -> tf.Tensor:
 def create_agent(id: int, agent_num: int, agent_name: str, is_learner: bool, is_tester: bool,
                  agent_option_probs: List[float], agent_clusterer_cfg_name: str,
                  weights_file: str) -> Union[DataCollectionAgent, LearningAgent]:
+    creation_start_time = time.time()
     cfg = copy.deepcopy(globals()['cfg'])
     phone_class = cfg['phone_class']
     environment_configs = cfg['environment_configs']
@@ -404,6 +328,7 @@ def create_agent(id: int, agent_num: int, agent_name: str, is_learner: bool, is_
     collectors_clone_script = cfg['collectors_clone_script']
     testers_clone_script = cfg['testers_clone_script']
     reward_predictor = cfg['reward_predictor']
+    model_cache_dir = cfg['model_cache_dir']
     prediction_shape = cfg['prediction_shape']
     variance_reg_coeff = cfg['variance_reg_coeff']
     l1_reg_coeff = cfg['l1_reg_coeff']
@@ -427,6 +352,14 @@ def create_agent(id: int, agent_num: int, agent_name: str, is_learner: bool, is_
     reward_predictor_configs = cfg[f'{reward_predictor[1]}_reward_predictor_configs']
     learn_in_tester = tester_configs['learn']
     learning_rate = tester_configs['learning_rate']
+    preprocessed_cache_dtype = learner_configs['preprocessed_cache_dtype']
+    inference_configs = cfg['inference_configs']
+    inference_mode = inference_configs['mode']
+    prediction_cache_size = inference_configs['prediction_cache_size']
+    prediction_cascade = inference_configs['prediction_cascade']
+    distillation_configs = cfg['distillation_configs']
+    distill = distillation_configs['distill']
+    has_prediction_source = inference_mode != 'graph' or prediction_cache_size > 0 or prediction_cascade or distill
 
     environment_configs['pos_reward'] = pos_reward
     environment_configs['neg_reward'] = neg_reward
@@ -436,12 +369,15 @@ def create_agent(id: int, agent_num: int, agent_name: str, is_learner: bool, is_
     if is_tester and learn_in_tester:
         environment_configs['calculate_reward'] = True
         calculate_reward = True
+    inference_configs['crop_top_left'] = screen_preprocessor_crop_top_left
+    inference_configs['crop_size'] = screen_preprocessor_crop_size
     phone_configs['crop_top_left'] = screen_preprocessor_crop_top_left
     phone_configs['crop_size'] = screen_preprocessor_crop_size
     phone_configs['apks_path'] = testers_apks_path if is_tester else collectors_apks_path
     phone_configs['clone_script_path'] = testers_clone_script if is_tester else collectors_clone_script
     browser_configs['screen_shape'] = screen_shape
     collector_configs['file_dir'] = data_file_dir
+    collector_configs['weights_file'] = weights_file
     learner_configs['file_dir'] = data_file_dir
     tester_configs['weights_file'] = weights_file
     tester_configs['file_dir'] = tester_configs['file_dir'] + '/tester' + str(id)
@@ -453,6 +389,12 @@ def create_agent(id: int, agent_num: int, agent_name: str, is_learner: bool, is_
     tester_learner_configs['save_dir'] = None
     tester_learner_configs['validation_dir'] = None
     tester_learner_configs['data_portion_per_epoch'] = 1
+    distillation_configs['save_dir'] = learner_configs['save_dir']
+    # the collectors and testers run the student, which the learner distills and sends to them
+    if distill and not is_learner:
+        if is_tester and learn_in_tester:
+            raise ValueError('cannot distill for testers that learn.')
+        weights_file = distillation_configs['weights_file']
     if is_tester and monkey_client_mode:
         tester_configs['weight_reset_frequency'] = None
     collector_logger_configs['dir'] = logs_dir
@@ -485,8 +427,7 @@ def create_agent(id: int, agent_num: int, agent_name: str, is_learner: bool, is_
         return transform_linearly(action_p, screen_preprocessor_crop_size_a / prediction_shape_a,
                                   screen_preprocessor_crop_top_left_a, dtype)
 
-    example_episode = Episode(np.zeros((*screen_shape, 3), np.uint8), np.zeros(3, np.int32),
-                              np.zeros((), np.bool), np.zeros((*screen_shape, 3), np.uint8))
+    example_episode = create_example_episode(screen_shape)
 
     screen_preprocessor = ScreenPreprocessor(screen_preprocessor_configs, name='screen_preprocessor')
 
@@ -499,14 +440,42 @@ def create_agent(id: int, agent_num: int, agent_name: str, is_learner: bool, is_
             regs.append(keras.regularizers.l1(l1_reg_coeff))
             coeffs.append(1)
 
+    initial_weights_cache = InitialWeightsCache(model_cache_dir, reward_predictor[0], action_type_count,
+                                                reward_predictor_configs)
     reward_predictor = eval(reward_predictor[0])(action_type_count, 2,
-                                                 reward_predictor_configs, name='reward_predictor',
+                                                 initial_weights_cache.get_configs(reward_predictor_configs),
+                                                 name='reward_predictor',
                                                  activity_regularizer=None if len(regs) == 0
                                                  else linear_combination(regs, coeffs))
 
-    screen_input = keras.layers.Input(example_episode.state.shape, batch_size, name='state',
-                                      dtype=example_episode.state.dtype)
-    predictions = reward_predictor(screen_preprocessor(screen_input))
+    # the learner reads states that are already preprocessed from the cache, so preprocessing is skipped in its graph
+    if is_learner and not is_tester and preprocessed_cache_dtype is not None:
+        if iic_coeff != 0:
+            raise ValueError('cannot use preprocessed cache with iic distortions.')
+        raw_screen_input = keras.layers.Input(example_episode.state.shape, name='raw_state',
+                                              dtype=example_episode.state.dtype)
+        screen_preprocessor_model = keras.Model(inputs=raw_screen_input, outputs=screen_preprocessor(raw_screen_input))
+        preprocessed_cache = PreprocessedCache(screen_preprocessor_model.predict_on_batch, preprocessed_cache_dtype,
+                                               batch_size, screen_preprocessor_configs)
+        preprocessed_scale = preprocessed_cache.get_scale()
+        screen_input = keras.layers.Input(preprocessed_cache.get_shape(), batch_size, name='state',
+                                          dtype=preprocessed_cache.dtype.name)
+        predictions = reward_predictor(keras.layers.Lambda(lambda x: tf.cast(x, tf.float32) / preprocessed_scale,
+                                                           name='preprocessed_cache_decoder')(screen_input))
+    # the predictions come from a prediction source (the inference server, the tflite model, or a separate model behind
+    #   the prediction cache or cascade), the screen is only preprocessed for the logger
+    elif not is_learner and has_prediction_source:
+        preprocessed_cache = None
+        screen_input = keras.layers.Input(example_episode.state.shape, batch_size, name='state',
+                                          dtype=example_episode.state.dtype)
+        screen_preprocessor(screen_input)
+        predictions = keras.layers.Input((*prediction_shape, action_type_count), batch_size, name='predictions',
+                                         dtype=tf.float32)
+    else:
+        preprocessed_cache = None
+        screen_input = keras.layers.Input(example_episode.state.shape, batch_size, name='state',
+                                          dtype=example_episode.state.dtype)
+        predictions = reward_predictor(screen_preprocessor(screen_input))
 
     if is_learner:
         action_sampler = keras.layers.Lambda(lambda elems: prediction_sampler(elems[0], elems[1]),
@@ -548,6 +517,22 @@ def create_agent(id: int, agent_num: int, agent_name: str, is_learner: bool, is_
             learn_model_output = reward
 
         learn_model = keras.Model(inputs=learn_model_input, outputs=learn_model_output)
+
+        if distill and not is_tester:
+            if preprocessed_cache is not None:
+                raise ValueError('cannot distill with the preprocessed cache.')
+            teacher_input = keras.layers.Input(example_episode.state.shape, name='teacher_state',
+                                               dtype=example_episode.state.dtype)
+            teacher = keras.Model(inputs=teacher_input, outputs=reward_predictor(screen_preprocessor(teacher_input)))
+            student = create_prediction_model(distillation_configs['weights_file'])
+            student.compile('adam', keras.losses.BinaryCrossentropy())
+            with tf.device('/cpu:0'):
+                latency_input = keras.layers.Input(example_episode.state.shape, name='latency_state',
+                                                   dtype=example_episode.state.dtype)
+                latency_models = (keras.Model(inputs=latency_input,
+                                              outputs=reward_predictor(screen_preprocessor(latency_input))),
+                                  keras.Model(inputs=latency_input, outputs=student(latency_input)))
+            distiller = Distiller(teacher, student, latency_models, distillation_configs)
     else:
         built_prediction_to_action_options = [prediction_to_action_options[0](agent_clusterer_cfg_name)] + \
                                              prediction_to_action_options[1:]
@@ -557,21 +542,22 @@ def create_agent(id: int, agent_num: int, agent_name: str, is_learner: bool, is_
 
         if use_logger:
             logger = CollectorLogger(f'{agent_name}_{"tester" if is_tester else "collector"}{id}',
-                                     screen_preprocessor.output, reward_predictor.output,
+                                     screen_preprocessor.output, predictions,
                                      built_prediction_to_action_options[0], action_pos_to_screen_pos,
                                      to_preprocessed_coord, collector_logger_configs)
 
             action = keras.layers.Lambda(control_dependencies,
                                          name='log_dependency_controller')((action, logger.get_dependencies()))
 
-        input = screen_input
+        input = [screen_input, predictions] if has_prediction_source else screen_input
         output = action
         model = keras.Model(inputs=input, outputs=output)
 
+    initial_weights_cache.apply(reward_predictor)
     if weights_file is not None:
         if is_learner:
             learn_model.load_weights(weights_file, by_name=True)
-        else:
+        elif not has_prediction_source:
             model.load_weights(weights_file, by_name=True)
     if is_learner:
         if is_tester:
@@ -594,14 +580,15 @@ def create_agent(id: int, agent_num: int, agent_name: str, is_learner: bool, is_
                                              monkey_client_configs)
             return env
         else:
-            phone_type = eval(phone_class)
-            if phone_type is Browser:
+            if phone_class == 'Browser':
+                # selenium is only imported by the browser agents
+                from browser import Browser
                 env = RelevantActionEnvironment(
                     collector, Browser(('tester' if is_tester else 'collector') + str(id),
                                        browser_configs), action2pos, environment_configs)
             else:
                 env = RelevantActionEnvironment(
-                    collector, phone_type(('tester' if is_tester else 'collector') + str(id), 
+                    collector, eval(phone_class)(('tester' if is_tester else 'collector') + str(id),
                                           5554 + 2 * agent_num, phone_configs), action2pos, environment_configs)
             if use_logger:
                 env.add_callback(logger)
@@ -609,23 +596,72 @@ def create_agent(id: int, agent_num: int, agent_name: str, is_learner: bool, is_
             return env
 
     if is_learner:
-        iic_distorter = combine_distort_episode(
-            list(zip([distort_episode_color, partial(distort_episode_shift,
-                                                     shift_max_value=distort_shift_max_value,
-                                                     action_pos_to_screen_pos=action_pos_to_screen_pos,
-                                                     screen_pos_to_action_pos=screen_pos_to_action_pos)],
+        iic_distorter = BatchDistorter(
+            list(zip([distort_batch_color, partial(distort_batch_shift,
+                                                   shift_max_value=distort_shift_max_value,
+                                                   action_pos_to_screen_pos=action_pos_to_screen_pos,
+                                                   screen_pos_to_action_pos=screen_pos_to_action_pos)],
                      iic_distorter_probabilities)), tuple([int(x) for x in predictions.shape[1:]]))
         iic_distorter = None if iic_coeff == 0 else iic_distorter
 
     if is_learner:
-        return LearningAgent(id, learn_model, iic_distorter, tester_learner_configs if is_tester else learner_configs)
-    elif is_tester:
-        agent = TestingAgent(id, model, example_episode, create_environment, tester_configs)
-        if monkey_client_mode:
-            tester_agent_ref.append(agent)
-        return agent
+        agent = LearningAgent(id, learn_model, iic_distorter, tester_learner_configs if is_tester else learner_configs,
+                              preprocessed_cache)
+        if distill and not is_tester:
+            agent.set_distiller(distiller)
     else:
-        return DataCollectionAgent(id, model, example_episode, create_environment, collector_configs)
+        if is_tester:
+            agent = TestingAgent(id, model, example_episode, create_environment, tester_configs)
+            if monkey_client_mode:
+                tester_agent_ref.append(agent)
+        else:
+            agent = DataCollectionAgent(id, model, example_episode, create_environment, collector_configs)
+        if inference_mode == 'tflite':
+            agent.set_prediction_source(TFLitePredictor(create_prediction_model(weights_file), inference_configs))
+        elif has_prediction_source and inference_mode == 'graph':
+            agent.set_prediction_source(KerasPredictor(create_prediction_model(weights_file)))
+        if prediction_cache_size > 0:
+            agent.set_prediction_cache(PredictionCache(inference_configs))
+        if prediction_cascade:
+            agent.set_prediction_cascade(PredictionCascade(agent.environment.are_states_equal, inference_configs))
+    role = ('tester ' if is_tester else '') + ('learner' if is_learner else 'tester' if is_tester else 'collector')
+    # measured from the creation of the process, so it includes the imports of the process
+    process_start_time = psutil.Process().create_time()
+    print(f'{datetime.now()}: {role} {id} started {time.time() - process_start_time:.1f}s after its process, '
+          f'{time.time() - creation_start_time:.1f}s of which creating the agent.')
+    return agent
+
+
+# the reward predictor alone, for the inference server (which predicts the frames of several agents in one batch) and
+#   the tflite export. with distillation, this is the student that the collectors and testers run
+def create_prediction_model(weights_file: str) -> keras.Model:
+    cfg = copy.deepcopy(globals()['cfg'])
+    reward_predictor = cfg['reward_predictor']
+    reward_predictor_configs = cfg[f'{reward_predictor[1]}_reward_predictor_configs']
+    if cfg['distillation_configs']['distill']:
+        reward_predictor = ['SimpleRewardPredictor']
+        reward_predictor_configs = cfg['distillation_configs']['student_configs']
+    reward_predictor_configs['prediction_shape'] = cfg['prediction_shape']
+    example_episode = create_example_episode(cfg['phone_configs']['screen_shape'])
+
+    screen_input = keras.layers.Input(example_episode.state.shape, name='state', dtype=example_episode.state.dtype)
+    screen_preprocessor = ScreenPreprocessor(cfg['screen_preprocessor_configs'], name='screen_preprocessor')
+    action_type_count = cfg['environment_configs']['action_type_count']
+    initial_weights_cache = InitialWeightsCache(cfg['model_cache_dir'], reward_predictor[0], action_type_count,
+                                                reward_predictor_configs)
+    reward_predictor = eval(reward_predictor[0])(action_type_count, 2,
+                                                 initial_weights_cache.get_configs(reward_predictor_configs),
+                                                 name='reward_predictor')
+    model = keras.Model(inputs=screen_input, outputs=reward_predictor(screen_preprocessor(screen_input)))
+    initial_weights_cache.apply(reward_predictor)
+    if weights_file is not None:
+        model.load_weights(weights_file, by_name=True)
+    return model
+
+
+def create_example_episode(screen_shape: Tuple[int, int]) -> Episode:
+    return Episode(np.zeros((*screen_shape, 3), np.uint8), np.zeros(3, np.int32),
+                   np.zeros((), np.bool), np.zeros((*screen_shape, 3), np.uint8))
 
 
 def parse_specs_to_probs_and_ops(specs: Dict, max_len: int) -> List:
@@ -638,7 +674,6 @@ pos_reward = 1
 neg_reward = 0
 with open('configs.yaml') as f:
     cfg = yaml.load(f, Loader=yaml.FullLoader)
-print(cfg)
 collectors = cfg['collectors']
 testers = cfg['testers']
 reset_logs = cfg['reset_logs']
@@ -652,9 +687,20 @@ shuffle_apps = cfg['environment_configs']['shuffle_apps']
 action_prob_coeffs = cfg['action_prob_coeffs']
 
 coordinator_configs['collector_version_start'] = collector_version_start
+coordinator_configs['data_file_dir'] = cfg['data_file_dir']
+coordinator_configs['tester_file_dir'] = cfg['tester_configs']['file_dir']
+coordinator_configs['example_episode'] = create_example_episode(cfg['phone_configs']['screen_shape'])
+coordinator_configs['inference_configs'] = cfg['inference_configs']
+coordinator_configs['inference_configs']['prediction_shape'] = (*cfg['prediction_shape'],
+                                                                 cfg['environment_configs']['action_type_count'])
+coordinator_configs['prediction_model_creator'] = create_prediction_model
 
 readouts.prediction_normalizer = None if prediction_normalizer_name is None else eval(prediction_normalizer_name)
+readouts.numpy_prediction_normalizer = None if prediction_normalizer_name is None else \
+    eval(f'{prediction_normalizer_name}_numpy')
 readouts.action_prob_coeffs = action_prob_coeffs
+readouts.sampler_temperature = cfg['sampler_configs']['temperature']
+readouts.sampler_top_k = cfg['sampler_configs']['top_k']
 
 for clusterer_cfg_name in clusterer_configs:
     if clusterer_cfg_name == 'default':
@@ -675,6 +721,7 @@ tf.disable_v2_behavior()
 os.environ["KMP_AFFINITY"] = "verbose"
 
 if __name__ == '__main__':
+    print(cfg)
     remove_logs(logs_dir, reset_logs)
     collector_creators = [partial(create_agent, i, i, probs_and_ops[1] if len(probs_and_ops) > 1 else '',
                                   False, False, probs_and_ops[0], probs_and_ops[2] if len(probs_and_ops) > 2 else None,
@@ -693,6 +740,10 @@ if __name__ == '__main__':
                                for i, probs_and_ops in enumerate(tester_option_probs_and_ops)]
     learner_creator = partial(create_agent, *2 * (len(collector_creators) + 2 * len(tester_creators),), 'learner',
                               True, False, None, None, weights_file['learner'])
-    coord = ProcessBasedCoordinator(collector_creators, learner_creator, tester_creators,
-                                    tester_learner_creators, cfg['coordinator_configs'])
+    coordinator_backends = {'process': ProcessBasedCoordinator, 'thread': ThreadBasedCoordinator,
+                            'asyncio': AsyncioCoordinator, 'network': NetworkCoordinator}
+    if coordinator_configs['backend'] not in coordinator_backends:
+        raise ValueError(f'unknown coordinator backend {coordinator_configs["backend"]}.')
+    coord = coordinator_backends[coordinator_configs['backend']](collector_creators, learner_creator, tester_creators,
+                                                                 tester_learner_creators, coordinator_configs)
     coord.start()
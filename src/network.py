@@ -0,0 +1,238 @@
+import hashlib
+import hmac
+import os
+import pickle
+import socket
+import socketserver
+import struct
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, List, Optional, Tuple, Union
+
+from parallelism import Thread, QueueItem
+from utils import Config
+
+Address = Tuple[str, int]
+
+frame_header = struct.Struct('>Q')
+challenge_size = 32
+
+
+def send_frame(connection: socket.socket, obj: Any) -> None:
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    connection.sendall(frame_header.pack(len(data)) + data)
+
+
+def receive_exactly(connection: socket.socket, size: int) -> Optional[bytes]:
+    chunks = []
+    while size > 0:
+        chunk = connection.recv(min(size, 1 << 20))
+        if len(chunk) == 0:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+# returns None when the other side closed the connection
+def receive_frame(connection: socket.socket) -> Any:
+    header = receive_exactly(connection, frame_header.size)
+    if header is None:
+        return None
+    data = receive_exactly(connection, frame_header.unpack(header)[0])
+    if data is None:
+        return None
+    return pickle.loads(data)
+
+
+def get_challenge_digest(authkey: bytes, challenge: bytes) -> bytes:
+    return hmac.new(authkey, challenge, hashlib.sha256).digest()
+
+
+# frames are unpickled, so a connection is only received from once the other side has proven that it knows the authkey
+#   of the nodes: it is sent a random challenge and has to answer with its hmac
+def deliver_challenge(connection: socket.socket, authkey: bytes) -> bool:
+    challenge = os.urandom(challenge_size)
+    connection.sendall(challenge)
+    digest = receive_exactly(connection, hashlib.sha256().digest_size)
+    return digest is not None and hmac.compare_digest(digest, get_challenge_digest(authkey, challenge))
+
+
+def answer_challenge(connection: socket.socket, authkey: bytes) -> None:
+    challenge = receive_exactly(connection, challenge_size)
+    if challenge is None:
+        raise ConnectionError('the node closed the connection before its challenge.')
+    connection.sendall(get_challenge_digest(authkey, challenge))
+
+
+# maps the nodes to their addresses and the workers (collectors and then testers, in the order they are created) to
+#   the nodes that run them
+class NodeRegistry:
+    def __init__(self, cfg: Config):
+        self.nodes = cfg['nodes']
+        self.learner_node = cfg['learner_node']
+        self.worker_nodes = cfg['worker_nodes']
+        self.bind_host = cfg['bind_host']
+        authkey = cfg['authkey']
+
+        for node in [self.learner_node, *self.worker_nodes]:
+            if node not in self.nodes:
+                raise ValueError(f'unknown node {node}.')
+        if not authkey:
+            raise ValueError('the nodes need an authkey.')
+        self.authkey = str(authkey).encode()
+
+    def get_address(self, node: str) -> Address:
+        host, port = self.nodes[node].rsplit(':', 1)
+        return host, int(port)
+
+    # the server of a node listens on the port of its address, on bind_host only
+    def get_bind_address(self, node: str) -> Address:
+        return self.bind_host, self.get_address(node)[1]
+
+    def get_worker_node(self, index: int) -> str:
+        if index >= len(self.worker_nodes):
+            raise ValueError(f'no node is assigned to worker {index}.')
+        return self.worker_nodes[index]
+
+    def get_worker_name(self, index: int) -> str:
+        return f'worker_{index}'
+
+
+# receives the frames of all the authenticated connections to this node and passes them to on_frame (from the
+#   connection threads)
+class MessageServer:
+    def __init__(self, address: Address, on_frame: Callable[[Any], None], authkey: bytes):
+        self.address = address
+        self.on_frame = on_frame
+        self.authkey = authkey
+        self.server = None
+
+    def start(self) -> None:
+        on_frame = self.on_frame
+        authkey = self.authkey
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                if not deliver_challenge(self.request, authkey):
+                    print(f'{datetime.now()}: rejected the connection from {self.client_address}, '
+                          f'it failed its challenge.')
+                    return
+                while True:
+                    frame = receive_frame(self.request)
+                    if frame is None:
+                        return
+                    on_frame(frame)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(self.address, Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def get_address(self) -> Address:
+        return self.server.server_address
+
+    def close(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+# a thread on another node. it can only be sent to, and it connects on first use, so it can be pickled into the
+#   processes that send to it
+class RemoteThread(Thread):
+    def __init__(self, address: Address, name: str, channels: List[str], authkey: bytes, connect_timeout: float = 60):
+        self.address = tuple(address)
+        self.name = name
+        self.channels = channels
+        self.authkey = authkey
+        self.connect_timeout = connect_timeout
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['connection'] = None
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def connect(self) -> socket.socket:
+        deadline = time.time() + self.connect_timeout
+        while True:
+            try:
+                connection = socket.create_connection(self.address)
+                break
+            except ConnectionRefusedError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(1)
+        answer_challenge(connection, self.authkey)
+        return connection
+
+    def send(self, frame: Any) -> None:
+        with self.lock:
+            if self.connection is None:
+                self.connection = self.connect()
+            send_frame(self.connection, frame)
+
+    def add_to_run_queue(self, func: Callable, *args, channel: Optional[str] = None) -> None:
+        channel = self.channels[-1] if channel is None else channel
+        if channel not in self.channels:
+            raise ValueError(f'unknown channel {channel}.')
+        self.send(('message', self.name, channel, (func, args, time.time())))
+
+    # frames from one sender arrive in order, so a file sent before a message is complete when the message is run
+    def send_file(self, file_path: str, root: Any, relative_path: str, chunk_size: int = 1 << 22) -> None:
+        with open(file_path, 'rb') as f:
+            offset = 0
+            while True:
+                data = f.read(chunk_size)
+                if offset > 0 and len(data) == 0:
+                    break
+                self.send(('file', root, relative_path, offset, data))
+                offset += len(data)
+
+    def close(self) -> None:
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def run(self) -> None:
+        pass
+
+    def pop_next(self, wait=False, channels: Optional[List[str]] = None) \
+            -> Union[Tuple[Callable, list], Tuple[None, None]]:
+        raise NotImplementedError('remote threads can only be sent to.')
+
+    def pop_ready(self, timeout: Optional[float], channels: Optional[List[str]] = None) -> List[QueueItem]:
+        raise NotImplementedError('remote threads can only be sent to.')
+
+    def get_queue_size(self) -> int:
+        return -1
+
+    def pop_and_run_next(self, *local_args, wait=False) -> None:
+        raise NotImplementedError('remote threads can only be sent to.')
+
+
+# the path of a file sent to root. the relative path comes from the other node, so it may not leave root
+def resolve_file_path(root: str, relative_path: str) -> str:
+    root = os.path.realpath(root)
+    file_path = os.path.realpath(os.path.join(root, relative_path))
+    if os.path.commonpath([root, file_path]) != root or file_path == root:
+        raise ValueError(f'the sent file {relative_path} is outside of {root}.')
+    return file_path
+
+
+# writes the chunks sent by RemoteThread.send_file
+def write_file_chunk(file_path: str, offset: int, data: bytes) -> None:
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb' if offset == 0 else 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
@@ -1,32 +1,243 @@
+import asyncio
 import multiprocessing
+import queue
+import threading
+import time
+import traceback
 from abc import ABC, abstractmethod
+from collections import defaultdict, deque
 from queue import Empty
-from typing import Callable, Optional, Tuple, Union
+from typing import Callable, Optional, Tuple, Union, List, Any
+
+import numpy as np
 
 from utils import Config
 
+QueueItem = Tuple[Callable, tuple, float]
+
 
+# messages are sent on named channels. channels are listed in priority order, and when no channel is given the
+#   last (lowest priority) one is used
 class Thread(ABC):
     @abstractmethod
-    def add_to_run_queue(self, func: Callable, *args) -> None:
+    def add_to_run_queue(self, func: Callable, *args, channel: Optional[str] = None) -> None:
         pass
 
     @abstractmethod
     def run(self) -> None:
         pass
 
+    # this can only be accessed from the thread associated to this object
+    @abstractmethod
+    def pop_next(self, wait=False, channels: Optional[List[str]] = None) \
+            -> Union[Tuple[Callable, list], Tuple[None, None]]:
+        pass
+
+    # blocks until at least one item is ready or timeout passes, then returns every ready item with its enqueue time
+    #   in priority order. only the given channels are received from, the rest stay buffered
+    @abstractmethod
+    def pop_ready(self, timeout: Optional[float], channels: Optional[List[str]] = None) -> List[QueueItem]:
+        pass
+
+    @abstractmethod
+    def get_queue_size(self) -> int:
+        pass
+
     # this can only be accessed from the thread associated to this object
     @abstractmethod
     def pop_and_run_next(self, *local_args, wait=False) -> None:
         pass
 
 
-# one problem with current framework is that each Thread has only 1 queue
-class Process(Thread):
+class QueueStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.wakeups = 0
+        self.dispatched = 0
+        self.latencies = []
+        self.queue_sizes = []
+        self.start_time = time.time()
+
+    def record_wakeup(self, queue_size: int) -> None:
+        self.wakeups += 1
+        self.queue_sizes.append(queue_size)
+
+    def record_dispatch(self, enqueue_time: float) -> None:
+        self.dispatched += 1
+        self.latencies.append(time.time() - enqueue_time)
+
+    def summary(self) -> str:
+        latencies = np.array(self.latencies) if len(self.latencies) > 0 else np.zeros(1)
+        return f'{self.dispatched} functions in {self.wakeups} wake-ups over {time.time() - self.start_time:.0f}s, ' \
+               f'dispatch latency mean {np.mean(latencies):.3f}s, p95 {np.percentile(latencies, 95):.3f}s, ' \
+               f'max {np.max(latencies):.3f}s, max queue size {max(self.queue_sizes, default=0)}'
+
+
+# with an order key, the items of the same key (e.g. the messages of one tester) are popped in the order they arrived
+#   in, whatever their channels, and the other items in priority order
+class ChannelBuffers:
+    def __init__(self, channels: List[str], order_key: Optional[Callable[[QueueItem], Any]] = None):
+        self.channels = channels
+        self.order_key = order_key
+        self.buffers = {channel: deque() for channel in channels}
+        self.arrivals = 0
+
+    def get_channel(self, channel: Optional[str]) -> str:
+        if channel is None:
+            return self.channels[-1]
+        if channel not in self.buffers:
+            raise ValueError(f'unknown channel {channel}.')
+        return channel
+
+    def get_key(self, item: QueueItem) -> Any:
+        return None if self.order_key is None else self.order_key(item)
+
+    # the buffers keep the arrival number of each item next to it
+    def add(self, channel: str, item: QueueItem) -> None:
+        self.buffers[channel].append((self.arrivals, item))
+        self.arrivals += 1
+
+    def has_items(self, channels: Optional[List[str]] = None) -> bool:
+        return any(len(self.buffers[channel]) > 0 for channel in channels or self.channels)
+
+    def get_entries(self, channels: Optional[List[str]] = None) -> List[Tuple[int, QueueItem]]:
+        return [entry for channel in self.channels if channels is None or channel in channels
+                for entry in self.buffers[channel]]
+
+    # the entries of each key are moved to the places of the entries of their key in arrival order
+    def order(self, entries: List[Tuple[int, QueueItem]]) -> List[Tuple[int, QueueItem]]:
+        if self.order_key is None:
+            return entries
+        places = defaultdict(list)
+        for i, (_, item) in enumerate(entries):
+            key = self.order_key(item)
+            if key is not None:
+                places[key].append(i)
+        entries = list(entries)
+        for key_places in places.values():
+            for i, entry in zip(key_places, sorted([entries[i] for i in key_places], key=lambda entry: entry[0])):
+                entries[i] = entry
+        return entries
+
+    def pop(self, channels: Optional[List[str]] = None) -> Optional[QueueItem]:
+        entries = self.order(self.get_entries(channels))
+        if len(entries) == 0:
+            return None
+        arrival, item = entries[0]
+        for buffer in self.buffers.values():
+            for i, entry in enumerate(buffer):
+                if entry[0] == arrival:
+                    del buffer[i]
+                    return item
+
+    def pop_all(self, channels: Optional[List[str]] = None) -> List[QueueItem]:
+        entries = self.order(self.get_entries(channels))
+        for channel in self.channels:
+            if channels is None or channel in channels:
+                self.buffers[channel].clear()
+        return [item for _, item in entries]
+
+    # a matching item is not taken past an earlier item of its key that stays buffered
+    def pop_matching(self, channel: str, predicate: Callable[[QueueItem], bool]) -> List[QueueItem]:
+        first_arrivals = {}
+        if self.order_key is not None:
+            for arrival, item in self.get_entries([other for other in self.channels if other != channel]):
+                key = self.order_key(item)
+                first_arrivals[key] = min(first_arrivals.get(key, arrival), arrival)
+        items = []
+        remaining = deque()
+        for arrival, item in self.buffers[channel]:
+            key = self.get_key(item)
+            if predicate(item) and (key is None or first_arrivals.get(key, arrival) >= arrival):
+                items.append(item)
+            else:
+                remaining.append((arrival, item))
+                first_arrivals[key] = min(first_arrivals.get(key, arrival), arrival)
+        self.buffers[channel] = remaining
+        return items
+
+    def __len__(self):
+        return sum(len(buffer) for buffer in self.buffers.values())
+
+
+# all channels share one queue. the receiving side moves what arrives into per channel buffers, so a control message
+#   never waits behind data messages that are not being received
+class QueueThread(Thread):
+    def __init__(self, queue: Any, channels: List[str]):
+        self.queue = queue
+        self.buffers = ChannelBuffers(channels)
+
+    def add_to_run_queue(self, func: Callable, *args, channel: Optional[str] = None) -> None:
+        self.put(self.buffers.get_channel(channel), (func, args, time.time()))
+
+    # also used to deliver the items that were sent from another node
+    def put(self, channel: str, item: QueueItem) -> None:
+        self.queue.put((channel, item))
+
+    def set_order_key(self, order_key: Optional[Callable[[QueueItem], Any]]) -> None:
+        self.buffers.order_key = order_key
+
+    # moves the arrived messages (at most max_items) to the buffers, waiting up to timeout (forever if None) for the
+    #   first one
+    def receive(self, block: bool, timeout: Optional[float] = None, max_items: Optional[int] = None) -> None:
+        try:
+            channel, item = self.queue.get(block, timeout)
+            self.buffers.add(channel, item)
+            received = 1
+            while max_items is None or received < max_items:
+                channel, item = self.queue.get_nowait()
+                self.buffers.add(channel, item)
+                received += 1
+        except Empty:
+            pass
+
+    def pop_next(self, wait=False, channels: Optional[List[str]] = None) \
+            -> Union[Tuple[Callable, list], Tuple[None, None]]:
+        self.receive(False)
+        while wait and not self.buffers.has_items(channels):
+            self.receive(True)
+        item = self.buffers.pop(channels)
+        if item is None:
+            return None, None
+        return item[0], item[1]
+
+    def pop_ready(self, timeout: Optional[float], channels: Optional[List[str]] = None) -> List[QueueItem]:
+        self.receive(False)
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.buffers.has_items(channels):
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                break
+            self.receive(True, remaining)
+        return self.buffers.pop_all(channels)
+
+    # takes the arrived items of the channel that match the predicate, the rest stay buffered in order. it is called
+    #   often (e.g. after every training batch), so it only receives up to max_items new messages
+    def pop_matching(self, channel: str, predicate: Callable[[QueueItem], bool],
+                     max_items: int = 16) -> List[QueueItem]:
+        self.receive(False, max_items=max_items)
+        return self.buffers.pop_matching(self.buffers.get_channel(channel), predicate)
+
+    def get_queue_size(self) -> int:
+        try:
+            return len(self.buffers) + self.queue.qsize()
+        except NotImplementedError:
+            return len(self.buffers)
+
+    def pop_and_run_next(self, *local_args, wait=False) -> None:
+        func, args = self.pop_next(wait)
+        if func is not None:
+            func(*local_args, *args)
+
+
+class Process(QueueThread):
     def __init__(self, name: Optional[str], main_func: Optional[Callable], *args,
                  cfg: Config, main_process: bool = False):
         type = cfg['type']
         queue_size = cfg['queue_size']
+        channels = cfg['channels']
 
         mp = multiprocessing.get_context(type)
 
@@ -34,25 +245,54 @@ class Process(Thread):
             assert name is None and main_func is None and len(args) == 0
         else:
             self.process = mp.Process(name=name, target=main_func, args=(*args, self))
-        self.queue = mp.Queue(queue_size)
+        super().__init__(mp.Queue(queue_size), channels)
 
-    def add_to_run_queue(self, func: Callable, *args) -> None:
-        self.queue.put((func, args))
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['buffers'] = ChannelBuffers(self.buffers.channels, self.buffers.order_key)
+        return state
 
     def run(self) -> None:
         self.process.start()
 
-    def pop_next(self, wait=False) -> Union[Tuple[Callable, list], Tuple[None, None]]:
-        try:
-            if wait:
-                func, args = self.queue.get()
-            else:
-                func, args = self.queue.get_nowait()
-            return func, args
-        except Empty:
-            return None, None
 
-    def pop_and_run_next(self, *local_args, wait=False) -> None:
-        func, args = self.pop_next(wait)
-        if func is not None:
-            func(*local_args, *args)
+# runs in a thread of the current process, so the workers share the process memory (and the tensorflow graph)
+class LocalThread(QueueThread):
+    def __init__(self, name: Optional[str], main_func: Optional[Callable], *args,
+                 cfg: Config, main_thread: bool = False):
+        queue_size = cfg['queue_size']
+        channels = cfg['channels']
+
+        if main_thread:
+            assert name is None and main_func is None and len(args) == 0
+        else:
+            self.thread = threading.Thread(name=name, target=main_func, args=(*args, self), daemon=True)
+        super().__init__(queue.Queue(queue_size), channels)
+
+    def run(self) -> None:
+        self.thread.start()
+
+
+# runs a coroutine on an event loop (that runs in another thread) instead of in its own thread. the messages still go
+#   through a thread safe queue, since they are sent from other threads and received in the blocking calls that the
+#   coroutine runs in an executor
+class EventLoopTask(QueueThread):
+    def __init__(self, loop: asyncio.AbstractEventLoop, main_coroutine: Callable, *args, cfg: Config):
+        queue_size = cfg['queue_size']
+        channels = cfg['channels']
+
+        self.loop = loop
+        self.main_coroutine = main_coroutine
+        self.args = args
+        self.future = None
+        super().__init__(queue.Queue(queue_size), channels)
+
+    @staticmethod
+    def report_exception(future: Any) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            exception = future.exception()
+            print(''.join(traceback.format_exception(type(exception), exception, exception.__traceback__)))
+
+    def run(self) -> None:
+        self.future = asyncio.run_coroutine_threadsafe(self.main_coroutine(*self.args, self), self.loop)
+        self.future.add_done_callback(self.report_exception)
@@ -8,7 +8,6 @@ import subprocess
 import time
 from typing import Union, Optional, List, Tuple, Callable, Any
 
-import matplotlib.image as mpimg
 from PIL import Image
 import numpy as np
 
@@ -323,6 +322,8 @@ class Phone:
         screenshot_dir = os.path.abspath(f'{self.screenshots_dir}/.tmp-{self.device_name}')
         image_path = f'{screenshot_dir}/scr.png'
         self.adb(f'emu screenrecord screenshot {image_path}')
+        # matplotlib is only imported by the agents that take screenshots
+        import matplotlib.image as mpimg
         res = mpimg.imread(image_path)[:, :, :-1]
         self.true_screen_shape = res.shape[:2]
         res = (res * 255).astype(np.uint8)
@@ -1,3 +1,10 @@
+import copy
+import hashlib
+import os
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
 import tensorflow as tf
 import tensorflow.keras as keras
 
@@ -13,9 +20,21 @@ class ScreenPreprocessor(keras.layers.Layer):
         self.scale_color = cfg['scale_color']
         self.equalize_background = cfg['equalize_background']
         self.contrast_alpha = cfg['contrast_alpha']
+        self.grayscale_weights = np.array([0.2989, 0.5870, 0.1140], np.float32)
 
         super().__init__(**kwargs)
 
+    def check_channels(self, channels: int) -> None:
+        if channels != 1:
+            if self.scale_color:
+                raise AttributeError('cannot scale colored images.')
+            if self.equalize_background:
+                raise AttributeError('cannot equalize background for colored images.')
+            if self.contrast_alpha > 0:
+                raise AttributeError('cannot change contrast of colored images.')
+
+    # the whole batch is normalized at once: the min and max of each screen are computed once, and the screens with
+    #   mostly dark backgrounds are inverted with one broadcasted select
     def call(self, screens, **kwargs):
         screens = tf.cast(screens, tf.float32)
         if self.grayscale:
@@ -25,27 +44,87 @@ class ScreenPreprocessor(keras.layers.Layer):
         if screens_shape[1:3] != self.resize_size:
             screens = tf.image.resize(screens, self.resize_size)
         screens_shape = (None, *[int(d) for d in screens.shape[1:]])
+        self.check_channels(screens_shape[-1])
+        axes = [1, 2, 3]
         if self.scale_color:
-            if screens_shape[-1] != 1:
-                raise AttributeError('cannot scale colored images.')
-            axes = [1, 2, 3]
-            screens = (screens - tf.reduce_min(screens, axis=axes, keep_dims=True)) / \
-                      (tf.reduce_max(screens, axis=axes, keep_dims=True) -
-                       tf.reduce_min(screens, axis=axes, keep_dims=True) + 1e-6)
+            screens_min = tf.reduce_min(screens, axis=axes, keepdims=True)
+            screens_max = tf.reduce_max(screens, axis=axes, keepdims=True)
+            screens = (screens - screens_min) / (screens_max - screens_min + 1e-6)
         if self.equalize_background:
-            if screens_shape[-1] != 1:
-                raise AttributeError('cannot equalize background for colored images.')
             image_size = screens_shape[1] * screens_shape[2]
-            color_sums = tf.reduce_sum(tf.cast(screens < .5, tf.float32), axis=[1, 2, 3])
-            screens, _ = tf.map_fn(lambda elems:
-                                   (tf.where(elems[1] < image_size / 2, 1 - elems[0], elems[0]), elems[1]),
-                                   (screens, color_sums))
+            color_sums = tf.reduce_sum(tf.cast(screens < .5, tf.float32), axis=axes, keepdims=True)
+            screens = tf.where_v2(color_sums < image_size / 2, 1 - screens, screens)
         if self.contrast_alpha > 0:
-            if not screens_shape[-1] != 1:
-                raise AttributeError('cannot change contrast of colored images.')
             screens = tf.sigmoid(self.contrast_alpha * (screens - .5))
         return screens
 
+    # the same preprocessing in numpy, for preprocessing screens offline without a session. the resize is the bilinear
+    #   resize of tf.image.resize in tensorflow 1 (without half pixel centers)
+    def preprocess_numpy(self, screens: np.ndarray) -> np.ndarray:
+        screens = screens.astype(np.float32)
+        if self.grayscale:
+            screens = np.expand_dims(screens @ self.grayscale_weights, axis=-1)
+        screens = screens[:, self.crop_top_left[0]:self.crop_top_left[0] + self.crop_size[0],
+                          self.crop_top_left[1]:self.crop_top_left[1] + self.crop_size[1]]
+        if tuple(screens.shape[1:3]) != tuple(self.resize_size):
+            screens = self.resize_numpy(screens)
+        self.check_channels(screens.shape[-1])
+        axes = (1, 2, 3)
+        if self.scale_color:
+            screens_min = np.min(screens, axis=axes, keepdims=True)
+            screens_max = np.max(screens, axis=axes, keepdims=True)
+            screens = (screens - screens_min) / (screens_max - screens_min + 1e-6)
+        if self.equalize_background:
+            image_size = screens.shape[1] * screens.shape[2]
+            color_sums = np.sum(screens < .5, axis=axes, keepdims=True)
+            screens = np.where(color_sums < image_size / 2, 1 - screens, screens)
+        if self.contrast_alpha > 0:
+            screens = 1 / (1 + np.exp(-self.contrast_alpha * (screens - .5)))
+        return screens.astype(np.float32)
+
+    def resize_numpy(self, screens: np.ndarray) -> np.ndarray:
+        for axis, (in_size, out_size) in enumerate(zip(screens.shape[1:3], self.resize_size), 1):
+            positions = np.arange(out_size) * (in_size / out_size)
+            lower = np.floor(positions).astype(np.int64)
+            upper = np.minimum(lower + 1, in_size - 1)
+            fraction = (positions - lower).astype(np.float32).reshape([-1 if i == axis else 1 for i in range(4)])
+            lower_values = np.take(screens, lower, axis=axis)
+            screens = lower_values + (np.take(screens, upper, axis=axis) - lower_values) * fraction
+        return screens
+
+
+# the initial weights of a reward predictor (e.g. the imagenet weights of the unet encoder) are saved once in cache_dir,
+#   keyed by the predictor and its configs. the processes that find them build the predictor without the pretrained
+#   weights and set the cached ones in one step. predictors that are not used in the graph (e.g. behind a prediction
+#   source) are never built, so they are skipped
+class InitialWeightsCache:
+    def __init__(self, cache_dir: Optional[str], reward_predictor_name: str, action_type_count: int, cfg: Config):
+        self.file_name = None if cache_dir is None else f'{cache_dir}/{reward_predictor_name}_' + \
+            hashlib.md5(repr([action_type_count, cfg]).encode()).hexdigest()[:10] + '.npz'
+
+    def is_cached(self) -> bool:
+        return self.file_name is not None and os.path.exists(self.file_name)
+
+    def get_configs(self, cfg: Config) -> Config:
+        if not self.is_cached() or 'inner_configs' not in cfg.get('screen_encoder_configs', {}):
+            return cfg
+        cfg = copy.deepcopy(cfg)
+        cfg['screen_encoder_configs']['inner_configs']['weights'] = None
+        return cfg
+
+    # the file is replaced at once, so other processes never load a partial one
+    def apply(self, reward_predictor: keras.layers.Layer) -> None:
+        if self.file_name is None or not reward_predictor.built:
+            return
+        if self.is_cached():
+            with np.load(self.file_name) as weights:
+                reward_predictor.set_weights([weights[f'arr_{i}'] for i in range(len(weights.files))])
+        else:
+            Path(os.path.dirname(self.file_name)).mkdir(parents=True, exist_ok=True)
+            with open(f'{self.file_name}.{os.getpid()}', 'wb') as f:
+                np.savez(f, *reward_predictor.get_weights())
+            os.replace(f'{self.file_name}.{os.getpid()}', self.file_name)
+
 
 class EncodingRewardPredictor(keras.layers.Layer):
     def __init__(self, screen_encoder: keras.layers.Layer, reward_decoder: keras.layers.Layer, **kwarg):
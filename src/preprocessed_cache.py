@@ -0,0 +1,81 @@
+import hashlib
+import os
+from typing import Any, Callable, Tuple, Optional
+
+import numpy as np
+
+from episode_catalog import EpisodeCatalog
+from utils import Config, dump_obj, load_obj
+
+
+class PreprocessedCache:
+    preprocessor_keys = ['grayscale', 'crop_top_left', 'crop_size', 'resize_size', 'scale_color',
+                         'equalize_background', 'contrast_alpha']
+
+    def __init__(self, preprocess: Callable[[np.ndarray], np.ndarray], dtype: str, batch_size: int, cfg: Config):
+        self.grayscale = cfg['grayscale']
+        self.resize_size = cfg['resize_size']
+        self.scale_color = cfg['scale_color']
+        self.equalize_background = cfg['equalize_background']
+        self.contrast_alpha = cfg['contrast_alpha']
+
+        if dtype not in ['uint8', 'float16']:
+            raise ValueError(f'unsupported preprocessed cache dtype {dtype}.')
+
+        self.preprocess = preprocess
+        self.batch_size = batch_size
+        self.dtype = np.dtype(dtype)
+        self.key = hashlib.md5(repr([(key, cfg[key]) for key in self.preprocessor_keys] + [dtype])
+                               .encode()).hexdigest()[:10]
+
+    def get_shape(self) -> Tuple[int, int, int]:
+        return (*self.resize_size, 1 if self.grayscale else 3)
+
+    # the preprocessed values are either in [0, 255] or normalized in [0, 1]
+    def get_scale(self) -> float:
+        if self.dtype == np.uint8 and (self.scale_color or self.equalize_background or self.contrast_alpha > 0):
+            return 255.
+        return 1.
+
+    def get_file_name(self, episode_file_name: str) -> str:
+        return f'{episode_file_name}.prep_{self.key}'
+
+    def quantize(self, screens: np.ndarray) -> np.ndarray:
+        screens = screens * self.get_scale()
+        if self.dtype == np.uint8:
+            screens = np.clip(np.round(screens), 0, 255)
+        return screens.astype(self.dtype)
+
+    # the cache is rebuilt when its episode file was rewritten (e.g. a compacted shard or a reused version)
+    @staticmethod
+    def get_source_signature(episode_file: Any) -> str:
+        return EpisodeCatalog.get_signature(episode_file.file_name + episode_file.signature_suffix)
+
+    def load(self, episode_file_name: str, size: int, signature: str) -> Optional[np.ndarray]:
+        file_name = self.get_file_name(episode_file_name)
+        if os.path.exists(file_name + '.info'):
+            meta = load_obj(file_name + '.info')
+            if meta['size'] >= size and meta.get('signature') == signature:
+                return np.memmap(file_name + '.npy', dtype=self.dtype, mode='r', shape=(meta['size'], *meta['shape']))
+        return None
+
+    # the info file is written last, so a partially built cache is never used
+    def build(self, episode_file: Any, size: int) -> np.ndarray:
+        file_name = self.get_file_name(episode_file.file_name)
+        signature = self.get_source_signature(episode_file)
+        cache = np.memmap(file_name + '.npy', dtype=self.dtype, mode='w+', shape=(max(size, 1), *self.get_shape()))
+        for start in range(0, size, self.batch_size):
+            end = min(start + self.batch_size, size)
+            cache[start:end] = self.quantize(self.preprocess(episode_file.read_states(start, end)))
+        cache.flush()
+        del cache
+        dump_obj({'size': size, 'shape': self.get_shape(), 'dtype': self.dtype.name, 'signature': signature},
+                 file_name + '.info')
+        return self.load(episode_file.file_name, size, signature)
+
+    # episode_file can be an EpisodeFile or an EpisodeShard
+    def get(self, episode_file: Any, size: int) -> np.ndarray:
+        cache = self.load(episode_file.file_name, size, self.get_source_signature(episode_file))
+        if cache is None:
+            cache = self.build(episode_file, size)
+        return cache
@@ -1,13 +1,20 @@
-from typing import Callable
+from functools import partial
+from typing import Callable, List, Tuple
 
 import tensorflow as tf
 import numpy as np
-from sklearn.cluster import AgglomerativeClustering
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
+import sampler
 from utils import Config
 
 prediction_normalizer = None
+# the numpy twin of prediction_normalizer, for the readouts that run in python
+numpy_prediction_normalizer = None
 action_prob_coeffs = None
+sampler_temperature = 1
+sampler_top_k = None
 
 
 def index_to_action(index: tf.Tensor, preds: tf.Tensor) -> tf.Tensor:
@@ -19,9 +26,7 @@ def index_to_action(index: tf.Tensor, preds: tf.Tensor) -> tf.Tensor:
 
 
 def most_probable_weighted_policy_user(logits: tf.Tensor) -> tf.Tensor:
-    if prediction_normalizer is None:
-        return tf.argmax(tf.distributions.Multinomial(1.0, logits=logits).sample(), axis=-1)
-    return tf.argmax(tf.distributions.Multinomial(1.0, probs=prediction_normalizer(logits, axis=-1)).sample(), axis=-1)
+    return sampler.sample(logits, prediction_normalizer, sampler_temperature, sampler_top_k)
 
 
 def better_reward_to_action(preds: tf.Tensor) -> tf.Tensor:
@@ -30,6 +35,14 @@ def better_reward_to_action(preds: tf.Tensor) -> tf.Tensor:
     return index_to_action(most_probable_weighted_policy_user(preds_f), preds)
 
 
+# the same for the predictions of one environment in numpy, so the clusterer never runs tensorflow ops
+def better_reward_to_action_numpy(preds: np.ndarray) -> np.ndarray:
+    preds = preds[0] * action_prob_coeffs
+    index = sampler.sample_numpy(sampler.get_numpy_weights(preds.reshape(-1), numpy_prediction_normalizer,
+                                                           sampler_temperature, sampler_top_k))
+    return np.array([np.unravel_index(index, preds.shape)], np.int32)
+
+
 def worse_reward_to_action(preds: tf.Tensor) -> tf.Tensor:
     return better_reward_to_action(-preds + 1)
 
@@ -46,6 +59,32 @@ def random_reward_to_action(preds: tf.Tensor) -> tf.Tensor:
     return better_reward_to_action(tf.ones_like(preds, dtype=tf.float32))
 
 
+# single linkage clustering with a distance threshold (the same clusters as AgglomerativeClustering), as the connected
+#   components of the graph that connects the points closer than the threshold. the points are on a grid, so only the
+#   offsets within the threshold are checked instead of every pair. the grid can have more dimensions than rows and
+#   columns (e.g. action types), and points that differ in them are never connected
+def cluster_connected_components(points: np.ndarray, distance_threshold: float, grid_shape: Tuple[int, ...]) \
+        -> np.ndarray:
+    grid = np.full(grid_shape, -1, np.int64)
+    grid[tuple(points.T)] = np.arange(len(points))
+    radius = int(np.ceil(distance_threshold))
+    offset = np.zeros(points.shape[1], np.int64)
+    sources, targets = [np.zeros(0, np.int64)], [np.zeros(0, np.int64)]
+    for dy in range(radius + 1):
+        for dx in range(-radius, radius + 1):
+            if (dy == 0 and dx <= 0) or dy * dy + dx * dx >= distance_threshold * distance_threshold:
+                continue
+            offset[:2] = dy, dx
+            neighbors = points + offset
+            is_valid = np.all((neighbors >= 0) & (neighbors < grid_shape), axis=1)
+            neighbor_indices = grid[tuple(neighbors[is_valid].T)]
+            sources.append(np.flatnonzero(is_valid)[neighbor_indices >= 0])
+            targets.append(neighbor_indices[neighbor_indices >= 0])
+    sources, targets = np.concatenate(sources), np.concatenate(targets)
+    graph = coo_matrix((np.ones(len(sources), np.bool), (sources, targets)), shape=(len(points), len(points)))
+    return connected_components(graph, directed=False)[1]
+
+
 class PredictionClusterer:
     def __init__(self, cfg: Config):
         self.start_clickable_threshold = cfg['start_clickable_threshold']
@@ -54,6 +93,10 @@ class PredictionClusterer:
         self.speed_steps_per_clickable_threshold_reset = cfg['speed_steps_per_clickable_threshold_reset']
         self.distance_threshold = cfg['distance_threshold']
         self.cluster_count_threshold = cfg['cluster_count_threshold']
+        self.engine = cfg['engine']
+
+        if self.engine not in ['components', 'agglomerative']:
+            raise ValueError(f'unknown clusterer engine {self.engine}.')
 
         self.callbacks = []
         self.steps = 0
@@ -61,55 +104,88 @@ class PredictionClusterer:
     def add_callback(self, callback: Callable) -> None:
         self.callbacks.append(callback)
 
-    def __call__(self, preds: tf.Tensor) -> tf.Tensor:
+    # labels the clusters of all the types at once, the points are (y, x, type)
+    def cluster(self, points: np.ndarray, grid_shape: Tuple[int, int, int]) -> np.ndarray:
+        if self.engine == 'components':
+            return cluster_connected_components(points, self.distance_threshold, grid_shape)
+        # sklearn is slow to import and only this engine needs it
+        from sklearn.cluster import AgglomerativeClustering
+        clusters = np.zeros(len(points), np.int64)
+        cluster_count = 0
+        for type in np.unique(points[:, 2]):
+            is_type = points[:, 2] == type
+            if np.sum(is_type) > 1:
+                clusterer = AgglomerativeClustering(n_clusters=None, distance_threshold=self.distance_threshold,
+                                                    compute_full_tree=True, linkage='single')
+                clusters[is_type] = clusterer.fit_predict(points[is_type, :2]) + cluster_count
+            else:
+                clusters[is_type] = cluster_count
+            cluster_count = np.max(clusters[is_type]) + 1
+        return clusters
+
+    # the types with fewer than two clickable points have no clusters. a type is chosen (weighted by
+    #   action_prob_coeffs) among the ones with valid clusters, then one of its valid clusters, and then a point of
+    #   the cluster by its prediction
+    def __call__(self, preds: tf.Tensor) -> np.ndarray:
         clickable_threshold = self.start_clickable_threshold - self.clickable_threshold_speed * \
                               ((self.steps // self.clickable_threshold_speed_step) %
                                self.speed_steps_per_clickable_threshold_reset)
         self.steps += 1
         if preds.shape[0] > 1:
             raise NotImplementedError('cluster reward is not implemented for batch size > 1.')
-        preds_old = preds
+        preds = np.asarray(preds)[0]
         type_count = preds.shape[-1]
 
-        all_clickables = []
-        all_clusters = []
-        all_valid_clusters_nums = []
-        for type in range(type_count):
-            all_clickables.append([])
-            all_clusters.append([])
-            all_valid_clusters_nums.append([])
-            preds = preds_old[0, :, :, type]
-            clickables = tf.cast(tf.where(preds > clickable_threshold), tf.int32)
-            if len(clickables) == 0 or len(clickables) == 1:
-                all_clickables[-1] = clickables
-                continue
-            clusterer = AgglomerativeClustering(n_clusters=None, distance_threshold=self.distance_threshold,
-                                                compute_full_tree=True, linkage='single')
-            clusters = clusterer.fit_predict(clickables)
-            clusters_nums, clusters_counts = np.unique(clusters, axis=0, return_counts=True)
-            valid_clusters_nums = clusters_nums[clusters_counts >= self.cluster_count_threshold]
-            if len(valid_clusters_nums) == 0:
-                all_clickables[-1] = clickables
-                continue
-            all_clickables[-1] = clickables
-            all_clusters[-1] = clusters
-            all_valid_clusters_nums[-1] = valid_clusters_nums
-
-        if sum(map(len, all_clusters)) == 0:
-            return better_reward_to_action(preds_old)
-
-        valid_types = [i for i in range(len(all_clusters)) if len(all_clusters[i]) > 0]
-        valid_type_coeffs = np.array([action_prob_coeffs[i]
-                                      for i in range(len(all_clusters)) if len(all_clusters[i]) > 0])
-        chosen_type = np.random.choice(valid_types, 1, p=valid_type_coeffs / np.sum(valid_type_coeffs))[0]
-        preds = preds_old[0, :, :, chosen_type]
-        valid_clusters_nums = all_valid_clusters_nums[chosen_type]
-        clickables = all_clickables[chosen_type]
-        clusters = all_clusters[chosen_type]
-        chosen_cluster_num = np.random.choice(valid_clusters_nums, 1)
-        chosen_clickables = tf.boolean_mask(clickables, clusters == chosen_cluster_num)
-        chosen_clickable_i = most_probable_weighted_policy_user(tf.gather_nd(preds, chosen_clickables))
-        chosen_clickable = tf.concat([tf.gather(chosen_clickables, chosen_clickable_i), [chosen_type]], axis=-1)
-        for callback in self.callbacks:
-            callback(all_clickables, all_clusters, all_valid_clusters_nums)
-        return tf.expand_dims(chosen_clickable, axis=0)
+        points = np.argwhere(preds > clickable_threshold)
+        types = points[:, 2]
+        clusters = self.cluster(points, preds.shape)
+        cluster_sizes = np.bincount(clusters)
+        cluster_types = np.zeros(len(cluster_sizes), np.int64)
+        cluster_types[clusters] = types
+        is_valid = (cluster_sizes >= self.cluster_count_threshold) & \
+                   (np.bincount(types, minlength=type_count)[cluster_types] > 1)
+        valid_counts = np.bincount(cluster_types[is_valid], minlength=type_count)
+        if np.sum(valid_counts) == 0:
+            return better_reward_to_action_numpy(np.expand_dims(preds, axis=0))
+
+        chosen_type = sampler.sample_numpy(np.array(action_prob_coeffs[:type_count]) * (valid_counts > 0))
+        chosen_cluster = np.random.choice(np.flatnonzero(is_valid & (cluster_types == chosen_type)))
+        chosen_clickables = points[clusters == chosen_cluster]
+        chosen_clickable = chosen_clickables[sampler.sample_numpy(sampler.get_numpy_weights(
+            preds[chosen_clickables[:, 0], chosen_clickables[:, 1], chosen_type], numpy_prediction_normalizer,
+            sampler_temperature, sampler_top_k))]
+        if len(self.callbacks) > 0:
+            all_clickables = [points[types == type, :2] for type in range(type_count)]
+            all_clusters = [clusters[types == type] if valid_counts[type] > 0 else [] for type in range(type_count)]
+            all_valid_clusters_nums = [np.flatnonzero(is_valid & (cluster_types == type))
+                                       for type in range(type_count)]
+            for callback in self.callbacks:
+                callback(all_clickables, all_clusters, all_valid_clusters_nums)
+        return np.expand_dims(chosen_clickable.astype(np.int32), axis=0)
+
+
+# the readouts that are tensorflow ops can run in the graph, the others (the clusterer) run in python
+def is_graph_native(prediction_to_action: Callable) -> bool:
+    return not isinstance(prediction_to_action, PredictionClusterer)
+
+
+# the readout of each step is sampled in the graph and only that one is run, so python is only called when the
+#   clusterer is chosen
+def combine_prediction_to_actions(prediction_to_actions: List[Callable], probs: List[float]) -> Callable:
+    assert abs(sum(probs) - 1) < 1e-6
+
+    def to_graph_op(prediction_to_action: Callable) -> Callable:
+        if is_graph_native(prediction_to_action):
+            return prediction_to_action
+        return lambda preds: tf.py_function(prediction_to_action, [preds], tf.int32)
+
+    options = [(i, to_graph_op(prediction_to_action))
+               for i, (prediction_to_action, prob) in enumerate(zip(prediction_to_actions, probs)) if prob > 0]
+    if len(options) == 1:
+        return options[0][1]
+
+    def to_actions(preds: tf.Tensor) -> tf.Tensor:
+        chosen = tf.random.categorical(tf.math.log(tf.constant([probs], tf.float32)), 1)[0, 0]
+        return tf.case([(tf.equal(chosen, i), partial(op, preds)) for i, op in options], exclusive=True)
+
+    return to_actions
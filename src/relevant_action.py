@@ -3,7 +3,7 @@ import time
 import time as tm
 import traceback
 from datetime import datetime
-from typing import Tuple, Callable, Any, Optional
+from typing import Tuple, Callable, Any, Iterator, Optional
 
 import numpy as np
 
@@ -78,10 +78,10 @@ class RelevantActionEnvironment(Environment):
             return self.phone.apk_names[(step // self.steps_per_app) % len(self.phone.apk_names)]
         return self.phone.app_names[(step // self.steps_per_app) % len(self.phone.app_names)]
 
-    def start(self):
+    def run_steps(self) -> Iterator[None]:
         while True:
             try:
-                super().start()
+                yield from super().run_steps()
                 break
             # add this in Environment class
             except Exception:
@@ -159,7 +159,7 @@ class RelevantActionEnvironment(Environment):
                self.crop_top_left[0]:self.crop_top_left[0] + self.crop_size[0],
                self.crop_top_left[1]:self.crop_top_left[1] + self.crop_size[1]]
 
-    def are_states_equal(self, s1: np.ndarray, s2: np.ndarray, mask: Optional[np.ndarray]) -> bool:
+    def are_states_equal(self, s1: np.ndarray, s2: np.ndarray, mask: Optional[np.ndarray] = None) -> bool:
         mask = np.expand_dims(self.crop_state(np.ones_like(s1[:, :, 0]) if mask is None else mask), axis=-1)
         return np.linalg.norm(self.crop_state(s1) * mask - self.crop_state(s2) * mask) <= self.global_equality_threshold
 
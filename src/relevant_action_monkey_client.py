@@ -5,10 +5,9 @@ import time
 import socket
 import subprocess
 import traceback
-from typing import Any, Callable, Union, Optional
+from typing import Any, Callable, Iterator, Union, Optional
 
 import numpy as np
-import matplotlib.image as mpimg
 from PIL import Image
 
 from environment import Environment, EnvironmentController
@@ -54,10 +53,10 @@ class RelevantActionMonkeyClient(Environment):
             return res.decode('utf-8')
         return res
 
-    def start(self):
+    def run_steps(self) -> Iterator[None]:
         while True:
             try:
-                super().start()
+                yield from super().run_steps()
                 break
             except Exception:
                 print(f'{datetime.now()}: exception in {self.server_port}:\n{traceback.format_exc()}')
@@ -145,6 +144,8 @@ class RelevantActionMonkeyClient(Environment):
         screenshot_path = f'{screenshot_dir}/{self.adb_port}.png'
         self.adb(f'emu screenrecord screenshot {screenshot_path}')
         print(f'{datetime.now()}: took a screenshot from {self.server_port}')
+        # matplotlib is only imported by the agents that take screenshots
+        import matplotlib.image as mpimg
         res = mpimg.imread(screenshot_path)[:, :, :-1]
         self.true_screen_shape = res.shape[:2]
         res = (res * 255).astype(np.uint8)
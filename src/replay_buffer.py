@@ -0,0 +1,102 @@
+import multiprocessing
+from typing import Any, Optional, Tuple
+
+import numpy as np
+
+from utils import Config
+
+
+# a ring of the latest episodes in a memory mapped file (preferably under /dev/shm) that the collectors push to and the
+#   learner samples from. when it is full, fifo eviction replaces the oldest episode and reservoir eviction keeps a
+#   uniform sample of every pushed episode
+class ReplayBuffer:
+    header_dtype = np.dtype([('pushed', '<i8'), ('size', '<i8')])
+
+    # example is an Episode with the shapes and dtypes of the stored episodes
+    def __init__(self, example: Any, cfg: Config):
+        self.path = cfg['path']
+        self.capacity = cfg['capacity']
+        self.eviction = cfg['eviction']
+
+        if self.eviction not in ['fifo', 'reservoir']:
+            raise ValueError(f'unknown replay buffer eviction {self.eviction}.')
+
+        self.record_dtype = np.dtype([('state', example.state.dtype, example.state.shape),
+                                      ('action', example.action.dtype, example.action.shape),
+                                      ('reward', np.int64),
+                                      ('result', example.result.dtype, example.result.shape)])
+        self.lock = multiprocessing.get_context('spawn').Lock()
+        self.header = None
+        self.records = None
+
+    # the memory maps are opened again in each process
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['header'] = None
+        state['records'] = None
+        return state
+
+    def create(self) -> None:
+        with open(self.path, 'wb') as f:
+            f.truncate(self.header_dtype.itemsize + self.capacity * self.record_dtype.itemsize)
+        self.open()
+
+    def open(self) -> None:
+        if self.header is None:
+            self.header = np.memmap(self.path, dtype=self.header_dtype, mode='r+', shape=(1,))
+            self.records = np.memmap(self.path, dtype=self.record_dtype, mode='r+', offset=self.header_dtype.itemsize,
+                                     shape=(self.capacity,))
+
+    def get_size(self) -> int:
+        self.open()
+        return int(self.header[0]['size'])
+
+    def get_pushed_count(self) -> int:
+        self.open()
+        return int(self.header[0]['pushed'])
+
+    def push(self, episode: Any) -> None:
+        self.open()
+        with self.lock:
+            header = self.header[0]
+            pushed, size = int(header['pushed']), int(header['size'])
+            if size < self.capacity:
+                slot = size
+                header['size'] = size + 1
+            elif self.eviction == 'fifo':
+                slot = pushed % self.capacity
+            else:
+                slot = np.random.randint(pushed + 1)
+            if slot < self.capacity:
+                record = self.records[slot]
+                record['state'] = episode.state
+                record['action'] = episode.action
+                record['reward'] = int(episode.reward)
+                record['result'] = episode.result
+            header['pushed'] = pushed + 1
+
+    # with correct_distributions, every reward class in the buffer is equally likely in the batch. returns None if the
+    #   batch cannot be balanced and strict_correction is set
+    def sample(self, batch_size: int, correct_distributions: bool, strict_correction: bool) \
+            -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]]:
+        self.open()
+        with self.lock:
+            size = int(self.header[0]['size'])
+            if size == 0:
+                return None
+            rewards = np.array(self.records['reward'][:size])
+            classes = np.unique(rewards)
+            if correct_distributions and len(classes) > 1:
+                batch_classes = classes[np.random.randint(len(classes), size=batch_size)]
+                slots = np.zeros(batch_size, dtype=np.int64)
+                for reward in classes:
+                    class_slots = np.flatnonzero(rewards == reward)
+                    is_class = batch_classes == reward
+                    slots[is_class] = class_slots[np.random.randint(len(class_slots), size=np.sum(is_class))]
+            elif correct_distributions and strict_correction:
+                return None
+            else:
+                slots = np.random.randint(size, size=batch_size)
+            batch = self.records[np.sort(slots)]
+        batch = batch[np.random.permutation(batch_size)]
+        return batch['state'], batch['action'], batch['reward'], batch['result']
@@ -0,0 +1,70 @@
+import os
+from datetime import datetime
+from typing import List, Tuple
+
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras as keras
+
+from utils import Config
+
+
+# the cores of a process and the sizes of its tensorflow thread pools. it is applied in the process itself, before its
+#   agent creates the keras session
+class ResourcePlan:
+    def __init__(self, cores: List[int], intra_op_threads: int, inter_op_threads: int):
+        self.cores = cores
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+
+    def __repr__(self) -> str:
+        return f'cores {self.cores}, {self.intra_op_threads} intra op and {self.inter_op_threads} inter op threads'
+
+    def apply(self) -> None:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, self.cores)
+        os.environ['OMP_NUM_THREADS'] = str(self.intra_op_threads)
+        keras.backend.set_session(tf.Session(config=tf.ConfigProto(
+            intra_op_parallelism_threads=self.intra_op_threads, inter_op_parallelism_threads=self.inter_op_threads)))
+
+
+# splits the cores of the host between the learner (which also runs the tester learners) and the worker processes, so
+#   that dozens of processes do not each size their thread pools to all of the cores. the learner gets learner_share of
+#   the cores (or shares all of them with the workers if it is 0) and the workers split the rest evenly, or share them
+#   one core each when there are more workers than cores
+class ResourcePlanner:
+    def __init__(self, worker_count: int, cfg: Config):
+        self.learner_share = cfg['learner_share']
+        self.inter_op_threads = cfg['inter_op_threads']
+        cores = cfg['cores']
+
+        self.worker_count = worker_count
+        self.cores = self.get_available_cores() if cores is None else list(cores)
+
+    @staticmethod
+    def get_available_cores() -> List[int]:
+        if hasattr(os, 'sched_getaffinity'):
+            return sorted(os.sched_getaffinity(0))
+        return list(range(os.cpu_count()))
+
+    def create_plan(self, cores: List[int]) -> ResourcePlan:
+        return ResourcePlan(cores, len(cores), min(self.inter_op_threads, len(cores)))
+
+    def plan(self) -> Tuple[ResourcePlan, List[ResourcePlan]]:
+        if self.worker_count == 0:
+            return self.create_plan(self.cores), []
+        learner_core_count = min(max(int(self.learner_share > 0), int(round(len(self.cores) * self.learner_share))),
+                                 len(self.cores) - 1)
+        learner_cores = self.cores[:learner_core_count] if learner_core_count > 0 else self.cores
+        worker_cores = self.cores[learner_core_count:] if learner_core_count > 0 else self.cores
+        if len(worker_cores) >= self.worker_count:
+            worker_core_groups = [[int(core) for core in group]
+                                  for group in np.array_split(worker_cores, self.worker_count)]
+        else:
+            worker_core_groups = [[worker_cores[i % len(worker_cores)]] for i in range(self.worker_count)]
+        learner_plan = self.create_plan(learner_cores)
+        worker_plans = [self.create_plan(group) for group in worker_core_groups]
+        print(f'{datetime.now()}: planned {len(self.cores)} cores, learner: {learner_plan}, '
+              f'workers: {"; ".join(map(str, worker_plans))}.')
+        return learner_plan, worker_plans
+
@@ -0,0 +1,51 @@
+from typing import Callable, Optional
+
+import numpy as np
+import tensorflow as tf
+
+
+# the readouts sample an index of each row of logits (e.g. the flattened prediction maps of several environments) with
+#   probability proportional to its weight, which is the softmax of the logits, or their prediction_normalizer when it
+#   is given (the same as tf.distributions.Multinomial with logits or probs). a temperature below 1 makes the most
+#   probable indices more likely, and with top_k only the k most probable ones are sampled. the sampling is by inverse
+#   cdf, so no one hot sample is allocated per row
+def get_weights(logits: tf.Tensor, normalizer: Optional[Callable] = None, temperature: float = 1) -> tf.Tensor:
+    if normalizer is None:
+        return tf.exp((logits - tf.reduce_max(logits, axis=-1, keepdims=True)) / temperature)
+    weights = normalizer(logits, axis=-1)
+    return weights if temperature == 1 else tf.pow(weights, 1 / temperature)
+
+
+def sample_by_weights(weights: tf.Tensor) -> tf.Tensor:
+    cumulative_weights = tf.cumsum(weights, axis=-1)
+    thresholds = tf.random.uniform((tf.shape(weights)[0], 1)) * cumulative_weights[:, -1:]
+    indices = tf.searchsorted(cumulative_weights, thresholds, side='right', out_type=tf.int64)[:, 0]
+    return tf.minimum(indices, tf.cast(tf.shape(weights)[1] - 1, tf.int64))
+
+
+def sample(logits: tf.Tensor, normalizer: Optional[Callable] = None, temperature: float = 1,
+           top_k: Optional[int] = None) -> tf.Tensor:
+    weights = get_weights(logits, normalizer, temperature)
+    if top_k is None:
+        return sample_by_weights(weights)
+    top_weights, top_indices = tf.math.top_k(weights, top_k)
+    return tf.cast(tf.gather(top_indices, sample_by_weights(top_weights), batch_dims=1), tf.int64)
+
+
+# the same for one row in numpy, for the readouts that run in python. the normalizer is a numpy one too
+def get_numpy_weights(logits: np.ndarray, normalizer: Optional[Callable] = None, temperature: float = 1,
+                      top_k: Optional[int] = None) -> np.ndarray:
+    if normalizer is None:
+        weights = np.exp((logits - np.max(logits)) / temperature)
+    else:
+        weights = np.asarray(normalizer(logits, axis=-1))
+        weights = weights if temperature == 1 else np.power(weights, 1 / temperature)
+    if top_k is not None and top_k < len(weights):
+        weights = np.where(weights >= np.partition(weights, -top_k)[-top_k], weights, 0)
+    return weights
+
+
+def sample_numpy(weights: np.ndarray) -> int:
+    cumulative_weights = np.cumsum(weights)
+    return min(int(np.searchsorted(cumulative_weights, np.random.uniform(0, cumulative_weights[-1]), side='right')),
+               len(weights) - 1)
@@ -1,20 +1,36 @@
+import asyncio
 import glob
+import hashlib
+import multiprocessing
+import os
+import threading
 import time
 from abc import ABC, abstractmethod
 from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from functools import partial
 from pathlib import Path
-from typing import Any, List, Dict, Tuple, Callable, Optional, Union
+from typing import Any, List, Dict, Tuple, Callable, Iterator, Optional, Union
 
 import numpy as np
 import tensorflow as tf
 import tensorflow.keras as keras
 from tensorflow_core.python.keras.callbacks import LambdaCallback
 
+from distillation import Distiller
 from environment import EnvironmentCallbacks, EnvironmentController, Environment
-from parallelism import Thread, Process
+from episode_catalog import EpisodeCatalog, CatalogRecord
+from episode_sampler import RewardIndex, BalancedSampler
+from inference import InferenceServer, PredictionCache, PredictionCascade, SharedKerasPredictor
+from network import NodeRegistry, MessageServer, RemoteThread, write_file_chunk, resolve_file_path
+from parallelism import Thread, Process, QueueStats, QueueItem, LocalThread, EventLoopTask
+from preprocessed_cache import PreprocessedCache
+from replay_buffer import ReplayBuffer
+from resources import ResourcePlan, ResourcePlanner
+from validation_set import ValidationSet
 from utils import Config, MemVariable, dump_obj, load_obj
+from weight_store import SharedWeightStore, WeightSpecs
 
 
 class Episode:
@@ -28,6 +44,8 @@ class Episode:
 
 
 class EpisodeFile:
+    signature_suffix = '.meta'
+
     def __init__(self, file_name: str, max_size: int, example: Episode, mode: str):
         self.file_name = file_name
 
@@ -42,6 +60,22 @@ class EpisodeFile:
         states = self.states[index]
         return Episode(states[0], self.actions[index], self.rewards[index], states[1])
 
+    def read_states(self, start: int, end: int) -> np.ndarray:
+        return np.array(self.states[start:end, 0])
+
+    @staticmethod
+    def read_catalog_record(file_name: str) -> CatalogRecord:
+        meta = load_obj(file_name + '.meta')
+        size = meta['size']
+        rewards = np.zeros(size, dtype=np.int64)
+        for reward, indices in meta['reward_indices'].items():
+            indices = np.array(indices, dtype=np.int64)
+            rewards[indices[indices < size]] = int(reward)
+        episode_file = EpisodeFile(file_name, meta['max_size'], meta['example'], 'r')
+        action_types = np.array(episode_file.actions[:size, -1], dtype=np.int64)
+        episode_file.close()
+        return size, meta['max_size'], meta['example'], rewards, action_types
+
     def set(self, episode: Episode, index: int) -> None:
         self.states[index][0] = episode.state
         self.states[index][1] = episode.result
@@ -59,6 +93,138 @@ class EpisodeFile:
         del self.rewards
 
 
+# an append-only alternative to EpisodeFile. each record has a small fixed header and the index is appended after the
+#   record is written, so readers only see complete records and can read a shard while it is still being written
+class EpisodeShard:
+    magic = 0x45505344
+    header_dtype = np.dtype([('magic', '<u4'), ('index', '<u4'), ('reward', '<i8')])
+    index_dtype = np.dtype([('offset', '<i8'), ('reward', '<i8'), ('action_type', '<i8')])
+    signature_suffix = '.shard.index'
+
+    def __init__(self, file_name: str, example: Episode, mode: str):
+        self.file_name = file_name
+        self.mode = mode
+        self.record_dtype = np.dtype([('header', self.header_dtype),
+                                      ('state', example.state.dtype, example.state.shape),
+                                      ('result', example.result.dtype, example.result.shape),
+                                      ('action', example.action.dtype, example.action.shape),
+                                      ('reward', example.reward.dtype, example.reward.shape)])
+        self.records = None
+        self.index = None
+
+        if mode == 'w':
+            if self.is_closed(file_name):
+                os.remove(file_name + '.shard.closed')
+            dump_obj({'example': example}, file_name + '.shard.example')
+            self.data_writer = open(file_name + '.shard', 'wb')
+            self.index_writer = open(file_name + '.shard.index', 'wb')
+            self.size = 0
+        elif mode == 'r':
+            self.data_writer = None
+            self.index_writer = None
+            self.size = 0
+            self.refresh()
+        else:
+            raise ValueError(f'unsupported shard mode {mode}.')
+
+    @staticmethod
+    def read_example(file_name: str) -> Episode:
+        return load_obj(file_name + '.shard.example')['example']
+
+    def refresh(self) -> int:
+        size = min(os.path.getsize(self.file_name + '.shard.index') // self.index_dtype.itemsize,
+                   os.path.getsize(self.file_name + '.shard') // self.record_dtype.itemsize)
+        if size != self.size or self.index is None:
+            self.size = size
+            self.index = np.fromfile(self.file_name + '.shard.index', dtype=self.index_dtype, count=size)
+            self.records = None if size == 0 else \
+                np.memmap(self.file_name + '.shard', dtype=self.record_dtype, mode='r', shape=(size,))
+        return self.size
+
+    @staticmethod
+    def read_catalog_record(file_name: str) -> CatalogRecord:
+        index = np.fromfile(file_name + '.shard.index', dtype=EpisodeShard.index_dtype)
+        return len(index), len(index), EpisodeShard.read_example(file_name), index['reward'], index['action_type']
+
+    def get_reward_indices(self) -> Dict[int, np.ndarray]:
+        rewards = self.index['reward']
+        return {int(reward): np.flatnonzero(rewards == reward) for reward in np.unique(rewards)}
+
+    def get(self, index: int) -> Episode:
+        if index >= self.size:
+            self.refresh()
+        if index >= self.size:
+            raise IndexError(f'record {index} is not written in shard {self.file_name} of size {self.size}.')
+        record = self.records[index]
+        if record['header']['magic'] != self.magic or record['header']['index'] != index:
+            raise IOError(f'corrupted record {index} in shard {self.file_name}.')
+        return Episode(record['state'], record['action'], record['reward'], record['result'])
+
+    def read_states(self, start: int, end: int) -> np.ndarray:
+        if self.records is None:
+            return np.zeros((0, *self.record_dtype['state'].shape), dtype=self.record_dtype['state'].base)
+        return np.array(self.records['state'][start:end])
+
+    def set(self, episode: Episode, index: int) -> None:
+        assert self.mode == 'w' and index == self.size
+        record = np.zeros((), dtype=self.record_dtype)
+        record['header'] = (self.magic, index, int(episode.reward))
+        record['state'] = episode.state
+        record['result'] = episode.result
+        record['action'] = episode.action
+        record['reward'] = episode.reward
+        self.data_writer.write(record.tobytes())
+        self.data_writer.flush()
+        self.index_writer.write(np.array((index * self.record_dtype.itemsize, int(episode.reward),
+                                          int(episode.action[-1])), dtype=self.index_dtype).tobytes())
+        self.index_writer.flush()
+        self.size += 1
+
+    def flush(self):
+        if self.data_writer is not None:
+            self.data_writer.flush()
+            self.index_writer.flush()
+
+    # the closed marker tells compact_shards that the writer is done with the shard
+    def close(self):
+        if self.data_writer is not None:
+            self.data_writer.close()
+            self.index_writer.close()
+            self.data_writer = None
+            self.index_writer = None
+            open(self.file_name + '.shard.closed', 'wb').close()
+        self.records = None
+
+    @staticmethod
+    def is_closed(file_name: str) -> bool:
+        return os.path.exists(file_name + '.shard.closed')
+
+
+# rewrites the shards of a version as dense EpisodeFiles with exact sizes, dropping any partially written record.
+#   shards whose writer has not closed them yet are left as they are
+def compact_shards(directory: str, version: int) -> None:
+    for shard_file in glob.glob(f'{directory}/{version}/*.shard'):
+        file_name = shard_file[:-len('.shard')]
+        if not EpisodeShard.is_closed(file_name):
+            print(f'{datetime.now()}: skipping shard {file_name}, it is still being written.')
+            continue
+        example = EpisodeShard.read_example(file_name)
+        shard = EpisodeShard(file_name, example, 'r')
+        if shard.size > 0:
+            episode_file = EpisodeFile(file_name, shard.size, example, 'w+')
+            for index in range(shard.size):
+                episode_file.set(shard.get(index), index)
+            episode_file.flush()
+            episode_file.close()
+        dump_obj({'max_size': shard.size, 'size': shard.size, 'example': example,
+                  'reward_indices': {reward: list(map(int, indices))
+                                     for reward, indices in shard.get_reward_indices().items()}},
+                 file_name + '.meta')
+        shard.close()
+        for suffix in ['.shard', '.shard.index', '.shard.example', '.shard.closed']:
+            os.remove(file_name + suffix)
+
+
 class DataCollectionAgent(EnvironmentCallbacks, EnvironmentController):
     def __init__(self, id: int, model: keras.Model, example_episode: Episode,
                  create_environment: Callable[['DataCollectionAgent'], Environment], cfg: Config):
@@ -66,6 +232,8 @@ class DataCollectionAgent(EnvironmentCallbacks, EnvironmentController):
         self.max_file_size = cfg['max_file_size']
         self.meta_save_frequency = cfg['meta_save_frequency']
         self.file_dir = cfg['file_dir']
+        self.file_format = cfg['file_format']
+        self.weights_file = cfg['weights_file']
         version_start = cfg['version_start']
 
         self.id = id
@@ -75,10 +243,14 @@ class DataCollectionAgent(EnvironmentCallbacks, EnvironmentController):
         self.current_file_version = version_start - 1
         self.current_file = None
         self.current_file_size = 0
-        self.reward_indices = defaultdict(list)
+        self.reward_indices = RewardIndex()
         self.finished_episodes_count = 0
         self.current_episode = MemVariable(lambda: None)
         self.on_file_completed_callbacks = []
+        self.on_episode_stored_callbacks = []
+        self.prediction_source = None
+        self.prediction_cache = None
+        self.prediction_cascade = None
 
         self.reset_file()
         self.environment = create_environment(self)
@@ -86,10 +258,62 @@ class DataCollectionAgent(EnvironmentCallbacks, EnvironmentController):
 
     # the fact that this gets weights means that i cannot set the weights directly from tf (use tf ops for it)
     def update_weights(self, weights: List[tf.Tensor]):
-        self.model.set_weights(weights)
+        if self.prediction_source is None:
+            self.model.set_weights(weights)
+        else:
+            self.prediction_source.update_weights(weights)
+            self.invalidate_predictions()
+
+    # the weights of the prediction source, e.g. a distilled student
+    def get_weights(self) -> List[np.ndarray]:
+        if self.prediction_source is None:
+            return self.model.get_weights()
+        return self.prediction_source.get_weights()
+
+    def load_weights(self, weights_file: str) -> None:
+        if self.prediction_source is None:
+            self.model.load_weights(weights_file, by_name=True)
+        else:
+            self.prediction_source.update_weights(weights_file)
+            self.invalidate_predictions()
+
+    # with a prediction source (e.g. the inference server), the model only turns its predictions into actions
+    def set_prediction_source(self, prediction_source: Any) -> None:
+        self.prediction_source = prediction_source
+
+    # the cache is in front of the prediction source
+    def set_prediction_cache(self, prediction_cache: PredictionCache) -> None:
+        self.prediction_cache = prediction_cache
+
+    # the cascade is in front of the cache
+    def set_prediction_cascade(self, prediction_cascade: PredictionCascade) -> None:
+        self.prediction_cascade = prediction_cascade
+
+    def invalidate_predictions(self) -> None:
+        if self.prediction_cache is not None:
+            self.prediction_cache.invalidate()
+        if self.prediction_cascade is not None:
+            self.prediction_cascade.reset()
+
+    def predict_uncached(self, state: np.ndarray) -> np.ndarray:
+        if self.prediction_cache is None:
+            return self.prediction_source.predict(state)
+        return self.prediction_cache.predict(state, self.prediction_source.predict,
+                                             self.environment.get_current_app())
+
+    def predict(self, state: np.ndarray) -> np.ndarray:
+        if self.prediction_cascade is None:
+            return self.predict_uncached(state)
+        return self.prediction_cascade.predict(state, self.predict_uncached)
+
+    def add_on_file_completed_callbacks(self, callback: Callable[[int, int], None], first: bool = False) -> None:
+        if first:
+            self.on_file_completed_callbacks.insert(0, callback)
+        else:
+            self.on_file_completed_callbacks.append(callback)
 
-    def add_on_file_completed_callbacks(self, callback: Callable[[int, int], None]) -> None:
-        self.on_file_completed_callbacks.append(callback)
+    def add_on_episode_stored_callbacks(self, callback: Callable[[Episode], None]) -> None:
+        self.on_episode_stored_callbacks.append(callback)
 
     def on_file_completed_callback(self) -> None:
         for callback in self.on_file_completed_callbacks:
@@ -98,9 +322,15 @@ class DataCollectionAgent(EnvironmentCallbacks, EnvironmentController):
     def start(self):
         self.environment.start()
 
+    def run_steps(self) -> Iterator[None]:
+        return self.environment.run_steps()
+
     def dump_meta(self):
+        # shards keep their index on disk incrementally
+        if self.file_format == 'shard':
+            return
         dump_obj({'max_size': self.max_file_size, 'size': self.current_file_size,
-                  'example': self.example_episode, 'reward_indices': self.reward_indices},
+                  'example': self.example_episode, 'reward_indices': self.reward_indices.to_dict()},
                  self.current_file.file_name + '.meta')
 
     def reset_file(self, new_file: bool = True):
@@ -115,10 +345,14 @@ class DataCollectionAgent(EnvironmentCallbacks, EnvironmentController):
         if new_file and self.max_file_size > 0:
             self.current_file_version += 1
             self.current_file_size = 0
-            self.reward_indices = defaultdict(list)
+            self.reward_indices = RewardIndex(self.max_file_size)
             Path(f'{self.file_dir}/{self.current_file_version}').mkdir(parents=True, exist_ok=True)
-            self.current_file = EpisodeFile(f'{self.file_dir}/{self.current_file_version}/{self.id}',
-                                            self.max_file_size, self.example_episode, 'w+')
+            if self.file_format == 'shard':
+                self.current_file = EpisodeShard(f'{self.file_dir}/{self.current_file_version}/{self.id}',
+                                                 self.example_episode, 'w')
+            else:
+                self.current_file = EpisodeFile(f'{self.file_dir}/{self.current_file_version}/{self.id}',
+                                                self.max_file_size, self.example_episode, 'w+')
 
     def store_episode(self, episode: Episode) -> None:
         if self.current_file is not None:
@@ -126,9 +360,11 @@ class DataCollectionAgent(EnvironmentCallbacks, EnvironmentController):
                 self.reset_file()
             elif self.current_file_size % self.meta_save_frequency == 0:
                 self.dump_meta()
-            self.reward_indices[int(episode.reward)].append(self.current_file_size)
+            self.reward_indices.append(int(episode.reward), self.current_file_size)
             self.current_file.set(episode, self.current_file_size)
             self.current_file_size += 1
+            for callback in self.on_episode_stored_callbacks:
+                callback(episode)
 
     def should_start_episode(self) -> bool:
         res = self.finished_episodes_count < self.max_episodes
@@ -139,10 +375,18 @@ class DataCollectionAgent(EnvironmentCallbacks, EnvironmentController):
         return res
 
     def get_next_action(self, state: np.ndarray) -> Any:
+        if self.prediction_source is not None:
+            action = self.model.predict_on_batch([np.expand_dims(state, axis=0),
+                                                  np.expand_dims(self.predict(state), axis=0)])[0]
+            if self.prediction_cascade is not None:
+                self.prediction_cascade.on_action(action)
+            return action
         state = np.expand_dims(state, axis=0)
         return self.model.predict_on_batch(state)[0]
 
     def on_episode_start(self, state: np.ndarray) -> None:
+        if self.prediction_cascade is not None:
+            self.prediction_cascade.reset()
         self.current_episode.value = Episode()
         self.current_episode.value.state = state
 
@@ -177,6 +421,7 @@ class TestingAgent(DataCollectionAgent):
         max_episodes = cfg['max_episodes']
         max_file_size = cfg['max_file_size']
         file_dir = cfg['file_dir']
+        file_format = cfg['file_format']
         meta_save_frequency = max_file_size
         version_start = 0
 
@@ -185,6 +430,8 @@ class TestingAgent(DataCollectionAgent):
             'max_file_size': max_file_size if self.learn else 0,
             'meta_save_frequency': meta_save_frequency,
             'file_dir': file_dir,
+            'file_format': file_format,
+            'weights_file': self.weights_file,
             'version_start': version_start
         }
 
@@ -251,7 +498,7 @@ class TestingAgent(DataCollectionAgent):
             print('file')
             for callback in self.weight_reset_callbacks:
                 callback(self.id, self.weights_file)
-            self.model.load_weights(self.weights_file, by_name=True)
+            self.load_weights(self.weights_file)
 
     def on_episode_start(self, state: np.ndarray) -> None:
         if self.learn and self.weight_reset_frequency is not None and self.steps % self.weight_reset_frequency == 0:
@@ -290,7 +537,8 @@ class EarlyStoppingByLossVal(keras.callbacks.Callback):
 
 
 class LearningAgent:
-    def __init__(self, id: int, model: keras.Model, iic_distorter: Optional[Callable], cfg: Config):
+    def __init__(self, id: int, model: keras.Model, iic_distorter: Optional[Callable], cfg: Config,
+                 preprocessed_cache: Optional[PreprocessedCache] = None):
         self.file_dir = cfg['file_dir']
         self.shuffle = cfg['shuffle']
         self.correct_distributions = cfg['correct_distributions']
@@ -301,16 +549,27 @@ class LearningAgent:
         self.data_portion_per_epoch = cfg['data_portion_per_epoch']
         self.save_dir = cfg['save_dir']
         self.validation_dir = cfg['validation_dir']
+        self.use_catalog = cfg['use_catalog']
+        self.incremental_learning = cfg['incremental_learning']
+        self.replay_ratio = cfg['replay_ratio']
+        self.validation_cache = cfg['validation_cache']
 
         self.id = id
         # plot the model (maybe here or where it's created)
         self.model = model
         self.iic_distorter = iic_distorter
+        self.preprocessed_cache = preprocessed_cache
+        self.catalogs = {}
         self.stop_learning_callback = None
         self.is_learning = False
+        self.consumed_versions = set()
+        self.retraining_size = 0
+        self.saved_learning_time = 0
+        self.validation_set = None
+        self.distiller = None
 
     class EpisodeFileManager:
-        def __init__(self, episode_files: List[EpisodeFile]):
+        def __init__(self, episode_files: List[Union[EpisodeFile, EpisodeShard]]):
             self.episode_files = episode_files
 
         def __enter__(self):
@@ -320,9 +579,15 @@ class LearningAgent:
             for episode_file in self.episode_files:
                 episode_file.close()
 
+    # with a distiller, the workers get the weights of its student
     def get_weights(self) -> List[tf.Tensor]:
+        if self.distiller is not None:
+            return self.distiller.get_weights()
         return self.model.get_weights()
 
+    def set_distiller(self, distiller: Distiller) -> None:
+        self.distiller = distiller
+
     @staticmethod
     def get_general_example(ex1: Episode, ex2: Episode) -> Episode:
         assert ex1.state.shape == ex2.state.shape and ex1.action.shape == ex2.action.shape \
@@ -333,32 +598,21 @@ class LearningAgent:
                        ex1.result if ex1.result.itemsize > ex2.result.itemsize else ex2.result)
 
     @staticmethod
-    def merge_reward_indices_list(file_reward_indices_list: List[Dict[np.ndarray, List[int]]]) \
-            -> Dict[np.ndarray, List[int]]:
-        total_reward_indices = defaultdict(list)
+    def flatten_reward_indices_list(file_reward_indices_list: List[Dict[int, Union[List[int], np.ndarray]]]) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        file_ids, rows, rewards = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], \
+                                  [np.zeros(0, dtype=np.int64)]
         for file_i, reward_indices in enumerate(file_reward_indices_list):
-            for reward in reward_indices:
-                total_reward_indices[reward] += [(file_i, index) for index in reward_indices[reward]]
-        return total_reward_indices
-
-    @staticmethod
-    def correct_distribution(total_reward_indices: Dict[np.ndarray, List[int]]) -> Tuple[np.ndarray, int]:
-        # i can do this distribution correction by clicking on slightly different positions,
-        #   or by re-using from previous versions
-        # i can also not have this and instead use weights in keras
-
-        if len(total_reward_indices) == 1:
-            return np.array(-1), -1
-        if len(total_reward_indices) != 2:
-            raise NotImplementedError('Oops. Currently not supporting non-binary rewards.')
-        less_represented_reward = list(total_reward_indices.keys())[np.argmin([len(total_reward_indices[reward])
-                                                                               for reward in total_reward_indices])]
-        augmented_size = abs(np.subtract(*[len(total_reward_indices[reward]) for reward in total_reward_indices]))
-        return less_represented_reward, augmented_size
+            for reward, indices in reward_indices.items():
+                indices = np.asarray(indices, dtype=np.int64)
+                file_ids.append(np.full(len(indices), file_i, dtype=np.int64))
+                rows.append(indices)
+                rewards.append(np.full(len(indices), int(reward), dtype=np.int64))
+        return np.concatenate(file_ids), np.concatenate(rows), np.concatenate(rewards)
 
     @staticmethod
     def read_episode_files(directory: str, version: Union[int, List[int]]) -> \
-            Tuple[List[EpisodeFile], List[int], List[Dict[np.ndarray, List[int]]], Episode]:
+            Tuple[List[Union[EpisodeFile, EpisodeShard]], List[int], List[Dict[np.ndarray, List[int]]], Episode]:
         if not isinstance(version, list):
             version = [version]
 
@@ -376,138 +630,313 @@ class LearningAgent:
             episode_files.append(EpisodeFile(meta_file[:-5], meta['max_size'], meta['example'], 'r'))
             file_sizes.append(meta['size'])
             file_reward_indices_list.append(meta['reward_indices'])
+        shard_files = []
+        for v in version:
+            shard_files += glob.glob(f'{directory}/{v}/*.shard')
+        for shard_file in shard_files:
+            file_name = shard_file[:-len('.shard')]
+            example = EpisodeShard.read_example(file_name)
+            example_episode = example if example_episode is None else \
+                LearningAgent.get_general_example(example_episode, example)
+            shard = EpisodeShard(file_name, example, 'r')
+            episode_files.append(shard)
+            file_sizes.append(shard.size)
+            file_reward_indices_list.append(shard.get_reward_indices())
 
         return episode_files, file_sizes, file_reward_indices_list, example_episode
 
-    def create_training_data(self, directory: str, version: Union[int, List[int]]) -> Tuple[Optional[Callable], int]:
-        episode_files, file_sizes, file_reward_indices_list, example_episode = self.read_episode_files(directory,
-                                                                                                       version)
+    def read_catalog(self, directory: str, version: Union[int, List[int]]) -> \
+            Tuple[List[Union[EpisodeFile, EpisodeShard]], List[int], Tuple[np.ndarray, np.ndarray, np.ndarray],
+                  Episode]:
+        if not isinstance(version, list):
+            version = [version]
+        if directory not in self.catalogs:
+            self.catalogs[directory] = EpisodeCatalog(directory, {
+                'memmap': (EpisodeFile.signature_suffix, EpisodeFile.read_catalog_record),
+                'shard': (EpisodeShard.signature_suffix, EpisodeShard.read_catalog_record)})
+        entries, positions = self.catalogs[directory].query(version)
+
+        example_episode = None
+        episode_files = []
+        file_sizes = []
+        for file_name, file_format, size, max_size, example in entries:
+            example_episode = example if example_episode is None else \
+                self.get_general_example(example_episode, example)
+            if file_format == 'shard':
+                episode_files.append(EpisodeShard(file_name, example, 'r'))
+            else:
+                episode_files.append(EpisodeFile(file_name, max_size, example, 'r'))
+            file_sizes.append(size)
+
+        return episode_files, file_sizes, (positions['file'], positions['row'], positions['reward']), example_episode
+
+    # builds the preprocessed cache of a completed file, so it is ready when its version is learned
+    def preprocess_file(self, file_name: str) -> None:
+        if self.preprocessed_cache is None:
+            return
+        if os.path.exists(file_name + '.shard'):
+            episode_file = EpisodeShard(file_name, EpisodeShard.read_example(file_name), 'r')
+            size = episode_file.size
+        elif os.path.exists(file_name + '.meta'):
+            meta = load_obj(file_name + '.meta')
+            episode_file = EpisodeFile(file_name, meta['max_size'], meta['example'], 'r')
+            size = meta['size']
+        else:
+            return
+        self.preprocessed_cache.get(episode_file, size)
+        episode_file.close()
+
+    @staticmethod
+    def get_file_version(episode_file: Union[EpisodeFile, EpisodeShard]) -> int:
+        return int(os.path.basename(os.path.dirname(episode_file.file_name)))
+
+    # samples the episodes of the new versions and at most replay_ratio times as many episodes of the other versions,
+    #   with each group weighted to its share of the epoch
+    def get_incremental_sampling(self, episode_files: List[Union[EpisodeFile, EpisodeShard]], file_ids: np.ndarray,
+                                 new_versions: List[int]) -> Tuple[np.ndarray, int]:
+        file_versions = np.array([self.get_file_version(episode_file) for episode_file in episode_files],
+                                 dtype=np.int64)
+        is_new = np.isin(file_versions[file_ids], new_versions)
+        new_count = int(np.sum(is_new))
+        replay_count = min(len(is_new) - new_count, int(new_count * self.replay_ratio))
+        weights = np.where(is_new, 1 / max(new_count, 1), replay_count / max(len(is_new) - new_count, 1) /
+                           max(new_count, 1))
+        return weights, new_count + replay_count
+
+    # with new_versions, only those versions are fully trained on and the rest are replayed (see incremental_learning)
+    def create_training_data(self, directory: str, version: Union[int, List[int]],
+                             new_versions: Optional[List[int]] = None) -> Tuple[Optional[Callable], int]:
+        if self.use_catalog:
+            episode_files, file_sizes, (file_ids, rows, rewards), example_episode = \
+                self.read_catalog(directory, version)
+        else:
+            episode_files, file_sizes, file_reward_indices_list, example_episode = \
+                self.read_episode_files(directory, version)
+            file_ids, rows, rewards = self.flatten_reward_indices_list(file_reward_indices_list)
 
         if len(episode_files) == 0:
             return None, 0
 
-        total_reward_indices = self.merge_reward_indices_list(file_reward_indices_list)
-        if self.correct_distributions:
-            less_represented_reward, augmented_size = self.correct_distribution(total_reward_indices)
-            more_represented_reward = [x for x in list(total_reward_indices.keys()) if x != less_represented_reward][0]
+        if self.preprocessed_cache is not None:
+            preprocessed_states = [self.preprocessed_cache.get(episode_file, size)
+                                   for episode_file, size in zip(episode_files, file_sizes)]
+            state_shape = self.preprocessed_cache.get_shape()
+            state_dtype = self.preprocessed_cache.dtype
         else:
-            augmented_size = 0
+            preprocessed_states = None
+            state_shape = example_episode.state.shape
+            state_dtype = example_episode.state.dtype
 
-        if augmented_size == -1:
-            if self.strict_correction:
+        # i can do this distribution correction by clicking on slightly different positions,
+        #   or by re-using from previous versions
+        # i can also not have this and instead use weights in keras
+        sampler = BalancedSampler(file_ids, rows, rewards, self.correct_distributions, self.augmenting_correction,
+                                  self.shuffle)
+        if self.correct_distributions and not sampler.is_balanceable() and self.strict_correction:
+            return None, 0
+        self.retraining_size = sampler.get_size()
+        if new_versions is not None:
+            weights, size = self.get_incremental_sampling(episode_files, file_ids, new_versions)
+            if size == 0:
                 return None, 0
-            augmented_size = 0
-
-        total_size = sum(file_sizes)
-        if self.augmenting_correction:
-            training_size = total_size + augmented_size
-        else:
-            training_size = total_size - augmented_size
-
-        if self.correct_distributions and augmented_size != 0:
-            poses1 = np.random.choice(np.array(total_reward_indices[more_represented_reward], dtype='int, int'),
-                                      training_size // 2, replace=False)
-            inds = np.array(total_reward_indices[less_represented_reward], dtype='int, int')
-            rem_size = training_size // 2
-            arrs = []
-            while rem_size >= len(inds):
-                arrs.append(inds)
-                rem_size -= len(inds)
-            if rem_size > 0:
-                arrs.append(np.random.choice(inds, rem_size, replace=False))
-            poses2 = np.concatenate(arrs)
-            positions = np.concatenate([poses1, poses2])
-        else:
-            positions = np.concatenate([np.array(inds, dtype='int, int') for inds in total_reward_indices.values()])
-        positions_order = np.random.permutation(training_size) if self.shuffle else np.arange(training_size)
-        positions = positions[positions_order]
+            sampler = BalancedSampler(file_ids, rows, rewards, self.correct_distributions,
+                                      self.augmenting_correction, self.shuffle, weights, size)
+        training_size = sampler.get_size()
+        if training_size == 0:
+            return None, 0
 
         def generator() -> Tuple[Dict[str, np.ndarray], np.ndarray]:
             # if epochs is a lot more than 1, then i should generate a dataset in file instead of this ad hoc method
             current_positions_i = 0
+            positions_file_ids, positions_rows = sampler.sample()
             with self.EpisodeFileManager(episode_files):
                 while True:
                     batch_size = min(self.batch_size, training_size - current_positions_i)
                     if batch_size < self.batch_size:
                         current_positions_i = 0
                         batch_size = self.batch_size
+                        positions_file_ids, positions_rows = sampler.sample()
 
-                    x = {'state': np.zeros((batch_size, *example_episode.state.shape),
-                                           dtype=example_episode.state.dtype),
-                         'action': np.zeros((batch_size, *example_episode.action.shape),
-                                            dtype=example_episode.action.dtype),
-                         'result': np.zeros((batch_size, *example_episode.result.shape),
-                                            dtype=example_episode.result.dtype)}
-                    y = np.zeros((batch_size, 1), dtype=np.int32)
-                    if self.iic_distorter is not None:
-                        x['state2'] = x['state'].copy()
-                        x['action2'] = x['action'].copy()
-                        x['result2'] = x['result'].copy()
-                        y2 = np.zeros((batch_size, 1), dtype=np.int32)
-
+                    x, y = self.create_batch(batch_size, state_shape, state_dtype, example_episode)
                     for i in range(batch_size):
-                        position = positions[(current_positions_i + i) % training_size]
-                        file_i = position[0]
-                        data_i = position[1]
+                        file_i = positions_file_ids[(current_positions_i + i) % training_size]
+                        data_i = positions_rows[(current_positions_i + i) % training_size]
                         episode = episode_files[file_i].get(data_i)
-                        x['state'][i] = episode.state
-                        x['action'][i] = episode.action
-                        x['result'][i] = episode.result
-                        y[i][0] = episode.reward
-                        if self.iic_distorter is not None:
-                            episode2, mask, mask2 = self.iic_distorter(episode)
-                            x['state2'][i] = episode2.state
-                            x['action2'][i] = episode2.action
-                            x['result2'][i] = episode2.result
-                            if 'iic_mask' not in x:
-                                x['iic_mask'] = np.zeros((batch_size, *mask.shape), dtype=np.float32)
-                                x['iic_mask2'] = np.zeros((batch_size, *mask.shape), dtype=np.float32)
-                            x['iic_mask'][i] = mask
-                            x['iic_mask2'][i] = mask2
-                            y2[i][0] = episode2.reward
-
-                    if self.iic_distorter is None:
-                        yield x, y
-                    else:
-                        yield x, (y, y2)
+                        self.set_batch_item(x, y, i, episode, episode.state if preprocessed_states is None else
+                                            preprocessed_states[file_i][data_i])
+                    self.distort_batch(x, y)
+
+                    yield x, y
 
                     current_positions_i = (current_positions_i + self.batch_size) % training_size
 
         return generator, max(training_size, self.batch_size)
 
+    def create_batch(self, batch_size: int, state_shape: Tuple[int, ...], state_dtype: np.dtype,
+                     example_episode: Episode) -> Tuple[Dict[str, np.ndarray], Any]:
+        x = {'state': np.zeros((batch_size, *state_shape), dtype=state_dtype),
+             'action': np.zeros((batch_size, *example_episode.action.shape), dtype=example_episode.action.dtype),
+             'result': np.zeros((batch_size, *example_episode.result.shape), dtype=example_episode.result.dtype)}
+        y = np.zeros((batch_size, 1), dtype=np.int32)
+        if self.iic_distorter is None:
+            return x, y
+        x['state2'] = x['state'].copy()
+        x['action2'] = x['action'].copy()
+        x['result2'] = x['result'].copy()
+        x['iic_mask'] = np.zeros((batch_size, *self.iic_distorter.mask_shape), dtype=np.float32)
+        x['iic_mask2'] = np.zeros((batch_size, *self.iic_distorter.mask_shape), dtype=np.float32)
+        return x, (y, np.zeros((batch_size, 1), dtype=np.int32))
+
+    # state is either the episode state or its preprocessed version
+    def set_batch_item(self, x: Dict[str, np.ndarray], y: Any, i: int, episode: Episode, state: np.ndarray) -> None:
+        x['state'][i] = state
+        x['action'][i] = episode.action
+        x['result'][i] = episode.result
+        if self.iic_distorter is None:
+            y[i][0] = episode.reward
+        else:
+            y[0][i][0] = episode.reward
+
+    # the iic distortions are applied to the whole batch once its items are set
+    def distort_batch(self, x: Dict[str, np.ndarray], y: Any) -> None:
+        if self.iic_distorter is None:
+            return
+        self.iic_distorter(x['state'], x['action'], x['state2'], x['action2'], x['iic_mask'], x['iic_mask2'])
+        x['result2'][:] = x['result']
+        y[1][:] = y[0]
+
+    def sample_replay_batch(self, replay_buffer: ReplayBuffer, correct_distributions: bool) \
+            -> Optional[Tuple[Dict[str, np.ndarray], Any]]:
+        batch = replay_buffer.sample(self.batch_size, correct_distributions, self.strict_correction)
+        if batch is None:
+            return None
+        states, actions, rewards, results = batch
+        preprocessed_states = states if self.preprocessed_cache is None else \
+            self.preprocessed_cache.quantize(self.preprocessed_cache.preprocess(states))
+        x, y = self.create_batch(self.batch_size, preprocessed_states.shape[1:], preprocessed_states.dtype,
+                                 Episode(states[0], actions[0], rewards[0], results[0]))
+        for i in range(self.batch_size):
+            self.set_batch_item(x, y, i, Episode(states[i], actions[i], rewards[i], results[i]),
+                                preprocessed_states[i])
+        self.distort_batch(x, y)
+        return x, y
+
+    # trains on mini-batches sampled from the replay buffer and returns the mean loss, or None if the buffer cannot
+    #   provide a batch
+    def learn_from_replay_buffer(self, replay_buffer: ReplayBuffer, steps: int) -> Optional[float]:
+        losses = []
+        for _ in range(steps):
+            batch = self.sample_replay_batch(replay_buffer, self.correct_distributions)
+            if batch is None:
+                break
+            loss = self.model.train_on_batch(*batch)
+            losses.append(loss[0] if isinstance(loss, list) else loss)
+        return None if len(losses) == 0 else float(np.mean(losses))
+
+    # the replay path has no epochs, so whenever its weights are synced the learner distills its student (whose weights
+    #   are the ones synced), validates its weights on every version of the validation directory and saves them as a
+    #   checkpoint
+    def on_replay_sync(self, replay_buffer: ReplayBuffer, steps: int, loss: float) -> None:
+        if self.distiller is not None:
+            # the student only has to match the teacher, so its states are sampled without correcting the classes
+            self.distiller.distill(iter(partial(self.sample_replay_batch, replay_buffer, False), None),
+                                   f'replay_{steps}')
+        checkpoint_name = f'replay_{steps}-loss_{loss:.2f}'
+        if self.validation_dir is not None:
+            version = sorted(int(name) for name in os.listdir(self.validation_dir) if name.isdigit())
+            validation_set = self.get_validation_set(self.validation_dir, version)
+            if validation_set is None:
+                print(f'{datetime.now()}: In learner {self.id}, the validation versions {version} '
+                      f'are not expressive enough to validate from.')
+            else:
+                val_loss = self.model.evaluate(validation_set.get_data(), steps=validation_set.get_steps())
+                val_loss = val_loss[0] if isinstance(val_loss, list) else val_loss
+                print(f'{datetime.now()}: learner {self.id} validation loss after {steps} replay steps: '
+                      f'{val_loss:.4f}.')
+                checkpoint_name += f'-val-loss_{val_loss:.2f}'
+        if self.save_dir is not None:
+            self.model.save_weights(f'{self.save_dir}/{checkpoint_name}.hdf5')
+
+    # estimates the time that retraining the whole window would have taken from the time per step of this request
+    def report_saved_time(self, learning_time: float, steps_per_epoch: int, retraining_steps_per_epoch: int) -> None:
+        saved_time = learning_time / max(steps_per_epoch, 1) * max(retraining_steps_per_epoch - steps_per_epoch, 0)
+        self.saved_learning_time += saved_time
+        print(f'{datetime.now()}: learner {self.id} trained {steps_per_epoch} of {retraining_steps_per_epoch} '
+              f'steps per epoch in {learning_time:.1f}s, saving about {saved_time:.1f}s '
+              f'({self.saved_learning_time:.1f}s in total).')
+
     def stop_if_learning(self, callback: Callable) -> None:
         if self.is_learning:
             self.stop_learning_callback = callback
 
-    def evaluate(self, checkpoints_dir: str, version: Union[int, List[int]]) -> None:
-        for checkpoint in glob.glob(f'{checkpoints_dir}/*.hdf5'):
-            validation_generator, validation_data_size = self.create_training_data(self.validation_dir, version)
-            validation_data = validation_generator()
-            validation_steps = int(validation_data_size / self.batch_size)
+    # the latest validation set is kept, so the checkpoints and the epochs of a version set share it
+    def get_validation_set(self, directory: str, version: Union[int, List[int]]) -> Optional[ValidationSet]:
+        if not isinstance(version, list):
+            version = [version]
+        key = (directory, tuple(version))
+        if self.validation_set is None or self.validation_set[0] != key:
+            file_name = None
+            if self.validation_cache == 'memmap':
+                file_signatures = sorted((path, EpisodeCatalog.get_signature(path))
+                                         for v in version for path in glob.glob(f'{directory}/{v}/*')
+                                         if '.prep_' not in path)
+                file_name = f'{directory}/validation_' + \
+                            hashlib.md5(repr([self.batch_size, file_signatures]).encode()).hexdigest()[:10]
+            elif self.validation_cache != 'memory':
+                raise ValueError(f'unknown validation cache {self.validation_cache}.')
+            if file_name is not None and os.path.exists(file_name + '.info'):
+                validation_set = ValidationSet(None, load_obj(file_name + '.info')['steps'] * self.batch_size,
+                                               self.batch_size, file_name)
+            else:
+                generator, size = self.create_training_data(directory, version)
+                validation_set = None if generator is None else \
+                    ValidationSet(generator, size, self.batch_size, file_name)
+            self.validation_set = key, validation_set
+        return self.validation_set[1]
+
+    def evaluate(self, checkpoints_dir: str, version: Union[int, List[int]],
+                 checkpoints: Optional[List[str]] = None) -> List[Tuple[str, Any]]:
+        validation_set = self.get_validation_set(self.validation_dir, version)
+        if validation_set is None:
+            print(f'{datetime.now()}: In learner {self.id}, the experience version {version} '
+                  f'is not expressive enough to validate from.')
+            return []
+        results = []
+        for checkpoint in sorted(glob.glob(f'{checkpoints_dir}/*.hdf5')) if checkpoints is None else checkpoints:
             self.model.load_weights(checkpoint, by_name=True)
-            loss = self.model.evaluate(validation_data, steps=validation_steps)
+            loss = self.model.evaluate(validation_set.get_data(), steps=validation_set.get_steps())
             print(f'eval res for {checkpoint}: {loss}')
+            results.append((checkpoint, loss))
+        return results
 
+    # the versions learned from since the weights were last reset are not trained on again
+    def reset_consumed_versions(self) -> None:
+        self.consumed_versions = set()
 
     # add logs
     def learn(self, version: Union[int, List[int]], loss_threshold: int = None,
               batch_end_callback: Callable = None) -> None:
-        generator, data_size = self.create_training_data(self.file_dir, version)
-        if self.validation_dir is not None:
-            validation_generator, validation_data_size = self.create_training_data(self.validation_dir, version)
-        else:
-            validation_generator = None
-            validation_data_size = 0
-        if generator is None or (self.validation_dir is not None and validation_generator is None):
+        new_versions = None
+        if self.incremental_learning:
+            new_versions = [v for v in (version if isinstance(version, list) else [version])
+                            if v not in self.consumed_versions]
+            if len(new_versions) == 0:
+                print(f'{datetime.now()}: In learner {self.id}, the experience version {version} is already learned.')
+                return
+        generator, data_size = self.create_training_data(self.file_dir, version, new_versions)
+        retraining_size = self.retraining_size
+        validation_set = None if self.validation_dir is None else \
+            self.get_validation_set(self.validation_dir, version)
+        if generator is None or (self.validation_dir is not None and validation_set is None):
             print(f'{datetime.now()}: In learner {self.id}, the experience version {version} '
                   f'is not expressive enough to learn/validate from.')
         else:
             print(f'{datetime.now()}: starting learning for experience version {version} in learner {self.id}')
             data = generator()
-            validation_data = None if validation_generator is None else validation_generator()
+            validation_data = None if validation_set is None else validation_set.get_data()
             data_size = int(data_size * self.data_portion_per_epoch)
             steps_per_epoch = int(data_size * self.epochs_per_version / self.batch_size / int(self.epochs_per_version))
-            validation_steps = int(validation_data_size / self.batch_size)
+            validation_steps = 0 if validation_set is None else validation_set.get_steps()
 
             lambda_callback = LambdaCallback(on_batch_end=lambda epoch, logs: print())
             callbacks = [lambda_callback]
@@ -526,10 +955,18 @@ class LearningAgent:
 
             self.stop_learning_callback = None
             self.is_learning = True
+            start_time = time.time()
             self.model.fit(data, validation_data=validation_data, validation_steps=validation_steps,
                            epochs=int(self.epochs_per_version), steps_per_epoch=steps_per_epoch,
                            callbacks=callbacks)
             self.is_learning = False
+            if self.incremental_learning:
+                self.consumed_versions.update(new_versions)
+                self.report_saved_time(time.time() - start_time, steps_per_epoch,
+                                       int(max(retraining_size, self.batch_size) * self.data_portion_per_epoch /
+                                           self.batch_size))
+            if self.distiller is not None:
+                self.distiller.distill(data, version)
             if self.stop_learning_callback is not None:
                 self.stop_learning_callback()
                 self.stop_learning_callback = None
@@ -537,12 +974,25 @@ class LearningAgent:
             del data
 
 
+# runs in the checkpoint evaluation processes
+def evaluate_checkpoints(learner_creator: Callable[[], LearningAgent], checkpoints_dir: str, version: List[int],
+                         checkpoints: List[str]) -> List[Tuple[str, Any]]:
+    return learner_creator().evaluate(checkpoints_dir, version, checkpoints)
+
+
 class ThreadLocals:
     def __init__(self):
         self.thread = None
         self.collector = None
         self.new_weight = None
         self.new_tester_weight = None
+        self.weight_store = None
+        self.tester_weight_store = None
+        self.weight_version = -1
+        self.tester_weight_version = -1
+        self.weight_specs = None
+        self.is_tester = False
+        self.learning_done_callback = None
 
     def pop_and_run_next(self, *local_args, wait=False) -> None:
         self.thread.pop_and_run_next(*local_args, wait=wait)
@@ -556,9 +1006,20 @@ class Coordinator(ABC, EnvironmentCallbacks):
         self.collector_version_start = cfg['collector_version_start']
         self.train = cfg['train']
         self.evaluate_dir = cfg['evaluate_dir']
+        self.evaluation_workers = cfg['evaluation_workers']
         self.pre_training = cfg['pre_training']
         self.collect_before_pre_training = cfg['collect_before_pre_training']
         self.sync_weight = cfg['sync_weight']
+        self.weight_store_dir = cfg['weight_store_dir']
+        self.dispatch_timeout = cfg['dispatch_timeout']
+        self.dispatch_stats_frequency = cfg['dispatch_stats_frequency']
+        self.replay_buffer_configs = cfg['replay_buffer_configs']
+        self.replay_steps_per_dispatch = self.replay_buffer_configs['steps_per_dispatch']
+        self.replay_sync_frequency = self.replay_buffer_configs['sync_frequency']
+        self.replay_log_frequency = self.replay_buffer_configs['log_frequency']
+        self.inference_configs = cfg['inference_configs']
+        example_episode = cfg['example_episode']
+        prediction_model_creator = cfg['prediction_model_creator']
 
         self.collector_creators = collector_creators
         self.learner_creator = learner_creator
@@ -569,15 +1030,29 @@ class Coordinator(ABC, EnvironmentCallbacks):
         self.tester_learner_creators = tester_learner_creators
 
         self.learner = None
-        self.learner_thread_run_queue = deque()
         self.tester_learners = []
         self.file_completions = defaultdict(list)
         self.environment_completion_count = 0
-        self.is_tester = None
         self.weight_reset_requested = []
         self.tester_reset_weight_file = []
         self.tester_in_learning = []
-        self.learning_done_callback = None
+        self.learner_weight_store = None
+        self.tester_weight_stores = {}
+        self.dispatch_stats = QueueStats()
+        self.replay_buffer = None if self.replay_buffer_configs['path'] is None else \
+            ReplayBuffer(example_episode, self.replay_buffer_configs)
+        self.replay_steps = 0
+        self.replay_losses = []
+        self.replay_stalled_at = None
+        if self.inference_configs['mode'] not in ['graph', 'server', 'tflite', 'shared']:
+            raise ValueError(f'unknown inference mode {self.inference_configs["mode"]}.')
+        if self.inference_configs['mode'] != 'graph' and self.weight_store_dir is not None:
+            raise ValueError(f'the weight store cannot be used with the {self.inference_configs["mode"]} inference.')
+        self.inference_server = None
+        if self.inference_configs['mode'] == 'server':
+            self.inference_server = InferenceServer(prediction_model_creator,
+                                                    len(self.collector_creators) + len(self.tester_creators),
+                                                    example_episode.state, self.inference_configs)
 
         self.learner_thread = None
         self.collector_threads = []
@@ -595,24 +1070,56 @@ class Coordinator(ABC, EnvironmentCallbacks):
     def get_main_thread(self) -> Thread:
         pass
 
-    def start_collector(self, collector_creator: Callable[[], DataCollectionAgent], thread: Thread) -> None:
-        collector = collector_creator()
-        self.is_tester = isinstance(collector, TestingAgent)
-        if self.is_tester:
-            self.learning_done_callback = collector.set_learning_request_callback(self.on_tester_learning_request)
+    def create_agent(self, creator: Callable[[], Any]) -> Any:
+        return creator()
+
+    # the collectors share a model on the inference server if they start with the same weights, and each tester has its
+    #   own
+    @staticmethod
+    def get_prediction_group(collector: DataCollectionAgent) -> str:
+        if isinstance(collector, TestingAgent):
+            return f'tester_{collector.id}'
+        return f'collectors_{collector.weights_file}'
+
+    def create_inference_client(self, collector: DataCollectionAgent) -> Any:
+        slot = len(self.collector_creators) + self.tester_ids.index(collector.id) \
+            if isinstance(collector, TestingAgent) else collector.id
+        return self.inference_server.create_client(slot, self.get_prediction_group(collector), collector.weights_file)
+
+    # the prediction source that the coordinator provides, if any
+    def create_prediction_source(self, collector: DataCollectionAgent) -> Optional[Any]:
+        if self.inference_server is not None:
+            return self.create_inference_client(collector)
+        return None
+
+    def setup_collector(self, collector_creator: Callable[[], DataCollectionAgent], thread: Thread) \
+            -> DataCollectionAgent:
+        collector = self.create_agent(collector_creator)
+        locals = self.get_thread_locals()
+        locals.is_tester = isinstance(collector, TestingAgent)
+        prediction_source = self.create_prediction_source(collector)
+        if prediction_source is not None:
+            collector.set_prediction_source(prediction_source)
+        if locals.is_tester:
+            locals.learning_done_callback = collector.set_learning_request_callback(self.on_tester_learning_request)
             collector.add_on_weight_reset_callbacks(self.on_tester_weight_reset)
         else:
             collector.add_on_file_completed_callbacks(self.on_collector_file_completed)
+            if self.replay_buffer is not None:
+                collector.add_on_episode_stored_callbacks(self.replay_buffer.push)
         collector.environment.add_callback(self)
-        self.get_thread_locals().collector = collector
-        self.get_thread_locals().thread = thread
-        self.get_thread_locals().pop_and_run_next(self, wait=not self.collect_before_pre_training)
-        collector.start()
+        locals.collector = collector
+        locals.thread = thread
+        locals.pop_and_run_next(self, wait=not self.collect_before_pre_training)
+        return collector
+
+    def start_collector(self, collector_creator: Callable[[], DataCollectionAgent], thread: Thread) -> None:
+        self.setup_collector(collector_creator, thread).start()
 
     def on_episode_end(self, premature: bool) -> None:
         self.get_thread_locals().pop_and_run_next(self)
         self.local_update_collector_weight()
-        if self.is_tester:
+        if self.get_thread_locals().is_tester:
             self.local_update_tester_weight()
 
     def on_environment_finished(self) -> None:
@@ -624,9 +1131,45 @@ class Coordinator(ABC, EnvironmentCallbacks):
     def local_set_new_weight(self, new_weight: List[tf.Tensor]) -> None:
         self.get_thread_locals().new_weight = new_weight
 
+    def local_invalidate_predictions(self) -> None:
+        self.get_thread_locals().collector.invalidate_predictions()
+
     def local_set_new_tester_weight(self, new_weight: List[tf.Tensor]) -> None:
         self.get_thread_locals().new_tester_weight = new_weight
 
+    def get_weight_store_path(self, tester_id: Optional[int] = None) -> str:
+        return f'{self.weight_store_dir}/{"learner" if tester_id is None else f"tester_{tester_id}"}.weights'
+
+    def get_local_weight_specs(self) -> WeightSpecs:
+        locals = self.get_thread_locals()
+        if locals.weight_specs is None:
+            locals.weight_specs = SharedWeightStore.get_specs(locals.collector.get_weights())
+        return locals.weight_specs
+
+    # the weights themselves are read from the shared weight store, only the version goes through the queue
+    def local_set_new_weight_version(self, version: int) -> None:
+        locals = self.get_thread_locals()
+        if locals.weight_store is None:
+            locals.weight_store = SharedWeightStore(self.get_weight_store_path())
+        if version > locals.weight_version:
+            locals.new_weight = locals.weight_store.read(self.get_local_weight_specs(), locals.weight_version)
+            if locals.new_weight is not None:
+                locals.weight_version, locals.new_weight = locals.new_weight
+
+    def local_set_new_tester_weight_version(self, version: int) -> None:
+        locals = self.get_thread_locals()
+        if locals.tester_weight_store is None:
+            locals.tester_weight_store = SharedWeightStore(self.get_weight_store_path(locals.collector.id))
+        if version > locals.tester_weight_version:
+            locals.new_tester_weight = locals.tester_weight_store.read(self.get_local_weight_specs(),
+                                                                       locals.tester_weight_version)
+            if locals.new_tester_weight is not None:
+                locals.tester_weight_version, locals.new_tester_weight = locals.new_tester_weight
+
+    def is_local_weight_latest(self) -> bool:
+        locals = self.get_thread_locals()
+        return locals.weight_store is None or locals.weight_store.get_version() == locals.weight_version
+
     # make these functions with function decorator for coolness :D
     def local_update_collector_weight(self):
         locals = self.get_thread_locals()
@@ -643,50 +1186,84 @@ class Coordinator(ABC, EnvironmentCallbacks):
             locals.new_tester_weight = None
             self.call_learning_done_callback()
 
-    def send_to_workers(self, func: Callable, *args) -> None:
+    def send_to_workers(self, func: Callable, *args, channel: Optional[str] = None) -> None:
         for collector_thread in self.collector_threads:
-            collector_thread.add_to_run_queue(func, *args)
+            collector_thread.add_to_run_queue(func, *args, channel=channel)
         for tester_thread in self.tester_threads:
-            tester_thread.add_to_run_queue(func, *args)
+            tester_thread.add_to_run_queue(func, *args, channel=channel)
 
-    def send_to_tester(self, id: int, func: Callable, *args) -> None:
-        self.tester_threads[self.tester_ids.index(id)].add_to_run_queue(func, *args)
+    def send_to_tester(self, id: int, func: Callable, *args, channel: Optional[str] = None) -> None:
+        self.tester_threads[self.tester_ids.index(id)].add_to_run_queue(func, *args, channel=channel)
 
     def sync_weights(self):
         if not self.sync_weight:
             return
         print(f'{datetime.now()}: sending weights to workers.')
-        self.send_to_workers(Coordinator.local_set_new_weight, self.learner.get_weights())
+        if self.inference_server is not None:
+            # the collectors share their models on the inference server, so their weights are sent to it once and the
+            #   collectors only drop their cached predictions. each tester has its own model and still sends its weights
+            weights = self.learner.get_weights()
+            self.inference_server.update_weights('collectors_', weights)
+            for collector_thread in self.collector_threads:
+                collector_thread.add_to_run_queue(Coordinator.local_invalidate_predictions, channel='control')
+            for tester_thread in self.tester_threads:
+                tester_thread.add_to_run_queue(Coordinator.local_set_new_weight, weights, channel='control')
+        elif self.weight_store_dir is None:
+            self.send_to_workers(Coordinator.local_set_new_weight, self.learner.get_weights(), channel='control')
+        else:
+            if self.learner_weight_store is None:
+                self.learner_weight_store = SharedWeightStore(self.get_weight_store_path())
+            self.send_to_workers(Coordinator.local_set_new_weight_version,
+                                 self.learner_weight_store.publish(self.learner.get_weights()), channel='control')
 
     def sync_tester_weight(self, id: int) -> None:
         print(f'{datetime.now()}: sending weights to tester {id}.')
-        self.send_to_tester(id, Coordinator.local_set_new_tester_weight,
-                            self.tester_learners[self.tester_ids.index(id)].get_weights())
+        weights = self.tester_learners[self.tester_ids.index(id)].get_weights()
+        if self.weight_store_dir is None:
+            self.send_to_tester(id, Coordinator.local_set_new_tester_weight, weights, channel='control')
+        else:
+            if id not in self.tester_weight_stores:
+                self.tester_weight_stores[id] = SharedWeightStore(self.get_weight_store_path(id))
+            self.send_to_tester(id, Coordinator.local_set_new_tester_weight_version,
+                                self.tester_weight_stores[id].publish(weights), channel='control')
 
     def dummy(self):
         return
 
     def record_collector_file_completion(self, id: int, version: int) -> None:
         self.file_completions[version].append(True)
-        if self.train and len(self.file_completions[version]) == len(self.collector_creators):
-            self.learner.learn(version)
-            self.sync_weights()
+        # with a replay buffer the learner has already trained on these episodes
+        if self.train and self.replay_buffer is None:
+            # the screens of this file are preprocessed while the other collectors finish the version
+            self.learner.preprocess_file(f'{self.learner.file_dir}/{version}/{id}')
+            if len(self.file_completions[version]) == len(self.collector_creators):
+                self.learner.learn(version)
+                self.sync_weights()
+
+    @staticmethod
+    def is_tester_learner_weight_reset(func: Callable, id: int) -> bool:
+        return isinstance(func, partial) and func.func is Coordinator.tester_learner_weight_reset and \
+               func.keywords['id'] == id
 
+    # the learning requests and weight resets of a tester are run in the order the tester sent them, although the resets
+    #   are sent on the control channel
+    @staticmethod
+    def get_message_tester(item: QueueItem) -> Optional[int]:
+        func = item[0]
+        if isinstance(func, partial) and func.func in [Coordinator.learn_for_tester,
+                                                        Coordinator.tester_learner_weight_reset]:
+            return func.keywords['id']
+        return None
+
+    # only the weight reset of the learning tester is run while it learns, every other message waits for the dispatcher
     def tester_learning_batch_end_callback(self, id: int) -> None:
-        while True:
-            func, args = self.learner_thread.pop_next()
-            if func is None:
-                return
-            if isinstance(func, partial) and func.func is Coordinator.tester_learner_weight_reset and \
-                    func.keywords['id'] == id:
-                func(self, *args)
-                return
-            else:
-                self.learner_thread_run_queue.append((func, args))
+        self.run_items(self.learner_thread.pop_matching(
+            'control', lambda item: self.is_tester_learner_weight_reset(item[0], id)))
 
     def reset_tester_learner_weights(self, id: int) -> None:
         tester_index = self.tester_ids.index(id)
         print(f'{datetime.now()}: resetting tester learner weights for {id}.')
+        self.tester_learners[tester_index].reset_consumed_versions()
         if self.tester_reset_weight_file[tester_index] is None:
             self.tester_learners[tester_index].model.set_weights(self.learner.model.get_weights())
         else:
@@ -700,13 +1277,13 @@ class Coordinator(ABC, EnvironmentCallbacks):
                                                  partial(self.tester_learning_batch_end_callback, id=id))
         if self.weight_reset_requested[tester_index]:
             self.reset_tester_learner_weights(id)
-            self.send_to_tester(id, Coordinator.call_learning_done_callback)
+            self.send_to_tester(id, Coordinator.call_learning_done_callback, channel='control')
         else:
             self.sync_tester_weight(id)
         self.weight_reset_requested[tester_index] = False
 
     def call_learning_done_callback(self) -> None:
-        self.learning_done_callback()
+        self.get_thread_locals().learning_done_callback()
 
     def on_collector_file_completed(self, id: int, version: int) -> None:
         self.learner_thread.add_to_run_queue(
@@ -718,7 +1295,7 @@ class Coordinator(ABC, EnvironmentCallbacks):
 
     def on_tester_weight_reset(self, id: int, weight_file: str = None) -> None:
         self.learner_thread.add_to_run_queue(partial(Coordinator.tester_learner_weight_reset,
-                                                     id=id, weight_file=weight_file))
+                                                     id=id, weight_file=weight_file), channel='control')
 
     def tester_learner_weight_reset(self, id: int, weight_file: str = None) -> None:
         tester_index = self.tester_ids.index(id)
@@ -734,21 +1311,45 @@ class Coordinator(ABC, EnvironmentCallbacks):
         else:
             self.reset_tester_learner_weights(id)
 
+    # with several workers, the checkpoints are split between processes that each create their own learner. the
+    #   validation set is built here first, so with a memmap validation cache the workers only load it
+    def evaluate_checkpoints(self, version: List[int]) -> None:
+        checkpoints = sorted(glob.glob(f'{self.evaluate_dir}/*.hdf5'))
+        if self.evaluation_workers <= 1 or len(checkpoints) <= 1:
+            self.learner.evaluate(self.evaluate_dir, version, checkpoints)
+            return
+        self.learner.get_validation_set(self.learner.validation_dir, version)
+        worker_count = min(self.evaluation_workers, len(checkpoints))
+        print(f'{datetime.now()}: evaluating {len(checkpoints)} checkpoints in {worker_count} processes.')
+        with multiprocessing.get_context('spawn').Pool(worker_count) as pool:
+            results = sum(pool.starmap(evaluate_checkpoints, [
+                (self.learner_creator, self.evaluate_dir, version, checkpoints[i::worker_count])
+                for i in range(worker_count)]), [])
+        for checkpoint, loss in sorted(results, key=lambda result: np.ravel(result[1])[0]):
+            print(f'eval res for {checkpoint}: {loss}')
+
     def start(self):
+        if self.weight_store_dir is not None:
+            Path(self.weight_store_dir).mkdir(parents=True, exist_ok=True)
+        if self.replay_buffer is not None:
+            self.replay_buffer.create()
+        if self.inference_server is not None:
+            self.inference_server.start()
         self.learner_thread = self.get_main_thread()
+        self.learner_thread.set_order_key(Coordinator.get_message_tester)
         self.collector_threads = [self.create_thread(self.start_collector, c_creator)
                                   for c_creator in self.collector_creators]
         self.tester_threads = [self.create_thread(self.start_collector, t_creator)
                                for t_creator in self.tester_creators]
         [c_thread.run() for c_thread in self.collector_threads]
         [t_thread.run() for t_thread in self.tester_threads]
-        self.tester_learners = [learner_creator() for learner_creator in self.tester_learner_creators]
+        self.tester_learners = [self.create_agent(learner_creator) for learner_creator in self.tester_learner_creators]
         self.weight_reset_requested = [False] * len(self.tester_learners)
         self.tester_reset_weight_file = [None] * len(self.tester_learners)
         self.tester_in_learning = [False] * len(self.tester_learners)
-        self.learner = self.learner_creator()
+        self.learner = self.create_agent(self.learner_creator)
         if self.evaluate_dir is not None:
-            self.learner.evaluate(self.evaluate_dir, list(range(self.collector_version_start)))
+            self.evaluate_checkpoints(list(range(self.collector_version_start)))
         if self.pre_training:
             self.learner.learn(list(range(self.collector_version_start)))
         if self.sync_weight:
@@ -757,12 +1358,53 @@ class Coordinator(ABC, EnvironmentCallbacks):
             print(f'{datetime.now()}: sending dummy to workers.')
             self.send_to_workers(Coordinator.dummy)
         while self.environment_completion_count < len(self.collector_creators) + len(self.tester_creators):
-            if len(self.learner_thread_run_queue) > 0:
-                func, args = self.learner_thread_run_queue.popleft()
-                func(self, *args)
-            else:
-                self.learner_thread.pop_and_run_next(self)
-            time.sleep(1)
+            self.dispatch()
+        if self.inference_server is not None:
+            self.inference_server.stop()
+
+    def run_items(self, items: List[QueueItem]) -> None:
+        for func, args, enqueue_time in items:
+            self.dispatch_stats.record_dispatch(enqueue_time)
+            func(self, *args)
+
+    # the learner trains continuously once the replay buffer has a batch. if the buffer could not be balanced, it waits
+    #   for new episodes
+    def can_learn_from_replay_buffer(self) -> bool:
+        return self.train and self.replay_buffer is not None and \
+               self.replay_buffer.get_size() >= self.learner.batch_size and \
+               self.replay_stalled_at != self.replay_buffer.get_pushed_count()
+
+    def learn_from_replay_buffer(self) -> None:
+        loss = self.learner.learn_from_replay_buffer(self.replay_buffer, self.replay_steps_per_dispatch)
+        if loss is None:
+            self.replay_stalled_at = self.replay_buffer.get_pushed_count()
+            return
+        self.replay_stalled_at = None
+        self.replay_losses.append(loss)
+        previous_steps = self.replay_steps
+        self.replay_steps += self.replay_steps_per_dispatch
+        if self.replay_steps // self.replay_log_frequency > previous_steps // self.replay_log_frequency:
+            print(f'{datetime.now()}: learner trained {self.replay_steps} steps from the replay buffer '
+                  f'({self.replay_buffer.get_size()} of {self.replay_buffer.get_pushed_count()} episodes), '
+                  f'mean loss {np.mean(self.replay_losses):.4f}.')
+            self.replay_losses = []
+        if self.replay_steps // self.replay_sync_frequency > previous_steps // self.replay_sync_frequency:
+            self.learner.on_replay_sync(self.replay_buffer, self.replay_steps, loss)
+            self.sync_weights()
+
+    # runs everything that is ready in one wake-up (control messages first, but not before the earlier messages of the
+    #   same tester), blocking on the learner queue only when nothing is pending
+    def dispatch(self) -> None:
+        can_learn = self.can_learn_from_replay_buffer()
+        items = self.learner_thread.pop_ready(0 if can_learn else self.dispatch_timeout)
+        if len(items) > 0:
+            self.dispatch_stats.record_wakeup(len(items) + max(0, self.learner_thread.get_queue_size()))
+        self.run_items(items)
+        if can_learn:
+            self.learn_from_replay_buffer()
+        if time.time() - self.dispatch_stats.start_time >= self.dispatch_stats_frequency:
+            print(f'{datetime.now()}: learner dispatched {self.dispatch_stats.summary()}.')
+            self.dispatch_stats.reset()
 
 
 class ProcessBasedCoordinator(Coordinator):
@@ -771,19 +1413,263 @@ class ProcessBasedCoordinator(Coordinator):
                  tester_creators: List[Union[int, Callable[[], TestingAgent]]],
                  tester_learner_creators: List[Callable[[], Union[None, LearningAgent]]], cfg: Config):
         self.process_configs = cfg['process_configs']
+        resource_configs = cfg['resource_configs']
 
         super().__init__(collector_creators, learner_creator, tester_creators, tester_learner_creators, cfg)
 
+        if self.inference_configs['mode'] == 'shared':
+            raise ValueError('the shared inference needs a thread based coordinator backend.')
         self.thread_count = 0
         self.thread_locals = None
+        self.learner_resource_plan, self.worker_resource_plans = \
+            ResourcePlanner(len(collector_creators) + len(tester_creators), resource_configs).plan() \
+            if resource_configs['plan'] else (None, None)
 
     def get_thread_locals(self) -> ThreadLocals:
         if self.thread_locals is None:
             self.thread_locals = ThreadLocals()
         return self.thread_locals
 
+    # the workers are created in the order of their resource plans
     def create_thread(self, main_func: Callable, *args) -> Thread:
-        return Process(f'process_{self.thread_count}', main_func, *args, cfg=self.process_configs)
+        self.thread_count += 1
+        if self.worker_resource_plans is None:
+            return Process(f'process_{self.thread_count}', main_func, *args, cfg=self.process_configs)
+        return Process(f'process_{self.thread_count}', self.run_with_resource_plan,
+                       self.worker_resource_plans[self.thread_count - 1], main_func, *args, cfg=self.process_configs)
+
+    def run_with_resource_plan(self, resource_plan: ResourcePlan, main_func: Callable, *args) -> None:
+        resource_plan.apply()
+        main_func(*args)
 
     def get_main_thread(self) -> Thread:
         return Process(None, None, cfg=self.process_configs, main_process=True)
+
+    def start(self):
+        if self.learner_resource_plan is not None:
+            self.learner_resource_plan.apply()
+        super().start()
+
+
+# runs the workers as threads of the main process. they share one tensorflow graph and session, so the memory and the
+#   start up time of tensorflow are paid once. graph construction is not thread safe, so the agents are created one at
+#   a time. with the shared inference, the workers of a prediction group (see get_prediction_group) also share one
+#   reward predictor, and their own models only turn its predictions into actions
+class ThreadBasedCoordinator(Coordinator):
+    def __init__(self, collector_creators: List[Callable[[], DataCollectionAgent]],
+                 learner_creator: Callable[[], LearningAgent],
+                 tester_creators: List[Union[int, Callable[[], TestingAgent]]],
+                 tester_learner_creators: List[Callable[[], Union[None, LearningAgent]]], cfg: Config):
+        self.thread_configs = cfg['thread_configs']
+        self.prediction_model_creator = cfg['prediction_model_creator']
+        self.example_episode = cfg['example_episode']
+
+        super().__init__(collector_creators, learner_creator, tester_creators, tester_learner_creators, cfg)
+
+        self.thread_count = 0
+        self.thread_locals = threading.local()
+        self.agent_creation_lock = threading.Lock()
+        self.graph = tf.get_default_graph()
+        self.session = keras.backend.get_session()
+        self.shared_predictors = {}
+
+    def get_thread_locals(self) -> ThreadLocals:
+        if not hasattr(self.thread_locals, 'locals'):
+            self.thread_locals.locals = ThreadLocals()
+        return self.thread_locals.locals
+
+    # keras keeps its session per thread, so each worker is pointed to the shared one before creating its agent. keras
+    #   adds the predict and train functions of a model to the graph on their first use, so they are built here too
+    def create_agent(self, creator: Callable[[], Any]) -> Any:
+        with self.agent_creation_lock, self.graph.as_default():
+            keras.backend.set_session(self.session)
+            agent = creator()
+            if agent is not None:
+                agent.model._make_predict_function()
+                if getattr(agent.model, 'optimizer', None) is not None:
+                    agent.model._make_train_function()
+            return agent
+
+    # the model predicts once while it is created, so its predict function is not built by several threads at once
+    def create_shared_model(self, weights_file: Optional[str]) -> keras.Model:
+        model = self.prediction_model_creator(weights_file)
+        model.predict_on_batch(np.expand_dims(self.example_episode.state, axis=0))
+        return model
+
+    def create_prediction_source(self, collector: DataCollectionAgent) -> Optional[Any]:
+        if self.inference_configs['mode'] != 'shared':
+            return super().create_prediction_source(collector)
+        group = self.get_prediction_group(collector)
+        with self.agent_creation_lock:
+            if group not in self.shared_predictors:
+                with self.graph.as_default():
+                    keras.backend.set_session(self.session)
+                    print(f'{datetime.now()}: creating the shared model of {group}.')
+                    self.shared_predictors[group] = SharedKerasPredictor(self.create_shared_model(
+                        collector.weights_file))
+            return self.shared_predictors[group]
+
+    def create_thread(self, main_func: Callable, *args) -> Thread:
+        self.thread_count += 1
+        return LocalThread(f'thread_{self.thread_count}', main_func, *args, cfg=self.thread_configs)
+
+    def get_main_thread(self) -> Thread:
+        return LocalThread(None, None, cfg=self.thread_configs, main_thread=True)
+
+
+# same as ThreadBasedCoordinator, but the environment loop of each worker is a coroutine on an event loop (in its own
+#   thread), and each of its steps runs in a pool of blocking_threads threads (one per worker if empty). the phone and
+#   browser drivers block, so a step holds a thread, but fewer threads than workers bound how many workers step at once
+class AsyncioCoordinator(ThreadBasedCoordinator):
+    def __init__(self, collector_creators: List[Callable[[], DataCollectionAgent]],
+                 learner_creator: Callable[[], LearningAgent],
+                 tester_creators: List[Union[int, Callable[[], TestingAgent]]],
+                 tester_learner_creators: List[Callable[[], Union[None, LearningAgent]]], cfg: Config):
+        super().__init__(collector_creators, learner_creator, tester_creators, tester_learner_creators, cfg)
+
+        blocking_threads = self.thread_configs['blocking_threads']
+
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(blocking_threads or len(collector_creators) + len(tester_creators))
+
+    # main_func is start_collector, whose environment loop run_worker runs one step at a time
+    def create_thread(self, main_func: Callable, *args) -> Thread:
+        return EventLoopTask(self.loop, self.run_worker, *args, cfg=self.thread_configs)
+
+    # the executor threads run the steps of every worker, so the locals and the keras session are set on every call
+    def run_with_locals(self, locals: ThreadLocals, func: Callable, *args) -> Any:
+        self.thread_locals.locals = locals
+        with self.graph.as_default():
+            keras.backend.set_session(self.session)
+            return func(*args)
+
+    async def run_blocking(self, locals: ThreadLocals, func: Callable, *args) -> Any:
+        return await self.loop.run_in_executor(self.executor, partial(self.run_with_locals, locals, func, *args))
+
+    @staticmethod
+    def run_step(steps: Iterator[None]) -> bool:
+        try:
+            next(steps)
+            return True
+        except StopIteration:
+            return False
+
+    async def run_worker(self, collector_creator: Callable[[], DataCollectionAgent], thread: Thread) -> None:
+        locals = ThreadLocals()
+        collector = await self.run_blocking(locals, self.setup_collector, collector_creator, thread)
+        steps = collector.run_steps()
+        while await self.run_blocking(locals, self.run_step, steps):
+            pass
+
+    def start(self):
+        loop_thread = threading.Thread(target=self.loop.run_forever, name='event_loop', daemon=True)
+        loop_thread.start()
+        try:
+            super().start()
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            loop_thread.join()
+            self.loop.close()
+            self.executor.shutdown(wait=False)
+
+
+# runs the coordinator over several nodes, which all use the same configs except for their node name. the learner node
+#   runs the learner and its local workers, and the other nodes only run their workers. the workers send to the learner
+#   over tcp and stream their completed episode files to it before reporting them
+class NetworkCoordinator(ProcessBasedCoordinator):
+    def __init__(self, collector_creators: List[Callable[[], DataCollectionAgent]],
+                 learner_creator: Callable[[], LearningAgent],
+                 tester_creators: List[Union[int, Callable[[], TestingAgent]]],
+                 tester_learner_creators: List[Callable[[], Union[None, LearningAgent]]], cfg: Config):
+        self.network_configs = cfg['network_configs']
+        self.node = self.network_configs['node']
+        self.data_file_dir = cfg['data_file_dir']
+        self.tester_file_dir = cfg['tester_file_dir']
+
+        super().__init__(collector_creators, learner_creator, tester_creators, tester_learner_creators, cfg)
+
+        if self.weight_store_dir is not None:
+            raise ValueError('the weight store cannot be shared between nodes.')
+        if self.replay_buffer is not None:
+            raise ValueError('the replay buffer cannot be shared between nodes.')
+        if self.inference_server is not None:
+            raise ValueError('the inference server cannot be shared between nodes.')
+
+        self.registry = NodeRegistry(self.network_configs)
+        self.server = None
+        self.local_threads = {}
+
+    # the worker processes reach the learner over the network, even on the learner node
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['server'] = None
+        state['learner_thread'] = self.get_remote_learner_thread()
+        return state
+
+    def is_learner_node(self) -> bool:
+        return self.node == self.registry.learner_node
+
+    def get_remote_learner_thread(self) -> RemoteThread:
+        return RemoteThread(self.registry.get_address(self.registry.learner_node), 'learner',
+                            self.process_configs['channels'], self.registry.authkey)
+
+    def create_thread(self, main_func: Callable, *args) -> Thread:
+        name = self.registry.get_worker_name(self.thread_count)
+        node = self.registry.get_worker_node(self.thread_count)
+        self.thread_count += 1
+        if node != self.node:
+            return RemoteThread(self.registry.get_address(node), name, self.process_configs['channels'],
+                                self.registry.authkey)
+        thread = Process(name, main_func, *args, cfg=self.process_configs)
+        self.local_threads[name] = thread
+        return thread
+
+    def get_main_thread(self) -> Thread:
+        return LocalThread(None, None, cfg=self.process_configs, main_thread=True)
+
+    def create_agent(self, creator: Callable[[], Any]) -> Any:
+        agent = super().create_agent(creator)
+        if not self.is_learner_node() and isinstance(agent, DataCollectionAgent):
+            agent.add_on_file_completed_callbacks(partial(self.stream_episode_file, agent), first=True)
+        return agent
+
+    def get_file_dir(self, is_tester: bool, id: int) -> str:
+        return f'{self.tester_file_dir}/tester{id}' if is_tester else self.data_file_dir
+
+    def stream_episode_file(self, agent: DataCollectionAgent, id: int, version: int) -> None:
+        is_tester = isinstance(agent, TestingAgent)
+        for file_path in sorted(glob.glob(f'{agent.file_dir}/{version}/{id}.*')):
+            self.learner_thread.send_file(file_path, (is_tester, id), os.path.relpath(file_path, agent.file_dir))
+
+    # called from the connection threads of the server
+    def on_frame(self, frame: Tuple) -> None:
+        if frame[0] == 'message':
+            _, name, channel, item = frame
+            (self.learner_thread if name == 'learner' else self.local_threads[name]).put(channel, item)
+        elif frame[0] == 'file':
+            _, (is_tester, id), relative_path, offset, data = frame
+            file_path = resolve_file_path(self.get_file_dir(bool(is_tester), int(id)), relative_path)
+            write_file_chunk(file_path, offset, data)
+        else:
+            raise ValueError(f'unknown frame {frame[0]}.')
+
+    def start_workers(self) -> None:
+        self.learner_thread = self.get_remote_learner_thread()
+        self.collector_threads = [self.create_thread(self.start_collector, c_creator)
+                                  for c_creator in self.collector_creators]
+        self.tester_threads = [self.create_thread(self.start_collector, t_creator)
+                               for t_creator in self.tester_creators]
+        print(f'{datetime.now()}: starting {len(self.local_threads)} workers in node {self.node}.')
+        [thread.run() for thread in self.local_threads.values()]
+        [thread.process.join() for thread in self.local_threads.values()]
+
+    def start(self):
+        self.server = MessageServer(self.registry.get_bind_address(self.node), self.on_frame, self.registry.authkey)
+        self.server.start()
+        try:
+            if self.is_learner_node():
+                super().start()
+            else:
+                self.start_workers()
+        finally:
+            self.server.close()
@@ -0,0 +1,78 @@
+import os
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+from utils import dump_obj, load_obj
+
+
+# the validation batches of a set of versions, generated once and then replayed in the same order, so every checkpoint
+#   and every epoch is validated on the same samples. the batches are kept in memory, or in memmaps next to file_name
+#   so that other processes can load them instead of generating them again
+class ValidationSet:
+    def __init__(self, generator: Optional[Callable], size: int, batch_size: int, file_name: Optional[str] = None):
+        self.batch_size = batch_size
+        self.steps = int(size / batch_size)
+        self.file_name = file_name
+        self.arrays = None
+        self.y_count = None
+
+        if file_name is not None:
+            self.load()
+        if self.arrays is None:
+            self.build(generator)
+
+    @staticmethod
+    def flatten(x: Dict[str, np.ndarray], y: Any) -> Dict[str, np.ndarray]:
+        arrays = {f'x_{key}': value for key, value in x.items()}
+        for i, value in enumerate(y if isinstance(y, tuple) else [y]):
+            arrays[f'y_{i}'] = value
+        return arrays
+
+    def load(self) -> None:
+        if not os.path.exists(self.file_name + '.info'):
+            return
+        info = load_obj(self.file_name + '.info')
+        if info['steps'] < self.steps or info['batch_size'] != self.batch_size:
+            return
+        self.y_count = info['y_count']
+        self.arrays = {key: np.memmap(f'{self.file_name}.{key}.npy', dtype=dtype, mode='r', shape=shape)
+                       for key, (dtype, shape) in info['arrays'].items()}
+
+    # the info file is written last, so a partially built set is never loaded
+    def build(self, generator: Callable) -> None:
+        data = generator()
+        self.arrays = {}
+        for step in range(self.steps):
+            x, y = next(data)
+            batch = self.flatten(x, y)
+            if step == 0:
+                self.y_count = len(y) if isinstance(y, tuple) else None
+                for key, value in batch.items():
+                    shape = (self.steps * self.batch_size, *value.shape[1:])
+                    self.arrays[key] = np.zeros(shape, dtype=value.dtype) if self.file_name is None else \
+                        np.memmap(f'{self.file_name}.{key}.npy', dtype=value.dtype, mode='w+', shape=shape)
+            for key, value in batch.items():
+                self.arrays[key][step * self.batch_size:(step + 1) * self.batch_size] = value
+        data.close()
+        if self.file_name is not None:
+            for array in self.arrays.values():
+                array.flush()
+            dump_obj({'steps': self.steps, 'batch_size': self.batch_size, 'y_count': self.y_count,
+                      'arrays': {key: (array.dtype, array.shape) for key, array in self.arrays.items()}},
+                     self.file_name + '.info')
+
+    def get_steps(self) -> int:
+        return self.steps
+
+    def get_batch(self, step: int) -> Tuple[Dict[str, np.ndarray], Any]:
+        batch = {key: array[step * self.batch_size:(step + 1) * self.batch_size] for key, array in self.arrays.items()}
+        x = {key[2:]: value for key, value in batch.items() if key.startswith('x_')}
+        if self.y_count is None:
+            return x, batch['y_0']
+        return x, tuple(batch[f'y_{i}'] for i in range(self.y_count))
+
+    def get_data(self) -> Iterator[Tuple[Dict[str, np.ndarray], Any]]:
+        while True:
+            for step in range(self.steps):
+                yield self.get_batch(step)
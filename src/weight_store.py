@@ -0,0 +1,80 @@
+import os
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+# the shape and dtype of each weight
+WeightSpecs = List[Tuple[Tuple[int, ...], np.dtype]]
+
+
+# a versioned weight blob in a memory mapped file (preferably under /dev/shm). there is a single writer, and readers
+#   use the sequence counter (odd while writing) to detect and retry torn reads
+class SharedWeightStore:
+    header_dtype = np.dtype([('sequence', '<i8'), ('version', '<i8'), ('size', '<i8')])
+
+    def __init__(self, path: str):
+        self.path = path
+        self.header = None
+        self.data = None
+
+    # a resized file keeps its header, so the version keeps increasing and the readers accept the next publish
+    def open(self, size: Optional[int] = None) -> None:
+        if size is not None and (not os.path.exists(self.path) or
+                                 os.path.getsize(self.path) != self.header_dtype.itemsize + size):
+            with open(self.path, 'r+b' if os.path.exists(self.path) else 'wb') as f:
+                f.truncate(self.header_dtype.itemsize + size)
+        self.header = np.memmap(self.path, dtype=self.header_dtype, mode='r+' if size is not None else 'r',
+                                shape=(1,))
+        self.data = np.memmap(self.path, dtype=np.uint8, mode='r+' if size is not None else 'r',
+                              offset=self.header_dtype.itemsize)
+
+    def get_version(self) -> int:
+        if self.header is None:
+            if not os.path.exists(self.path):
+                return -1
+            self.open()
+        return int(self.header[0]['version'])
+
+    def publish(self, weights: List[np.ndarray]) -> int:
+        size = sum(weight.nbytes for weight in weights)
+        if self.header is None or len(self.data) != size:
+            self.open(size)
+        header = self.header[0]
+        header['sequence'] += 1
+        offset = 0
+        for weight in weights:
+            self.data[offset:offset + weight.nbytes] = np.ascontiguousarray(weight).view(np.uint8).ravel()
+            offset += weight.nbytes
+        header['size'] = size
+        header['version'] += 1
+        header['sequence'] += 1
+        return int(header['version'])
+
+    # the readers get the specs of their model once, instead of its weights on every read
+    @staticmethod
+    def get_specs(example_weights: List[np.ndarray]) -> WeightSpecs:
+        return [(weight.shape, weight.dtype) for weight in example_weights]
+
+    def read(self, specs: WeightSpecs, version: int = -1) -> Optional[Tuple[int, List[np.ndarray]]]:
+        if self.get_version() <= version:
+            return None
+        while True:
+            sequence = int(self.header[0]['sequence'])
+            if sequence % 2 == 1:
+                time.sleep(.01)
+                continue
+            new_version = int(self.header[0]['version'])
+            # the writer resized the file since it was mapped
+            if int(self.header[0]['size']) != len(self.data):
+                self.open()
+            sizes = [int(np.prod(shape)) * np.dtype(dtype).itemsize for shape, dtype in specs]
+            if int(self.header[0]['size']) != sum(sizes):
+                raise ValueError(f'weights in {self.path} do not match the model.')
+            weights = []
+            offset = 0
+            for (shape, dtype), size in zip(specs, sizes):
+                weights.append(np.array(self.data[offset:offset + size]).view(dtype).reshape(shape))
+                offset += size
+            if int(self.header[0]['sequence']) == sequence:
+                return new_version, weights